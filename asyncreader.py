@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+import serial
+import metrics
+from gpsreader import (DEFAULT_BAUD_RATE, QUEUE_SIZE, READ_SECONDS, RECONNECT_DELAY, FrameParser, format_block,
+                       read_records)
+
+logger = logging.getLogger(__name__)
+
+REPLAY_YIELD_RECORDS = 64  # Records an unpaced replay feeds before letting other tasks run
+
+# asyncio counterpart of gpsreader.FixReader: reads one GPS source in a task on
+# the event loop instead of a thread, and hands complete frames to the
+# consumer through an asyncio.Queue. Framing, queue policies and statistics
+# are the same, so metrics.register_reader works on it unchanged. Subclasses
+# implement _read, a coroutine that awaits data and passes it to _feed.
+class AsyncFixReader:
+    def __init__(self, name, queue_size=QUEUE_SIZE, policy='drop', reconnect_delay=RECONNECT_DELAY):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.reconnect_delay = reconnect_delay
+        self.frames = asyncio.Queue(maxsize=queue_size)
+        self.parser = FrameParser()
+        self.bytes_read = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.blocked = 0
+        self.in_waiting = 0  # Bytes the driver held at the last read, where the source knows
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    # Start reading; call from a coroutine on the loop that will consume the frames
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run(), name=self.name)
+        return self._task
+
+    async def run(self):
+        while not self._stopped.is_set():
+            try:
+                await self._read()
+            except OSError as e:  # serial.SerialException is an OSError too
+                print(f"Error: Could not read {self.name}: {e}")
+            if not self._stopped.is_set():
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), self.reconnect_delay)
+                except asyncio.TimeoutError:
+                    pass
+        print(f"{self.name} closed.")
+
+    async def _read(self):
+        raise NotImplementedError
+
+    async def _feed(self, data):
+        self.bytes_read += len(data)
+        start = metrics.now()
+        frames = self.parser.feed(data)
+        READ_SECONDS.observe_since(start)
+        if frames and logger.isEnabledFor(logging.DEBUG):
+            for frame in frames:
+                logger.debug("Raw data: %s", frame)
+        for frame in frames:
+            await self._put(frame)
+
+    async def _put(self, frame):
+        self.frames_received += 1
+        if self.policy == 'block':
+            if self.frames.full():
+                self.blocked += 1
+            await self.frames.put(frame)
+        else:
+            # Nothing else runs between these calls, so the oldest frame is
+            # dropped only when the queue really is full
+            while self.frames.full():
+                self.frames.get_nowait()
+                self.frames_dropped += 1
+            self.frames.put_nowait(frame)
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def stats(self):
+        return {
+            'bytes_read': self.bytes_read,
+            'frames_received': self.frames_received,
+            'frames_dropped': self.frames_dropped,
+            'blocked': self.blocked,
+            'discarded': self.parser.discarded,
+            'queue_depth': self.frames.qsize(),
+            'in_waiting': self.in_waiting,
+            'buffered_bytes': len(self.parser._pending),
+        }
+
+# Serial port without a thread. The port is opened non-blocking and the event
+# loop wakes the reader when its descriptor is readable (POSIX). Where the loop
+# cannot watch the port (Windows), each read runs in the default executor.
+class AsyncSerialReader(AsyncFixReader):
+    def __init__(self, port, baud_rate, **options):
+        super().__init__(port, **options)
+        self.port = port
+        self.baud_rate = baud_rate
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        with serial.Serial(self.port, self.baud_rate, timeout=0) as ser:
+            print(f"Connected to {self.port} at {self.baud_rate} baud rate.")
+            readable = asyncio.Event()
+            try:
+                loop.add_reader(ser.fileno(), readable.set)
+            except (AttributeError, NotImplementedError):
+                await self._read_in_executor(loop, ser)
+                return
+            try:
+                while not self._stopped.is_set():
+                    await readable.wait()
+                    readable.clear()
+                    self.in_waiting = ser.in_waiting
+                    # A readable port with nothing to read has gone away; pyserial
+                    # raises SerialException and the port is reopened
+                    data = ser.read(max(1, self.in_waiting))
+                    if data:
+                        await self._feed(data)
+            finally:
+                loop.remove_reader(ser.fileno())
+
+    async def _read_in_executor(self, loop, ser):
+        ser.timeout = 1
+        while not self._stopped.is_set():
+            self.in_waiting = ser.in_waiting
+            data = await loop.run_in_executor(None, ser.read, max(1, self.in_waiting))
+            if data:
+                await self._feed(data)
+
+# Receiver stream over TCP (e.g. a serial-to-network bridge on the implement)
+class AsyncTcpReader(AsyncFixReader):
+    def __init__(self, host, port, **options):
+        super().__init__(f"{host}:{port}", **options)
+        self.host = host
+        self.port = port
+
+    async def _read(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), 10)
+        print(f"Connected to {self.host}:{self.port}.")
+        try:
+            while not self._stopped.is_set():
+                data = await reader.read(4096)
+                if not data:
+                    raise ConnectionError("connection closed by peer")
+                await self._feed(data)
+        finally:
+            writer.close()
+
+# Replays a recorded session (.csv log or .trk track file) as receiver text
+# blocks, like gpsreader.ReplayReader. speed is a multiple of wall-clock time
+# (None replays as fast as the consumer takes them); loop starts over at the
+# end instead of stopping.
+class AsyncReplayReader(AsyncFixReader):
+    def __init__(self, path, speed=1.0, loop=False, **options):
+        options.setdefault('policy', 'block')
+        super().__init__(path, **options)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.finished = asyncio.Event()
+
+    async def _read(self):
+        while not self._stopped.is_set():
+            await self._replay_once()
+            if not self.loop:
+                self.finished.set()
+                self._stopped.set()
+
+    async def _replay_once(self):
+        start_wall = time.monotonic()
+        start_stamp = None
+        for count, (timestamp, lat, lon, alt, speed, heading) in enumerate(read_records(self.path)):
+            if self._stopped.is_set():
+                return
+            if self.speed:
+                if start_stamp is None:
+                    start_stamp = timestamp
+                delay = (timestamp - start_stamp) / self.speed - (time.monotonic() - start_wall)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif count % REPLAY_YIELD_RECORDS == 0:
+                # A queue with room never blocks, so give the loop a turn
+                await asyncio.sleep(0)
+            await self._feed(format_block(lat, lon, alt, speed, heading).encode('ascii'))
+
+# Build a reader from a source spec, as gpsreader.open_source:
+# serial:<device>[@<baud>], tcp:<host>:<port> or replay:<path>
+def open_async_source(spec, **options):
+    kind, _, target = spec.partition(':')
+    if kind == 'serial':
+        device, _, baud_rate = target.partition('@')
+        return AsyncSerialReader(device, int(baud_rate or DEFAULT_BAUD_RATE), **options)
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return AsyncTcpReader(host, int(port), **options)
+    if kind == 'replay':
+        return AsyncReplayReader(target, **options)
+    raise ValueError(f"Unknown source: {spec}")
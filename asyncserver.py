@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import namedtuple
+import jinja2
+import socketio
+from aiohttp import web
+import metrics
+from asyncreader import open_async_source
+from broadcast import AsyncBroadcaster
+from fleetconfig import add_vehicle_arguments, load_vehicles
+from gpsparser import FixParser
+from journal import SessionJournal
+from session import DISTANCE_FEET, CoverageSession
+from tilecache import CACHE_MAX_AGE, STATIC_DIR, TileCache
+
+BATCH_FRAMES = 64  # Frames a session owner processes before yielding to the loop
+BATCH_SECONDS = 0.005  # Or sooner, once a batch has taken this long
+COMMAND_TIMEOUT = 5.0  # Seconds a client waits for the owner to carry out a command
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+logger = logging.getLogger(__name__)
+
+# Everything runs on one event loop: the GPS readers, the session owners, the
+# broadcaster and the SocketIO server
+sio = socketio.AsyncServer(async_mode='aiohttp')
+broadcaster = AsyncBroadcaster(sio)
+metrics.register_broadcaster(broadcaster)
+
+# Map tiles shared by every vehicle's page
+tile_cache = TileCache()
+metrics.register_tile_cache(tile_cache)
+
+# The same templates as the Flask servers, with url_for for their static files
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+                               autoescape=jinja2.select_autoescape(['html']))
+templates.globals['url_for'] = lambda endpoint, filename: f'/static/{filename}'
+
+# Session owners by vehicle id
+owners = {}
+
+# A session's state as last published by its owner. Never changed once made;
+# the owner swaps in a new one after each batch of fixes.
+SessionView = namedtuple('SessionView', ['tracking', 'seq', 'fixes', 'location', 'stats'])
+
+# One tracked implement, whose CoverageSession is owned by a single task. The
+# task takes frames from the reader's queue, parses them and runs them through
+# the session, and yields to the loop after BATCH_FRAMES frames or
+# BATCH_SECONDS, whichever comes first, so a source catching up on a backlog
+# does not hold up the clients or the other vehicles.
+# Tracking is toggled by sending the owner a command; nothing else changes the
+# session. Everyone else sees it through immutable snapshots: `view`, replaced
+# after every batch, and session.snapshot(), whose packed edges are bytes
+# shared by every client until the next delta. The session's lock is kept for
+# the journal and is never contended.
+class SessionOwner:
+    def __init__(self, vehicle_id, source, width_feet=DISTANCE_FEET, state_dir=None, boundary=None,
+                 **source_options):
+        self.id = vehicle_id
+        self.source = source
+        self.room = f"vehicle:{vehicle_id}"
+        self.parser = FixParser()
+        self.session = CoverageSession(width_feet=width_feet, boundary=boundary)
+        self.journal = None
+        if state_dir is not None:
+            # Each vehicle keeps its own journal so sessions resume independently
+            self.journal = SessionJournal(os.path.join(state_dir, vehicle_id))
+            self.journal.attach(self.session)
+        self.reader = open_async_source(source, **source_options)
+        self.commands = asyncio.Queue()
+        self.fixes = 0
+        self.view = SessionView(self.session.tracking, self.session.seq, 0, None, self.session.stats())
+        metrics.register_reader(self.reader, vehicle=vehicle_id)
+        metrics.register_parser(self.parser, vehicle=vehicle_id)
+        metrics.register_session(self.session, vehicle=vehicle_id)
+        self._task = None
+
+    def start(self):
+        self.reader.start()
+        self._task = asyncio.get_running_loop().create_task(self.run(), name=f"session:{self.id}")
+
+    def stop(self):
+        self.reader.stop()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        frames = self.reader.frames
+        frame_wait = command_wait = None
+        try:
+            while True:
+                if frame_wait is None:
+                    frame_wait = asyncio.ensure_future(frames.get())
+                if command_wait is None:
+                    command_wait = asyncio.ensure_future(self.commands.get())
+                done, _ = await asyncio.wait((frame_wait, command_wait), return_when=asyncio.FIRST_COMPLETED)
+                if command_wait in done:
+                    command = command_wait.result()
+                    command_wait = None
+                    self._command(*command)
+                if frame_wait in done:
+                    self._process_batch(frame_wait.result())
+                    frame_wait = None
+                    # Let the clients and the other vehicles in before the next batch
+                    await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Vehicle %s: session owner stopped", self.id)
+            raise
+        finally:
+            if frame_wait is not None:
+                frame_wait.cancel()
+            if command_wait is not None:
+                if command_wait.done() and not command_wait.cancelled():
+                    # Taken off the queue but never carried out; failed below with the rest
+                    self.commands.put_nowait(command_wait.result())
+                else:
+                    command_wait.cancel()
+            self._fail_commands()
+
+    # Process frame and whatever else is queued, up to the batch limits
+    def _process_batch(self, frame):
+        frames = self.reader.frames
+        deadline = time.perf_counter() + BATCH_SECONDS
+        location = self.view.location
+        for count in range(1, BATCH_FRAMES + 1):
+            try:
+                fix = self.parser.parse(frame)
+                if fix:
+                    self.fixes += 1
+                    location = (fix.lat, fix.lon)
+                    self.publish(self.session.process_fix(fix))
+            except Exception:
+                logger.exception("Vehicle %s: failed to process frame %r", self.id, frame)
+            if count == BATCH_FRAMES or frames.empty() or time.perf_counter() > deadline:
+                break
+            frame = frames.get_nowait()
+        self._update_view(location)
+
+    def _command(self, command, done):
+        if done.done():
+            return  # The client gave up waiting, so leave the session as it was
+        try:
+            if command == 'toggle':
+                tracking, events = self.session.toggle_tracking()
+                self.publish(events)
+                self._update_view(self.view.location)
+                done.set_result(tracking)
+        except Exception as e:
+            done.set_exception(e)
+            raise
+
+    # Fail the commands still queued once the owner task has stopped, so
+    # nobody waits on them
+    def _fail_commands(self):
+        while not self.commands.empty():
+            _, done = self.commands.get_nowait()
+            if not done.done():
+                done.set_exception(RuntimeError(f"Vehicle {self.id} is not running"))
+
+    def _update_view(self, location):
+        self.view = SessionView(self.session.tracking, self.session.seq, self.fixes, location, self.session.stats())
+
+    # Flip tracking on the owner task, returning the new state. Raises
+    # RuntimeError if the owner is not running and asyncio.TimeoutError if it
+    # does not answer within COMMAND_TIMEOUT.
+    async def toggle(self):
+        if self._task is None or self._task.done():
+            raise RuntimeError(f"Vehicle {self.id} is not running")
+        done = asyncio.get_running_loop().create_future()
+        await self.commands.put(('toggle', done))
+        return await asyncio.wait_for(done, COMMAND_TIMEOUT)
+
+    def publish(self, events):
+        for event, payload in events:
+            payload['vehicle'] = self.id
+        broadcaster.publish(events, self.room)
+
+    def status(self):
+        view = self.view
+        return {
+            'id': self.id,
+            'source': self.source,
+            'tracking': view.tracking,
+            'fixes': view.fixes,
+            'location': view.location,
+            'reader': self.reader.stats(),
+            'coverage': view.stats,
+        }
+
+def get_owner(request):
+    owner = owners.get(request.match_info['vehicle_id'])
+    if owner is None:
+        raise web.HTTPNotFound()
+    return owner
+
+def owner_from_event(data):
+    return owners.get((data or {}).get('vehicle'))
+
+def render(name, **context):
+    return web.Response(text=templates.get_template(name).render(**context), content_type='text/html')
+
+@sio.on('join_vehicle')
+async def handle_join_vehicle(sid, data):
+    owner = owner_from_event(data)
+    if owner is None:
+        return
+    for other in owners.values():
+        if other is not owner:
+            await sio.leave_room(sid, other.room)
+    await sio.enter_room(sid, owner.room)
+    broadcaster.add_client(sid, owner.room)
+    await sio.emit('tracking_status', {'tracking': owner.view.tracking, 'vehicle': owner.id}, to=sid)
+    await sio.emit('coverage_resync', dict(owner.session.snapshot(), vehicle=owner.id), to=sid)
+
+@sio.on('disconnect')
+async def handle_disconnect(sid, *args):
+    broadcaster.remove_client(sid)
+
+@sio.on('toggle_tracking')
+async def handle_toggle_tracking(sid, data):
+    owner = owner_from_event(data)
+    if owner is None:
+        return
+    try:
+        tracking = await owner.toggle()
+    except (RuntimeError, asyncio.TimeoutError) as e:
+        logger.warning("Vehicle %s: could not toggle tracking: %s", owner.id, e)
+        # Put the client's button back to the state the session is really in
+        await sio.emit('tracking_status', {'tracking': owner.view.tracking, 'vehicle': owner.id}, to=sid)
+        return
+    await sio.emit('tracking_status', {'tracking': tracking, 'vehicle': owner.id}, to=owner.room)
+
+@sio.on('request_resync')
+async def handle_request_resync(sid, data):
+    owner = owner_from_event(data)
+    if owner is not None:
+        await sio.emit('coverage_resync', dict(owner.session.snapshot(), vehicle=owner.id), to=sid)
+
+# The map of the only vehicle, or the fleet list when there are several
+async def index(request):
+    if len(owners) == 1:
+        owner, = owners.values()
+        raise web.HTTPFound(f'/vehicles/{owner.id}')
+    return render('fleet.html', vehicles=[owner.status() for owner in owners.values()])
+
+async def vehicle_list(request):
+    return web.json_response([owner.status() for owner in owners.values()])
+
+async def broadcast_stats(request):
+    return web.json_response(broadcaster.stats())
+
+async def metrics_page(request):
+    return web.Response(text=metrics.registry.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+# Map tiles, looked up (and fetched when missing) on the default executor so a
+# slow upstream never holds up the loop
+async def map_tile(request):
+    z, x, y = (int(request.match_info[key]) for key in ('z', 'x', 'y'))
+    data = await asyncio.get_running_loop().run_in_executor(None, tile_cache.get, z, x, y)
+    if data is None:
+        raise web.HTTPNotFound()
+    etag = hashlib.md5(data).hexdigest()
+    headers = {'Cache-Control': f'public, max-age={CACHE_MAX_AGE}', 'ETag': f'"{etag}"'}
+    if request.headers.get('If-None-Match') == f'"{etag}"':
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=data, content_type='image/png', headers=headers)
+
+async def vehicle_map(request):
+    owner = get_owner(request)
+    return render('project.html', vehicle_id=owner.id, coverage_prefix=f'/vehicles/{owner.id}/coverage')
+
+async def vehicle_coverage_tiles(request):
+    return web.json_response(get_owner(request).session.tile_index())
+
+async def vehicle_coverage_boundary(request):
+    return web.json_response(get_owner(request).session.boundary_geojson())
+
+async def vehicle_coverage_tile(request):
+    png = get_owner(request).session.render_tile_png(int(request.match_info['x']), int(request.match_info['y']))
+    if png is None:
+        raise web.HTTPNotFound()
+    return web.Response(body=png, content_type='image/png', headers={'Cache-Control': 'no-cache'})
+
+async def start_background(app):
+    for owner in owners.values():
+        owner.start()
+    broadcaster.start()
+
+async def stop_background(app):
+    broadcaster.stop()
+    for owner in owners.values():
+        owner.stop()
+    tile_cache.close()
+
+def make_app():
+    app = web.Application()
+    sio.attach(app)
+    app.router.add_get('/', index)
+    app.router.add_get('/vehicles', vehicle_list)
+    app.router.add_get('/broadcast', broadcast_stats)
+    app.router.add_get('/metrics', metrics_page)
+    app.router.add_get('/tiles/{z:\\d+}/{x:\\d+}/{y:\\d+}.png', map_tile)
+    app.router.add_get('/vehicles/{vehicle_id}', vehicle_map)
+    app.router.add_get('/vehicles/{vehicle_id}/coverage/tiles', vehicle_coverage_tiles)
+    app.router.add_get('/vehicles/{vehicle_id}/coverage/boundary', vehicle_coverage_boundary)
+    app.router.add_get('/vehicles/{vehicle_id}/coverage/tile/{x:-?\\d+}/{y:-?\\d+}.png', vehicle_coverage_tile)
+    app.router.add_static('/static', STATIC_DIR)
+    app.on_startup.append(start_background)
+    app.on_cleanup.append(stop_background)
+    return app
+
+# Vehicles are configured as for fleet.py (see fleetconfig.py), less the
+# worker pool: every vehicle's owner task shares the one event loop.
+
+def main():
+    parser = argparse.ArgumentParser(description='Track one or many implements on a single asyncio event loop.')
+    add_vehicle_arguments(parser)
+    args = parser.parse_args()
+    _, vehicle_options = load_vehicles(parser, args)
+
+    for options in vehicle_options:
+        owner = SessionOwner(options.pop('id'), options.pop('source'), **options)
+        owners[owner.id] = owner
+        print(f"Tracking {owner.id} from {owner.source}")
+
+    web.run_app(make_app(), host='0.0.0.0', port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from boundary import load_boundary
+from coverage import COVERAGE_RESOLUTION_FEET
+from createfromcsv import CHUNK_ROWS, DISTANCE_FEET, coverage_stats, prepared_chunks, write_coverage_geojson
+from filters import HeadingFilter
+from simplify import EDGE_TOLERANCE_FEET, FixDecimator
+
+LOG_EXTENSIONS = ('.csv', '.trk')
+CACHE_FILE = 'cache.json'
+HASH_BLOCK_BYTES = 1 << 20
+# Bump when the results for an unchanged log would come out differently
+RESULTS_VERSION = 2
+
+# Columns of summary.csv, after the log's path
+SUMMARY_COLUMNS = ['rows', 'suppressed', 'vertices', 'track_miles', 'covered_acres', 'overlap_acres', 'gap_acres',
+                   'seconds']
+# Swath width and cell size the acres of each log were counted with
+RASTER_COLUMNS = ['width_feet', 'resolution_feet']
+
+# SHA-256 of a file's contents
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as log_file:
+        for block in iter(lambda: log_file.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Every log under the given files and directories, skipping the output directory
+def find_logs(paths, output_dir):
+    output_dir = os.path.abspath(output_dir)
+    logs = []
+    for path in paths:
+        if os.path.isfile(path):
+            logs.append(path)
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories[:] = sorted(name for name in subdirectories
+                                       if os.path.abspath(os.path.join(directory, name)) != output_dir)
+            logs.extend(os.path.join(directory, name) for name in sorted(files)
+                        if name.lower().endswith(LOG_EXTENSIONS))
+    return logs
+
+# Boundaries loaded by this worker process, by path
+_boundaries = {}
+
+# Swath polygon and coverage for one log, run in a worker process. Writes the
+# swath GeoJSON and returns the results.
+def process_log(path, geojson_path, settings):
+    start = time.perf_counter()
+    boundary = None
+    if settings['boundary']:
+        boundary = _boundaries.get(settings['boundary'])
+        if boundary is None:
+            boundary = _boundaries[settings['boundary']] = load_boundary(settings['boundary'])
+
+    def open_chunks(heading_filter=None, decimator=None):
+        return prepared_chunks(path, CHUNK_ROWS, heading_filter if settings['filter'] else None,
+                               decimator if settings['simplify'] else None)
+
+    heading_filter = HeadingFilter()
+    decimator = FixDecimator()
+    os.makedirs(os.path.dirname(geojson_path) or '.', exist_ok=True)
+    rows, vertices = write_coverage_geojson(open_chunks(heading_filter, decimator), geojson_path, settings['width'],
+                                            CHUNK_ROWS, settings['tolerance'] if settings['simplify'] else None)
+    stats = coverage_stats(open_chunks(HeadingFilter(), FixDecimator()), settings['width'], settings['resolution'],
+                           boundary)
+    if settings['filter']:
+        rows = heading_filter.passed + heading_filter.suppressed
+    elif settings['simplify']:
+        rows = decimator.seen
+    result = {
+        'rows': rows,
+        'suppressed': heading_filter.suppressed,
+        'vertices': vertices,
+        'track_miles': stats.pop('track_feet') / 5280,
+    }
+    result.update(stats)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _write_json(path, data):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as json_file:
+        json.dump(data, json_file, indent=1)
+    os.replace(temporary, path)
+
+def load_cache(path):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+# Totals over every processed log, with per-field acres added up by field name
+def merge_results(results):
+    totals = {column: 0 for column in SUMMARY_COLUMNS}
+    fields = {}
+    for result in results.values():
+        if 'error' in result:
+            continue
+        for column in SUMMARY_COLUMNS:
+            totals[column] += result[column]
+        for field in result.get('fields', []):
+            merged = fields.setdefault(field['name'], {'name': field['name'], 'acres': field['acres'],
+                                                       'covered_acres': 0.0, 'overlap_acres': 0.0, 'sessions': 0})
+            merged['covered_acres'] += field['covered_acres']
+            merged['overlap_acres'] += field['overlap_acres']
+            merged['sessions'] += field['covered_acres'] > 0
+    totals['logs'] = sum('error' not in result for result in results.values())
+    totals['failed'] = len(results) - totals['logs']
+    if fields:
+        totals['fields'] = list(fields.values())
+    return totals
+
+def write_summary(output_dir, results, totals, settings):
+    _write_json(os.path.join(output_dir, 'summary.json'), {'settings': settings, 'totals': totals, 'logs': results})
+    columns = SUMMARY_COLUMNS + RASTER_COLUMNS
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(['log'] + columns + ['error'])
+        for name, result in sorted(results.items()):
+            writer.writerow([name] + [result.get(column, '') for column in columns] + [result.get('error', '')])
+        writer.writerow(['total'] + [totals[column] for column in SUMMARY_COLUMNS]
+                        + [settings['width'], settings['resolution'], ''])
+
+# Process a whole archive of logs. Each log's swath polygon and results are
+# written under output_dir, mirroring the archive's layout, plus a merged
+# summary (summary.json, summary.csv). Logs are keyed by a hash of their
+# contents together with the settings; a log whose key matches the cache from
+# the last run is not processed again. The cache is saved after every log, so
+# an interrupted run picks up where it stopped.
+def run_batch(paths, output_dir, settings, workers=None, force=False):
+    os.makedirs(output_dir, exist_ok=True)
+    cache_path = os.path.join(output_dir, CACHE_FILE)
+    cache = {} if force else load_cache(cache_path)
+    settings_key = json.dumps(settings, sort_keys=True)
+    roots = [os.path.abspath(path if os.path.isdir(path) else os.path.dirname(path)) for path in paths]
+    common_root = os.path.commonpath(roots) if roots else '.'
+
+    results = {}
+    pending = []
+    for path in find_logs(paths, output_dir):
+        name = os.path.relpath(os.path.abspath(path), common_root)
+        stem = os.path.join(output_dir, os.path.splitext(name)[0])
+        stat = os.stat(path)
+        entry = cache.get(name)
+        # An unchanged size and modification time means the contents are
+        # unchanged too; only the rest are hashed again
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            content_hash = entry['hash']
+        else:
+            content_hash = file_hash(path)
+        if (entry and entry['hash'] == content_hash and entry['settings'] == settings_key
+                and os.path.exists(stem + '.geojson')):
+            entry['size'] = stat.st_size
+            entry['mtime_ns'] = stat.st_mtime_ns
+            results[name] = entry['result']
+            continue
+        pending.append((stat.st_size, name, path, stem, content_hash, stat))
+
+    print(f"{len(results) + len(pending)} logs, {len(results)} unchanged, {len(pending)} to process")
+    start = time.perf_counter()
+    # Largest first, so one big log does not start last and hold up the end
+    pending.sort(key=lambda item: item[0], reverse=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_log, path, stem + '.geojson', settings): (name, stem, content_hash, stat)
+                   for size, name, path, stem, content_hash, stat in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            name, stem, content_hash, stat = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                results[name] = {'error': f"{type(e).__name__}: {e}"}
+                # Nothing half-written is left looking like a result
+                if os.path.exists(stem + '.geojson'):
+                    os.remove(stem + '.geojson')
+                print(f"[{done}/{len(pending)}] {name}: failed ({results[name]['error']})")
+                continue
+            results[name] = result
+            _write_json(stem + '.json', result)
+            cache[name] = {'hash': content_hash, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                           'settings': settings_key, 'result': result}
+            _write_json(cache_path, cache)
+            print(f"[{done}/{len(pending)}] {name}: {result['rows']} rows, {result['covered_acres']:.2f} ac covered, "
+                  f"{result['overlap_acres']:.2f} ac overlap ({result['seconds']:.1f} s)")
+    elapsed = time.perf_counter() - start
+
+    _write_json(cache_path, cache)
+    totals = merge_results(results)
+    write_summary(output_dir, results, totals, settings)
+    processed_rows = sum(results[name].get('rows', 0) for size, name, path, stem, content_hash, stat in pending)
+    return totals, elapsed, len(pending), processed_rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Build swath polygons and coverage for a directory of GPS logs.')
+    parser.add_argument('paths', nargs='+', help='Logs (.csv or .trk) or directories searched for them')
+    parser.add_argument('--output', default='batch_output', help='Directory for the results and the summary')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--width', type=float, default=DISTANCE_FEET, help='Implement width in feet')
+    parser.add_argument('--resolution', type=float, default=COVERAGE_RESOLUTION_FEET,
+                        help='Coverage cell size in feet for the acre counts')
+    parser.add_argument('--simplify', action='store_true', help='Drop redundant fixes and thin the swath edges')
+    parser.add_argument('--tolerance', type=float, default=EDGE_TOLERANCE_FEET, help='Edge simplification tolerance in feet')
+    parser.add_argument('--no-filter', action='store_true', help='Project every fix with its raw heading')
+    parser.add_argument('--boundary', help='GeoJSON or shapefile of field boundaries; acres are clipped to the fields')
+    parser.add_argument('--force', action='store_true', help='Process every log, ignoring the cache')
+    args = parser.parse_args()
+
+    settings = {
+        'version': RESULTS_VERSION,
+        'width': args.width,
+        'resolution': args.resolution,
+        'simplify': args.simplify,
+        'tolerance': args.tolerance,
+        'filter': not args.no_filter,
+        'boundary': os.path.abspath(args.boundary) if args.boundary else None,
+        # A changed boundary file changes every result
+        'boundary_hash': file_hash(args.boundary) if args.boundary else None,
+    }
+    totals, elapsed, processed, processed_rows = run_batch(args.paths, args.output, settings, args.workers, args.force)
+    rate = processed_rows / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed} logs ({processed_rows} rows) in {elapsed:.1f} s, {rate:,.0f} rows/sec; "
+          f"{totals['logs']} logs and {totals['rows']} rows in the summary, {totals['failed']} failed")
+    print(f"Covered {totals['covered_acres']:.2f} ac, overlap {totals['overlap_acres']:.2f} ac, "
+          f"skipped {totals['gap_acres']:.2f} ac over {totals['track_miles']:.1f} miles "
+          f"({args.width:g} ft swath, {args.resolution:g} ft cells)")
+    for field in totals.get('fields', []):
+        print(f"  {field['name']}: {field['covered_acres']:.2f} ac covered in {field['sessions']} sessions "
+              f"({field['acres']:.2f} ac field)")
+    print(f"Wrote {os.path.join(args.output, 'summary.json')} and summary.csv")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Heading filter micro-benchmarks. Run from the repository root:
+#     python -m benchmarks.bench_filters [fixes]
+import math
+import random
+import sys
+import time
+import numpy as np
+from filters import HeadingFilter
+from gpsparser import Fix
+
+def report(name, count, seconds):
+    print(f"{name:<28} {count / seconds:>12,.0f} fixes/sec  {seconds / count * 1e6:8.2f} us/fix")
+
+# A lawnmower pattern at 4 mph with noisy headings, a stop at the end of each
+# pass with the heading flipped, like the receiver does
+def track(count):
+    random.seed(1)
+    fixes = []
+    lat, lon, heading = 46.3, -113.3, 0.0
+    for index in range(count):
+        if index % 200 == 199:
+            fixes.append(Fix(lat, lon, 5245.0, 0.0, (heading + 180.0) % 360.0))
+            heading = (heading + 180.0) % 360.0
+            lon += 9.0 / 276000.0
+            continue
+        lat += math.cos(math.radians(heading)) * 6.0 / 364000.0
+        fixes.append(Fix(lat, lon, 5245.0, 4.0, (heading + random.gauss(0, 5)) % 360.0))
+    return fixes
+
+def run(count):
+    fixes = track(count)
+
+    heading_filter = HeadingFilter()
+    start = time.perf_counter()
+    for fix in fixes:
+        heading_filter.filter(fix)
+    report('filter() per fix', count, time.perf_counter() - start)
+    print(f"{'':<28} {heading_filter.suppressed} suppressed, {heading_filter.replaced} headings replaced")
+
+    columns = [np.array(column, dtype=np.float64) for column in zip(*fixes)]
+    heading_filter = HeadingFilter()
+    start = time.perf_counter()
+    for offset in range(0, count, 65536):
+        heading_filter.filter_chunk(*(column[offset:offset + 65536] for column in
+                                      (columns[0], columns[1], columns[3], columns[4])))
+    report('filter_chunk()', count, time.perf_counter() - start)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,72 @@
+# Parser micro-benchmarks. Run from the repository root:
+#     python -m benchmarks.bench_parser [fixes]
+import random
+import sys
+import time
+from gpsparser import FixParser, parse_block, pattern
+from gpsreader import FrameParser
+
+def text_block(lat, lon, heading):
+    return (f"Lat: {lat:.7f} Long: {lon:.7f} Alt: 5245.54 feet "
+            f"Speed: 4.20 mph Heading: {heading:.2f} degrees")
+
+def nmea(body):
+    checksum = 0
+    for char in body.encode('ascii'):
+        checksum ^= char
+    return f"${body}*{checksum:02X}"
+
+def nmea_sentences(lat, lon, heading):
+    lat_field = f"{int(lat):02d}{(lat % 1) * 60:07.4f}"
+    lon_field = f"{int(abs(lon)):03d}{(abs(lon) % 1) * 60:07.4f}"
+    return [
+        nmea(f"GPGGA,234728.00,{lat_field},N,{lon_field},W,1,09,0.9,1598.8,M,-17.2,M,,"),
+        nmea(f"GPRMC,234728.00,A,{lat_field},N,{lon_field},W,3.65,{heading:.2f},150524,,,A"),
+    ]
+
+def regex_parse(block):
+    match = pattern.match(block)
+    if match:
+        return tuple(float(value) for value in match.groups())
+    return None
+
+def report(name, count, seconds):
+    print(f"{name:<28} {count / seconds:>12,.0f} fixes/sec  {seconds / count * 1e6:8.2f} us/fix")
+
+def run(count):
+    random.seed(1)
+    fixes = [(46.3 + random.random() * 0.01, -113.3 - random.random() * 0.01, random.uniform(0, 360))
+             for _ in range(count)]
+    blocks = [text_block(*fix) for fix in fixes]
+    sentences = [sentence for fix in fixes for sentence in nmea_sentences(*fix)]
+    raw = ''.join(block.replace(' Long', '\r\nLong').replace(' Alt', '\r\nAlt')
+                  .replace(' Speed', '\r\nSpeed').replace(' Heading', '\r\nHeading') + '\r\n'
+                  for block in blocks).encode('ascii')
+
+    start = time.perf_counter()
+    for block in blocks:
+        regex_parse(block)
+    report('regex (previous)', count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for block in blocks:
+        parse_block(block)
+    report('fixed-field text', count, time.perf_counter() - start)
+
+    parser = FixParser()
+    start = time.perf_counter()
+    for sentence in sentences:
+        parser.parse(sentence)
+    report('NMEA GGA+RMC', count, time.perf_counter() - start)
+
+    framer = FrameParser()
+    parser = FixParser()
+    start = time.perf_counter()
+    parsed = 0
+    for offset in range(0, len(raw), 4096):
+        for frame in framer.feed(raw[offset:offset + 4096]):
+            parsed += parser.parse(frame) is not None
+    report('bytes -> frames -> fixes', parsed, time.perf_counter() - start)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,95 @@
+# Live pipeline benchmark: a synthetic session replayed through framing,
+# parsing, the coverage session and emit. Reports throughput, per-stage
+# latency percentiles, how the per-fix cost changes as the session grows and
+# memory growth. Run from the repository root:
+#     python -m benchmarks.bench_pipeline [--fixes 100000] [--socketio | --broadcast]
+import argparse
+import time
+import tracemalloc
+from replay import STAGES, RecordingSink, StageTimer, run_pipeline, synthetic_track
+
+WINDOW = 10000  # Fixes per growth window
+
+# Emit through a real Flask-SocketIO server to an in-process test client
+def socketio_emit():
+    import projection
+    client = projection.socketio.test_client(projection.app)
+
+    def emit(event, payload):
+        projection.socketio.emit(event, payload)
+
+    # The test client queues everything it receives; empty it as we go
+    return emit, client.get_received
+
+# Publish through the broadcaster instead; frames go out when the test client
+# is drained, every 1000 fixes
+def broadcast_emit():
+    import projection
+    client = projection.socketio.test_client(projection.app)
+    sid = next(iter(projection.broadcaster.clients))
+
+    def emit(event, payload):
+        projection.broadcaster.publish([(event, payload)])
+
+    def drain():
+        projection.broadcaster.flush()
+        projection.broadcaster._ack(sid)  # The test client does not acknowledge
+        client.get_received()
+    return emit, drain
+
+def run(fixes, use_socketio, use_broadcast=False):
+    if use_socketio:
+        emit, drain = socketio_emit()
+    elif use_broadcast:
+        emit, drain = broadcast_emit()
+    else:
+        sink = RecordingSink()
+        emit, drain = sink.emit, lambda: None
+
+    timer = StageTimer()
+    start = time.perf_counter()
+    session = run_pipeline(synthetic_track(fixes), emit=emit, timer=timer,
+                           checkpoint=lambda index: drain(), checkpoint_every=1000)
+    elapsed = time.perf_counter() - start
+
+    print(f"{fixes} fixes in {elapsed:.2f} s: {fixes / elapsed:,.0f} fixes/sec")
+    print("Stage latency (us):")
+    for stage in STAGES:
+        p = timer.percentiles(stage)
+        print(f"  {stage:<8} p50 {p[50]:8.1f}  p95 {p[95]:8.1f}  p99 {p[99]:8.1f}  max {p[100]:9.1f}")
+
+    # A per-fix cost that grows with the session shows up as rising window medians
+    print(f"Per-fix total by window of {WINDOW} fixes (us, p50 / p99):")
+    totals = [sum(values) for values in zip(*(timer.samples[stage] for stage in STAGES))]
+    for offset in range(0, len(totals), WINDOW):
+        window = sorted(totals[offset:offset + WINDOW])
+        print(f"  {offset:>7}-{offset + len(window):<7} {window[len(window) // 2] / 1000:8.1f} / "
+              f"{window[int(len(window) * 0.99)] / 1000:8.1f}")
+    print(f"Coverage: {session.stats()}")
+
+def run_memory(fixes):
+    print(f"Traced memory by window of {WINDOW} fixes:")
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    def checkpoint(index):
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"  {index:>7} fixes: {(current - baseline) / 1e6:8.2f} MB (peak {(peak - baseline) / 1e6:.2f} MB)")
+
+    run_pipeline(synthetic_track(fixes), checkpoint=checkpoint, checkpoint_every=WINDOW)
+    tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the live pipeline on a synthetic session.')
+    parser.add_argument('--fixes', type=int, default=100000)
+    parser.add_argument('--socketio', action='store_true', help='Emit through Flask-SocketIO to a test client')
+    parser.add_argument('--broadcast', action='store_true', help='Publish through the frame broadcaster to a test client')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced memory run')
+    args = parser.parse_args()
+
+    run(args.fixes, args.socketio, args.broadcast)
+    if not args.no_memory:
+        run_memory(args.fixes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import json
+import numpy as np
+from coverage import SQUARE_FEET_PER_ACRE, TILE_CELLS
+from geodesy import LocalProjection
+
+# Feature properties tried, in order, for a field's name
+NAME_PROPERTIES = ('name', 'Name', 'NAME', 'field', 'Field', 'FIELD')
+
+def _field_name(properties, index):
+    for key in NAME_PROPERTIES:
+        if properties and properties.get(key) not in (None, ''):
+            return str(properties[key])
+    return f"Field {index + 1}"
+
+# Polygons of a GeoJSON geometry, each a list of rings as (lat, lon) arrays:
+# the outline first, then any holes
+def _geometry_polygons(geometry):
+    if not geometry:
+        return []
+    kind = geometry.get('type')
+    if kind == 'GeometryCollection':
+        return [polygon for part in geometry['geometries'] for polygon in _geometry_polygons(part)]
+    if kind == 'Polygon':
+        coordinates = [geometry['coordinates']]
+    elif kind == 'MultiPolygon':
+        coordinates = geometry['coordinates']
+    else:
+        return []
+    polygons = []
+    for polygon in coordinates:
+        rings = [np.asarray(ring, dtype=np.float64)[:, 1::-1].copy() for ring in polygon if len(ring) >= 3]
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+def _read_geojson(path):
+    with open(path) as boundary_file:
+        data = json.load(boundary_file)
+    if data.get('type') == 'FeatureCollection':
+        features = data['features']
+    elif data.get('type') == 'Feature':
+        features = [data]
+    else:
+        features = [{'properties': {}, 'geometry': data}]
+    fields = []
+    for feature in features:
+        polygons = _geometry_polygons(feature.get('geometry'))
+        if polygons:
+            fields.append((_field_name(feature.get('properties'), len(fields)), polygons))
+    return fields
+
+# Shapefiles are read with pyshp when it is installed. Coordinates must be
+# WGS84 longitude/latitude, as for GeoJSON; nothing is reprojected.
+def _read_shapefile(path):
+    try:
+        import shapefile
+    except ImportError:
+        raise ImportError("Reading shapefiles needs pyshp (pip install pyshp); "
+                          "or save the boundary as GeoJSON") from None
+    fields = []
+    with shapefile.Reader(path) as reader:
+        for shape_record in reader.iterShapeRecords():
+            polygons = _geometry_polygons(shape_record.shape.__geo_interface__)
+            if polygons:
+                fields.append((_field_name(shape_record.record.as_dict(), len(fields)), polygons))
+    return fields
+
+# Load field boundaries from a GeoJSON file (Polygon, MultiPolygon, Feature or
+# FeatureCollection) or a shapefile. Each polygon feature is one field, named
+# from its properties.
+def load_boundary(path):
+    if path.lower().endswith(('.shp', '.zip')):
+        fields = _read_shapefile(path)
+    else:
+        fields = _read_geojson(path)
+    if not fields:
+        raise ValueError(f"No polygons found in {path}")
+    return FieldBoundary(fields)
+
+# Signed area of a ring in square feet (shoelace)
+def _ring_area(x, y):
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+# One or more named fields, each a list of polygons with holes, in lat/lon
+class FieldBoundary:
+    def __init__(self, fields):
+        self.names = [name for name, polygons in fields]
+        self.polygons = [polygons for name, polygons in fields]
+        points = np.concatenate([ring for polygons in self.polygons for polygon in polygons for ring in polygon])
+        south, west = points.min(axis=0)
+        north, east = points.max(axis=0)
+        self.bounds = (float(south), float(west), float(north), float(east))
+        self.centroid = ((south + north) / 2, (west + east) / 2)
+        self.acres = self._acres()
+
+    def _acres(self):
+        projection = LocalProjection(*self.centroid)
+        acres = []
+        for polygons in self.polygons:
+            square_feet = 0.0
+            for polygon in polygons:
+                areas = [abs(_ring_area(*projection.to_xy(ring[:, 0], ring[:, 1]))) for ring in polygon]
+                square_feet += areas[0] - sum(areas[1:])
+            acres.append(square_feet / SQUARE_FEET_PER_ACRE)
+        return acres
+
+    def to_geojson(self):
+        return {'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature',
+            'properties': {'name': name, 'acres': acres},
+            'geometry': {'type': 'MultiPolygon', 'coordinates': [
+                [ring[:, ::-1].tolist() for ring in polygon] for polygon in polygons]},
+        } for name, polygons, acres in zip(self.names, self.polygons, self.acres)]}
+
+    # The boundary in the cells of a coverage grid
+    def prepare(self, projection, resolution_feet):
+        return PreparedBoundary(self, projection, resolution_feet)
+
+# A FieldBoundary rasterised to the cells of one CoverageGrid, one tile at a
+# time. The edges are projected once and listed under each band of tile rows
+# they cross. labels() fills in a tile of field labels (0 outside, 1 + field
+# index inside) with an even-odd scanline over that band's edges only, and
+# keeps it. Clipping a painted cell is then an array lookup, however many
+# vertices the boundary has; only rasterising a new tile depends on the
+# number of edges in its band.
+class PreparedBoundary:
+    def __init__(self, boundary, projection, resolution_feet):
+        self.boundary = boundary
+        self.projection = projection
+        self.resolution_feet = resolution_feet
+        self.fields = len(boundary.names)
+        self.dtype = np.uint8 if self.fields < 255 else np.uint16
+        edges = []
+        for field, polygons in enumerate(boundary.polygons):
+            for polygon in polygons:
+                for ring in polygon:
+                    x, y = projection.to_xy(ring[:, 0], ring[:, 1])
+                    x = x / resolution_feet
+                    y = y / resolution_feet
+                    # Rings may or may not repeat their first point; the closing
+                    # edge is then empty and dropped with the horizontal ones
+                    ring_edges = np.column_stack((x, y, np.roll(x, -1), np.roll(y, -1), np.full(len(x), field)))
+                    edges.append(ring_edges[ring_edges[:, 1] != ring_edges[:, 3]])
+        edges = np.concatenate(edges)
+        low = np.floor(np.minimum(edges[:, 1], edges[:, 3]) / TILE_CELLS).astype(int)
+        high = np.floor(np.maximum(edges[:, 1], edges[:, 3]) / TILE_CELLS).astype(int)
+        self._bands = {}
+        for band in range(int(low.min()), int(high.max()) + 1):
+            selected = edges[(low <= band) & (high >= band)]
+            if len(selected):
+                self._bands[band] = selected
+        self._tiles = {}
+        self._outside = np.zeros((TILE_CELLS, TILE_CELLS), dtype=self.dtype)
+        self._outside.flags.writeable = False
+
+    # Field labels of a tile's cells, indexed [row, column] like CoverageTile
+    def labels(self, key):
+        labels = self._tiles.get(key)
+        if labels is None:
+            labels = self._tiles[key] = self._rasterise(*key)
+        return labels
+
+    def _rasterise(self, tx, ty):
+        edges = self._bands.get(ty)
+        if edges is None:
+            return self._outside
+        x0, y0, x1, y1, field = edges.T
+        centers_x = tx * TILE_CELLS + np.arange(TILE_CELLS) + 0.5
+        centers_y = (ty * TILE_CELLS + np.arange(TILE_CELLS) + 0.5)[:, None]
+        # Where each edge crosses each row of cell centres, with the same
+        # half-open rule as the coverage painter
+        crosses = (y0 > centers_y) != (y1 > centers_y)
+        x_at = x0 + (centers_y - y0) * (x1 - x0) / (y1 - y0)
+        if not (crosses & (x_at > centers_x[0])).any():
+            return self._outside
+
+        labels = np.zeros((TILE_CELLS, TILE_CELLS), dtype=self.dtype)
+        for index in np.unique(field).astype(int).tolist():
+            of_field = field == index
+            for row in range(TILE_CELLS):
+                crossings = np.sort(x_at[row, crosses[row] & of_field])
+                if not len(crossings):
+                    continue
+                # Inside where an odd number of crossings lie to the right
+                right = len(crossings) - np.searchsorted(crossings, centers_x, side='right')
+                labels[row, (right & 1) == 1] = index + 1
+        return labels
+
+    # The edge bands and tiles are rebuilt when a snapshot is loaded rather
+    # than stored in it
+    def __getstate__(self):
+        return {'boundary': self.boundary, 'projection': self.projection, 'resolution_feet': self.resolution_feet}
+
+    def __setstate__(self, state):
+        self.__init__(state['boundary'], state['projection'], state['resolution_feet'])
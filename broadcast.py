@@ -0,0 +1,252 @@
+import time
+from functools import partial
+from threading import Lock
+import numpy as np
+import metrics
+
+FRAME_RATE = 10.0  # Frames sent to each client per second
+MAX_PENDING_FRAMES = 3  # Unacknowledged frames a client may have before frames are dropped for it
+ACK_TIMEOUT = 5.0  # Seconds without an acknowledgement before a client's queue is written off
+
+EMIT_SECONDS = metrics.stage_histogram('emit')
+FLUSH_SECONDS = metrics.histogram('polytrack_broadcast_flush_seconds', 'Time to send one round of frames')
+
+# Pack (lat, lon) points as little-endian float64 pairs. Clients read them
+# with new Float64Array(buffer); this is a third the size of a JSON list of
+# tuples and needs no parsing.
+def pack_points(points):
+    return np.asarray(points, dtype='<f8').reshape(-1, 2).tobytes()
+
+# Events merged into one frame per room between sends
+class _Frame:
+    def __init__(self):
+        self.events = {}
+        self.published = 0
+
+    def add(self, event, payload):
+        self.published += 1
+        if event == 'coverage_delta':
+            delta = self.events.get(event)
+            if delta is None:
+                delta = self.events[event] = {'first_seq': None, 'seq': payload['seq'], 'left': [], 'right': []}
+            # Batched vertices run from first_seq to seq; a batch with no
+            # vertices only moves the tips
+            if payload['left'] or payload['right']:
+                if delta['first_seq'] is None:
+                    delta['first_seq'] = payload['seq']
+                delta['left'].extend(payload['left'])
+                delta['right'].extend(payload['right'])
+            delta['seq'] = payload['seq']
+            delta['left_tip'] = payload['left_tip']
+            delta['right_tip'] = payload['right_tip']
+        elif event == 'coverage_tiles':
+            tiles = self.events.get(event)
+            if tiles is None:
+                tiles = self.events[event] = {'tiles': {}}
+            for tile in payload['tiles']:
+                tiles['tiles'][(tile['x'], tile['y'])] = tile
+            tiles['stats'] = payload['stats']
+        else:
+            # Everything else is state; only the newest value matters
+            self.events[event] = payload
+
+    # Take over the state and tiles of a frame a client missed. Its coverage
+    # delta is left out: the client sees the seq gap and resyncs the edges.
+    def carry(self, other):
+        for event, payload in other.events.items():
+            if event == 'coverage_delta':
+                continue
+            if event == 'coverage_tiles':
+                tiles = self.events.get(event)
+                if tiles is None:
+                    tiles = self.events[event] = {'tiles': {}}
+                tiles['tiles'].update(payload['tiles'])
+                tiles['stats'] = payload['stats']
+            else:
+                self.events[event] = payload
+
+    # The events to send, with the edges packed. Leaves the frame as it was.
+    def payload(self):
+        events = dict(self.events)
+        if 'coverage_delta' in events:
+            delta = events['coverage_delta'] = dict(events['coverage_delta'])
+            delta['left'] = pack_points(delta['left'])
+            delta['right'] = pack_points(delta['right'])
+        if 'coverage_tiles' in events:
+            tiles = events['coverage_tiles']
+            events['coverage_tiles'] = dict(tiles, tiles=list(tiles['tiles'].values()))
+        return events
+
+class _Client:
+    def __init__(self, sid, room):
+        self.sid = sid
+        self.room = room
+        self.pending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.last_ack = time.monotonic()
+        # State and tiles of the frames skipped for it, sent with its next frame
+        self.backlog = None
+
+# Decouples ingest from the clients. The serial (or vehicle) thread publishes
+# the session's events, which only merges them into the pending frame of
+# their room. A background task sends each room's frame to its clients
+# FRAME_RATE times a second as a single 'frame' event: location and other
+# state coalesced to the newest value, coverage deltas batched with their
+# vertices packed as binary, tiles merged by position. Each client
+# acknowledges its frames. A client with MAX_PENDING_FRAMES unacknowledged is
+# skipped and the frame counts as dropped for it. The state and tiles of a
+# skipped frame are kept for that client and merged into the next frame it is
+# sent. Its coverage deltas are not kept: the next delta it gets has a
+# sequence gap, so it asks for a resync of the edges.
+class Broadcaster:
+    def __init__(self, socketio, frame_rate=FRAME_RATE, max_pending=MAX_PENDING_FRAMES, ack_timeout=ACK_TIMEOUT):
+        self.socketio = socketio
+        self.interval = 1.0 / frame_rate
+        self.max_pending = max_pending
+        self.ack_timeout = ack_timeout
+        self.lock = Lock()
+        self.frames = {}
+        self.clients = {}
+        self.published = 0
+        self.sent_frames = 0
+        self.frames_dropped = 0  # Including clients that have since disconnected
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.socketio.start_background_task(self._run)
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            self.socketio.sleep(self.interval)
+            self.flush()
+
+    # Queue events for the clients in room (None for every client)
+    def publish(self, events, room=None):
+        if not events:
+            return
+        start = metrics.now()
+        with self.lock:
+            frame = self.frames.get(room)
+            if frame is None:
+                frame = self.frames[room] = _Frame()
+            for event, payload in events:
+                frame.add(event, payload)
+        EMIT_SECONDS.observe_since(start)
+
+    def add_client(self, sid, room=None):
+        with self.lock:
+            self.clients[sid] = _Client(sid, room)
+
+    def remove_client(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+
+    def _ack(self, sid, *args):
+        with self.lock:
+            client = self.clients.get(sid)
+            if client is not None and client.pending:
+                client.pending -= 1
+                client.last_ack = time.monotonic()
+
+    # Send every pending frame to the clients of its room
+    def flush(self):
+        start = metrics.now()
+        sends = self._take_sends()
+        for sid, payload in sends:
+            self.socketio.emit('frame', payload, to=sid, callback=partial(self._ack, sid))
+        if sends:
+            FLUSH_SECONDS.observe_since(start)
+
+    # Take the pending frames, returning the (sid, payload) pairs to send
+    def _take_sends(self):
+        now = time.monotonic()
+        sends = []
+        with self.lock:
+            frames = self.frames
+            self.frames = {}
+            for room, frame in frames.items():
+                self.published += frame.published
+                payload = frame.payload()
+                for client in self.clients.values():
+                    if room is not None and client.room != room:
+                        continue
+                    if not self._ready(client, now):
+                        client.dropped += 1
+                        self.frames_dropped += 1
+                        if client.backlog is None:
+                            client.backlog = _Frame()
+                        client.backlog.carry(frame)
+                        continue
+                    if client.backlog is not None:
+                        # What it missed, brought up to date by this frame
+                        client.backlog.carry(frame)
+                        client_payload = client.backlog.payload()
+                        if 'coverage_delta' in payload:
+                            client_payload['coverage_delta'] = payload['coverage_delta']
+                        client.backlog = None
+                        self._send(client, client_payload, now, sends)
+                    else:
+                        self._send(client, payload, now, sends)
+            # Clients that caught up with nothing new for their room still get
+            # what they missed
+            for client in self.clients.values():
+                if client.backlog is not None and self._ready(client, now):
+                    self._send(client, client.backlog.payload(), now, sends)
+                    client.backlog = None
+            self.sent_frames += len(sends)
+        return sends
+
+    # Whether a client can take another frame. Call with the lock held.
+    def _ready(self, client, now):
+        if client.pending and now - client.last_ack > self.ack_timeout:
+            # Acks are not coming back (old page, dead link); start over
+            client.pending = 0
+            client.timeouts += 1
+        return client.pending < self.max_pending
+
+    def _send(self, client, payload, now, sends):
+        client.pending += 1
+        if client.pending == 1:
+            client.last_ack = now
+        client.sent += 1
+        sends.append((client.sid, payload))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'frame_rate': 1.0 / self.interval,
+                'published_events': self.published,
+                'sent_frames': self.sent_frames,
+                'frames_dropped': self.frames_dropped,
+                'clients': [{
+                    'sid': client.sid,
+                    'room': client.room,
+                    'queue_depth': client.pending,
+                    'sent': client.sent,
+                    'dropped': client.dropped,
+                    'timeouts': client.timeouts,
+                } for client in self.clients.values()],
+            }
+
+# Broadcaster for a socketio.AsyncServer. Publishing is the same; the send
+# loop is a task on the event loop and each emit is awaited.
+class AsyncBroadcaster(Broadcaster):
+    async def _run(self):
+        while self._running:
+            await self.socketio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        start = metrics.now()
+        sends = self._take_sends()
+        for sid, payload in sends:
+            await self.socketio.emit('frame', payload, to=sid, callback=partial(self._ack, sid))
+        if sends:
+            FLUSH_SECONDS.observe_since(start)
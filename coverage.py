@@ -0,0 +1,312 @@
+import copy
+import math
+import struct
+import zlib
+import numpy as np
+from geodesy import LocalProjection
+
+TILE_CELLS = 256  # Cells along each side of a tile
+SQUARE_FEET_PER_ACRE = 43560.0
+
+# Raster configuration shared by the live session and the offline tools, so a
+# log gives the same acres whichever way it is processed
+COVERAGE_RESOLUTION_FEET = 0.5  # Size of a coverage cell
+COVERAGE_MAX_GAP_FEET = 3.0  # Uncovered strips up to this wide count as skipped ground
+MAX_STEP_WIDTHS = 4  # A jump between fixes of more than this many implement widths starts a new strip
+
+# Tile colours (RGBA) for ground covered once, covered more than once and skipped
+SINGLE_PASS_COLOR = (30, 100, 255, 140)
+OVERLAP_COLOR = (255, 60, 40, 170)
+GAP_COLOR = (255, 200, 0, 200)
+
+# One square of the grid. Arrays are indexed [row, column] = [y, x], y north.
+class CoverageTile:
+    __slots__ = ('passes', 'last_segment', 'gap', 'version')
+
+    def __init__(self):
+        self.passes = np.zeros((TILE_CELLS, TILE_CELLS), dtype=np.uint16)
+        self.last_segment = np.zeros((TILE_CELLS, TILE_CELLS), dtype=np.uint32)
+        self.gap = np.zeros((TILE_CELLS, TILE_CELLS), dtype=bool)
+        self.version = 0
+
+    def copy(self):
+        tile = CoverageTile.__new__(CoverageTile)
+        tile.passes = self.passes.copy()
+        tile.last_segment = self.last_segment.copy()
+        tile.gap = self.gap.copy()
+        tile.version = self.version
+        return tile
+
+# Even-odd point in polygon test for a grid of points against a small polygon
+def _points_in_polygon(px, py, xs, ys):
+    inside = np.zeros(np.broadcast(px, py).shape, dtype=bool)
+    count = len(xs)
+    for i in range(count):
+        ax, ay = xs[i], ys[i]
+        bx, by = xs[i - 1], ys[i - 1]
+        if ay == by:
+            continue
+        crosses = (ay > py) != (by > py)
+        x_at = ax + (py - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (px < x_at)
+    return inside
+
+# Minimal PNG encoder for an RGBA image
+def _encode_png(rgba):
+    height, width = rgba.shape[:2]
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+# Sparse tiled raster of covered ground. Each swath segment, the quad between
+# two consecutive rear left/right pairs, is painted into the cells whose centres
+# it contains. Only the tiles under that segment are touched, so the cost per
+# fix depends on the segment size and not on how long the session has run.
+#
+# Overlap is ground painted by more than one pass. A skipped gap is an
+# uncovered cell with covered ground on both sides (left and right, or above and
+# below) within max_gap_feet.
+#
+# With a field boundary (boundary.FieldBoundary) only cells inside a field are
+# painted, so the tiles and every count are clipped to the fence line, and
+# covered and overlap acres are also kept per field.
+class CoverageGrid:
+    # Grids restored from snapshots taken before boundaries existed have none
+    boundary = None
+    field = None
+
+    def __init__(self, resolution_feet=COVERAGE_RESOLUTION_FEET, max_gap_feet=COVERAGE_MAX_GAP_FEET, origin=None,
+                 boundary=None):
+        self.resolution_feet = resolution_feet
+        self.gap_reach = max(1, int(math.ceil(max_gap_feet / resolution_feet)))
+        self.projection = LocalProjection(*origin) if origin is not None else None
+        self.boundary = boundary
+        self.field = None
+        if boundary is not None:
+            if self.projection is None:
+                self.projection = LocalProjection(*boundary.centroid)
+            self.field = boundary.prepare(self.projection, resolution_feet)
+            # Indexed by field label; 0 (outside every field) stays empty
+            self.field_covered_cells = np.zeros(len(boundary.names) + 1, dtype=np.int64)
+            self.field_overlap_cells = np.zeros(len(boundary.names) + 1, dtype=np.int64)
+        self.tiles = {}
+        self.dirty_tiles = set()
+        self._frozen_tiles = {}  # Tile copies made by the last snapshot_copy
+        self.segments = 0
+        self._segment_id = 0  # Id of the last segment painted; a strip break skips one
+        self.covered_cells = 0
+        self.overlap_cells = 0
+        self.gap_cells = 0
+        self._previous_edge = None
+
+    # Add the next rear (left, right) pair as (lat, lon) tuples, painting the
+    # segment back to the previous pair
+    def add_edge(self, left, right):
+        if self.projection is None:
+            self.projection = LocalProjection((left[0] + right[0]) / 2, (left[1] + right[1]) / 2)
+        left_x, left_y = self.projection.to_xy(left[0], left[1])
+        right_x, right_y = self.projection.to_xy(right[0], right[1])
+        edge = (left_x / self.resolution_feet, left_y / self.resolution_feet,
+                right_x / self.resolution_feet, right_y / self.resolution_feet)
+        if self._previous_edge is not None:
+            previous = self._previous_edge
+            self._paint_quad((previous[0], previous[2], edge[2], edge[0]),
+                             (previous[1], previous[3], edge[3], edge[1]))
+        self._previous_edge = edge
+
+    # Start a new strip, e.g. when tracking is paused, so the next pair is not
+    # joined to the last one. The skipped id keeps the first segment of the new
+    # strip from counting as the same pass as the last one of the old.
+    def break_strip(self):
+        self._previous_edge = None
+        self._segment_id += 1
+
+    # Yield (tile key, window rows, window cols, tile rows, tile cols) for the
+    # tiles under the cell window [x0, x1) x [y0, y1)
+    def _tile_spans(self, x0, y0, x1, y1):
+        for ty in range(y0 // TILE_CELLS, (y1 - 1) // TILE_CELLS + 1):
+            row0 = max(y0, ty * TILE_CELLS)
+            row1 = min(y1, (ty + 1) * TILE_CELLS)
+            for tx in range(x0 // TILE_CELLS, (x1 - 1) // TILE_CELLS + 1):
+                col0 = max(x0, tx * TILE_CELLS)
+                col1 = min(x1, (tx + 1) * TILE_CELLS)
+                yield ((tx, ty),
+                       slice(row0 - y0, row1 - y0), slice(col0 - x0, col1 - x0),
+                       slice(row0 - ty * TILE_CELLS, row1 - ty * TILE_CELLS),
+                       slice(col0 - tx * TILE_CELLS, col1 - tx * TILE_CELLS))
+
+    def _tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = CoverageTile()
+        return tile
+
+    def _mark_dirty(self, key, tile):
+        tile.version += 1
+        self.dirty_tiles.add(key)
+
+    def _paint_quad(self, xs, ys):
+        x0 = int(math.floor(min(xs)))
+        x1 = int(math.ceil(max(xs)))
+        y0 = int(math.floor(min(ys)))
+        y1 = int(math.ceil(max(ys)))
+        if x1 <= x0 or y1 <= y0:
+            return
+        self.segments += 1
+        self._segment_id += 1
+        segment = self._segment_id
+
+        centers_x = np.arange(x0, x1) + 0.5
+        centers_y = (np.arange(y0, y1) + 0.5)[:, None]
+        inside = _points_in_polygon(centers_x, centers_y, xs, ys)
+        if not inside.any():
+            return
+
+        for key, win_rows, win_cols, tile_rows, tile_cols in self._tile_spans(x0, y0, x1, y1):
+            mask = inside[win_rows, win_cols]
+            if self.field is not None:
+                labels = self.field.labels(key)[tile_rows, tile_cols]
+                mask = mask & (labels > 0)
+            if not mask.any():
+                continue
+            tile = self._tile(key)
+            passes = tile.passes[tile_rows, tile_cols]
+            last_segment = tile.last_segment[tile_rows, tile_cols]
+
+            # The previous segment shares an edge with this one, cells it painted
+            # are part of the same pass
+            new_pass = mask & (last_segment + 1 < segment)
+            first = new_pass & (passes == 0)
+            second = new_pass & (passes == 1)
+            self.covered_cells += int(np.count_nonzero(first))
+            self.overlap_cells += int(np.count_nonzero(second))
+            if self.field is not None:
+                self.field_covered_cells += np.bincount(labels[first], minlength=len(self.field_covered_cells))
+                self.field_overlap_cells += np.bincount(labels[second], minlength=len(self.field_overlap_cells))
+            passes[new_pass] = np.minimum(passes[new_pass], np.iinfo(np.uint16).max - 1) + 1
+            last_segment[mask] = segment
+            self._mark_dirty(key, tile)
+
+        self._update_gaps(x0, y0, x1, y1)
+
+    # Covered cells in a window, as a dense boolean array
+    def _covered_window(self, x0, y0, x1, y1):
+        covered = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for key, win_rows, win_cols, tile_rows, tile_cols in self._tile_spans(x0, y0, x1, y1):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                covered[win_rows, win_cols] = tile.passes[tile_rows, tile_cols] > 0
+        return covered
+
+    # Recompute the gap flags of cells near a freshly painted window
+    def _update_gaps(self, x0, y0, x1, y1):
+        reach = self.gap_reach
+        covered = self._covered_window(x0 - 2 * reach, y0 - 2 * reach, x1 + 2 * reach, y1 + 2 * reach)
+        height = y1 - y0 + 2 * reach
+        width = x1 - x0 + 2 * reach
+
+        def shifted(dx, dy):
+            return covered[reach + dy:reach + dy + height, reach + dx:reach + dx + width]
+
+        left = np.zeros((height, width), dtype=bool)
+        right = np.zeros_like(left)
+        below = np.zeros_like(left)
+        above = np.zeros_like(left)
+        for step in range(1, reach + 1):
+            left |= shifted(-step, 0)
+            right |= shifted(step, 0)
+            below |= shifted(0, -step)
+            above |= shifted(0, step)
+        gap = ~shifted(0, 0) & ((left & right) | (below & above))
+
+        for key, win_rows, win_cols, tile_rows, tile_cols in self._tile_spans(x0 - reach, y0 - reach, x1 + reach, y1 + reach):
+            window_gap = gap[win_rows, win_cols]
+            if self.field is not None:
+                # Ground outside the fields is never a skip
+                window_gap = window_gap & (self.field.labels(key)[tile_rows, tile_cols] > 0)
+            tile = self.tiles.get(key)
+            if tile is None:
+                if not window_gap.any():
+                    continue
+                tile = self._tile(key)
+            old_gap = tile.gap[tile_rows, tile_cols]
+            changed = int(np.count_nonzero(window_gap)) - int(np.count_nonzero(old_gap))
+            if changed or (window_gap != old_gap).any():
+                tile.gap[tile_rows, tile_cols] = window_gap
+                self.gap_cells += changed
+                self._mark_dirty(key, tile)
+
+    def stats(self):
+        cell_acres = self.resolution_feet * self.resolution_feet / SQUARE_FEET_PER_ACRE
+        stats = {
+            'covered_acres': self.covered_cells * cell_acres,
+            'overlap_acres': self.overlap_cells * cell_acres,
+            'gap_acres': self.gap_cells * cell_acres,
+            'segments': self.segments,
+            'tiles': len(self.tiles),
+            'resolution_feet': self.resolution_feet,
+        }
+        if self.boundary is not None:
+            stats['fields'] = [{
+                'name': name,
+                'acres': acres,
+                'covered_acres': int(covered) * cell_acres,
+                'overlap_acres': int(overlap) * cell_acres,
+            } for name, acres, covered, overlap in zip(self.boundary.names, self.boundary.acres,
+                                                      self.field_covered_cells[1:], self.field_overlap_cells[1:])]
+        return stats
+
+    # A copy of the grid that can be pickled while painting goes on. The tile
+    # arrays are the only state painted in place, so they are what gets copied,
+    # and only for tiles painted since the previous copy; the others share the
+    # arrays copied then. That costs one spare copy of each tile in memory.
+    def snapshot_copy(self):
+        frozen = {}
+        for key, tile in self.tiles.items():
+            previous = self._frozen_tiles.get(key)
+            frozen[key] = previous if previous is not None and previous.version == tile.version else tile.copy()
+        self._frozen_tiles = frozen
+        grid = copy.copy(self)
+        grid.tiles = dict(frozen)
+        grid.dirty_tiles = set(self.dirty_tiles)
+        grid._frozen_tiles = {}
+        if self.boundary is not None:
+            grid.field_covered_cells = self.field_covered_cells.copy()
+            grid.field_overlap_cells = self.field_overlap_cells.copy()
+        return grid
+
+    # Tiles changed since the last call, as (tile x, tile y, version)
+    def take_dirty_tiles(self):
+        dirty = [(key[0], key[1], self.tiles[key].version) for key in sorted(self.dirty_tiles)]
+        self.dirty_tiles.clear()
+        return dirty
+
+    # [[south, west], [north, east]] of a tile, for a Leaflet image overlay
+    def tile_bounds(self, tx, ty):
+        size = TILE_CELLS * self.resolution_feet
+        south, west = self.projection.to_latlon(tx * size, ty * size)
+        north, east = self.projection.to_latlon((tx + 1) * size, (ty + 1) * size)
+        return [[float(south), float(west)], [float(north), float(east)]]
+
+    def tile_index(self):
+        return [{'x': key[0], 'y': key[1], 'version': tile.version, 'bounds': self.tile_bounds(*key)}
+                for key, tile in sorted(self.tiles.items())]
+
+    # PNG image of a tile, or None if nothing has been painted there
+    def render_tile_png(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            return None
+        rgba = np.zeros((TILE_CELLS, TILE_CELLS, 4), dtype=np.uint8)
+        rgba[tile.passes == 1] = SINGLE_PASS_COLOR
+        rgba[tile.passes > 1] = OVERLAP_COLOR
+        rgba[tile.gap] = GAP_COLOR
+        # Image rows run north to south
+        return _encode_png(rgba[::-1])
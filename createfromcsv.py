@@ -1,95 +1,349 @@
-import csv
-import math
+import argparse
+import json
+import os
+import tempfile
+import time
+from string import Template
 import folium
+import numpy as np
+from boundary import load_boundary
+from coverage import COVERAGE_RESOLUTION_FEET, MAX_STEP_WIDTHS, CoverageGrid
+from filters import HeadingFilter
+from geodesy import swath_points
+from simplify import EDGE_TOLERANCE_FEET, FixDecimator, simplify_latlon
+from trackstore import read_log_chunks
 
-# Constants
-EARTH_RADIUS_FEET = 20925646.325  # Earth radius in feet
-FEET_TO_METERS = 0.3048  # Conversion factor from feet to meters
-
-def calculate_new_gps_position(lat, lon, heading, distance_feet):
-    # Convert distance to meters
-    distance_meters = (distance_feet / 2) * FEET_TO_METERS  # Use half the distance for each side
-    
-    # Convert latitude and longitude from degrees to radians
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
-    
-    # Convert heading to radians
-    heading_rad = math.radians(heading)
-    
-    # Calculate the left and right angles in radians
-    left_angle_rad = heading_rad - math.pi / 2
-    right_angle_rad = heading_rad + math.pi / 2
-    
-    # Calculate the new latitude and longitude for the left position
-    left_lat_rad = math.asin(math.sin(lat_rad) * math.cos(distance_meters / EARTH_RADIUS_FEET) +
-                             math.cos(lat_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(left_angle_rad))
-    left_lon_rad = lon_rad + math.atan2(math.sin(left_angle_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(lat_rad),
-                                        math.cos(distance_meters / EARTH_RADIUS_FEET) - math.sin(lat_rad) * math.sin(left_lat_rad))
-    
-    # Calculate the new latitude and longitude for the right position
-    right_lat_rad = math.asin(math.sin(lat_rad) * math.cos(distance_meters / EARTH_RADIUS_FEET) +
-                              math.cos(lat_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(right_angle_rad))
-    right_lon_rad = lon_rad + math.atan2(math.sin(right_angle_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(lat_rad),
-                                         math.cos(distance_meters / EARTH_RADIUS_FEET) - math.sin(lat_rad) * math.sin(right_lat_rad))
-    
-    # Convert the new latitude and longitude from radians to degrees
-    left_lat = math.degrees(left_lat_rad)
-    left_lon = math.degrees(left_lon_rad)
-    right_lat = math.degrees(right_lat_rad)
-    right_lon = math.degrees(right_lon_rad)
-    
-    return (left_lat, left_lon), (right_lat, right_lon)
-
-# Initialize arrays to hold the left, center, and right positions
-left_positions = []
-center_positions = []
-right_positions = []
-
-# Read the CSV file
-with open('gps_data.csv', 'r') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        lat = float(row['Latitude'])
-        lon = float(row['Longitude'])
-        heading = float(row['Heading (degrees)'])
-        distance_feet = 30  # Distance in feet
-        
-        left_position, right_position = calculate_new_gps_position(lat, lon, heading, distance_feet)
-        
-        # Append the positions to their respective arrays
-        left_positions.append(left_position)
-        center_positions.append((lat, lon))
-        right_positions.append(right_position)
-
-# Create an array that is the reverse of the right array
-reverse_right_positions = list(reversed(right_positions))
-
-# Add the first value of the left array to the end of the reversed right array
-if left_positions:
-    reverse_right_positions.append(left_positions[0])
-
-# Create a new array that combines the left array with the reversed right array
-combined_positions = left_positions + reverse_right_positions
-
-# Create a folium map centered at the first position in the center positions array
-if center_positions:
-    m = folium.Map(location=[center_positions[0][0], center_positions[0][1]], zoom_start=20)
-    
-    # Add markers for each position
-    for left_pos, center_pos, right_pos in zip(left_positions, center_positions, right_positions):
-        folium.Marker([center_pos[0], center_pos[1]], popup='Center Position', icon=folium.Icon(color='blue')).add_to(m)
-        folium.Marker([left_pos[0], left_pos[1]], popup='Left Position', icon=folium.Icon(color='green')).add_to(m)
-        folium.Marker([right_pos[0], right_pos[1]], popup='Right Position', icon=folium.Icon(color='red')).add_to(m)
-    
-    # Add the polygon to the map
-    folium.Polygon(locations=combined_positions, color='blue', fill=True, fill_opacity=0.5).add_to(m)
-    
-    # Save the map to an HTML file and display it
-    m.save('./map.html')
-
-print("Left positions:", left_positions)
-print("Center positions:", center_positions)
-print("Right positions:", right_positions)
-print("Reversed right positions:", reverse_right_positions)
-print("Combined positions:", combined_positions)
+DISTANCE_FEET = 30  # Distance in feet
+CHUNK_ROWS = 65536  # Rows read and projected at a time
+
+# Static map export: the track and swath edges are stored once per level of
+# detail as encoded polylines. Each level is simplified to its tolerance and the
+# page shows the coarsest level whose tolerance is under a pixel at the current
+# zoom.
+LOD_TOLERANCES_FEET = (0.25, 2.0, 16.0, 128.0)
+POLYLINE_PRECISION = 7  # Decimal places kept in encoded polylines (about 1 cm)
+
+# Acres covered, overlapped and skipped are counted on a coverage raster at
+# coverage.COVERAGE_RESOLUTION_FEET, the same cells as the live session
+EXPORT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'export.html')
+# The pinned Leaflet the servers use (see tilecache.VENDOR_ASSETS), inlined into exports
+LEAFLET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'vendor', 'leaflet')
+
+# Drop stopped fixes and smooth the heading, chunk by chunk
+def filter_chunks(chunks, heading_filter):
+    for chunk in chunks:
+        keep, headings = heading_filter.filter_chunk(chunk['lat'], chunk['lon'], chunk['speed'], chunk['heading'])
+        kept = chunk[keep]
+        if len(kept):
+            kept['heading'] = headings
+            yield kept
+
+# Drop fixes that add nothing to the swath, chunk by chunk
+def decimate_chunks(chunks, decimator):
+    for chunk in chunks:
+        kept = chunk[decimator.filter_chunk(chunk['lat'], chunk['lon'], chunk['heading'])]
+        if len(kept):
+            yield kept
+
+# A log as chunks, through the heading filter and the decimator when given
+def prepared_chunks(path, chunk_rows=CHUNK_ROWS, heading_filter=None, decimator=None):
+    chunks = read_log_chunks(path, chunk_rows)
+    if heading_filter is not None:
+        chunks = filter_chunks(chunks, heading_filter)
+    if decimator is not None:
+        chunks = decimate_chunks(chunks, decimator)
+    return chunks
+
+# Write (lon, lat) rows as GeoJSON positions, returning the separator for the next write
+def _write_coordinates(out, coordinates, separator):
+    if len(coordinates):
+        position_format = ', '.join(['[%.9f, %.9f]'] * len(coordinates))
+        out.write(separator + position_format % tuple(coordinates.ravel().tolist()))
+        separator = ', '
+    return separator
+
+# Stream the swath polygon (left edge, reversed right edge, back to the start)
+# to a GeoJSON file. The left edge is written as each chunk is projected and the
+# right edge is spilled to a temporary file and read back in reverse, so memory
+# stays at one chunk whatever the log size. With tolerance_feet set each chunk's
+# edges are simplified (Douglas-Peucker) before they are written. Returns the
+# number of rows processed and of edge vertices written.
+def write_coverage_geojson(chunks, output_path, distance_feet=DISTANCE_FEET, chunk_rows=CHUNK_ROWS, tolerance_feet=None):
+    rows = 0
+    vertices = 0
+    first_left = None
+    separator = ''
+    with open(output_path, 'w') as out, tempfile.TemporaryFile() as right_spill:
+        out.write('{"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [[')
+        for chunk in chunks:
+            points = swath_points(chunk['lat'], chunk['lon'], chunk['heading'], distance_feet)
+            left_lat, left_lon = points.left_lat, points.left_lon
+            right_lat, right_lon = points.right_lat, points.right_lon
+            if tolerance_feet is not None:
+                left_lat, left_lon = simplify_latlon(left_lat, left_lon, tolerance_feet)
+                right_lat, right_lon = simplify_latlon(right_lat, right_lon, tolerance_feet)
+            left = np.column_stack((left_lon, left_lat))
+            right = np.column_stack((right_lon, right_lat))
+            if first_left is None and len(left):
+                first_left = left[:1].copy()
+            separator = _write_coordinates(out, left, separator)
+            right_spill.write(right.tobytes())
+            rows += len(chunk)
+            vertices += len(left) + len(right)
+
+        # Read the right edge back from the end, one chunk at a time
+        block_bytes = chunk_rows * 2 * 8
+        position = right_spill.seek(0, 2)
+        while position > 0:
+            start = max(0, position - block_bytes)
+            right_spill.seek(start)
+            right = np.frombuffer(right_spill.read(position - start), dtype=np.float64).reshape(-1, 2)
+            separator = _write_coordinates(out, right[::-1], separator)
+            position = start
+
+        # Close the ring on the first left position
+        if first_left is not None:
+            _write_coordinates(out, first_left, separator)
+        out.write(']]}}\n')
+    return rows, vertices
+
+# Paint the swath into a coverage raster and return its stats: covered,
+# overlap and skipped acres, clipped to the field boundaries and per field if
+# a boundary is given. A jump between fixes (a receiver dropout, or a second
+# session in the same log) starts a new strip instead of painting across the
+# field. The stats also give the distance driven, jumps left out, and the
+# swath width the acres were painted with.
+def coverage_stats(chunks, distance_feet=DISTANCE_FEET, resolution_feet=COVERAGE_RESOLUTION_FEET, boundary=None):
+    grid = None
+    max_step = MAX_STEP_WIDTHS * distance_feet
+    track_feet = 0.0
+    previous = None
+    for chunk in chunks:
+        if grid is None:
+            # Without a boundary the raster is centred on the first fix
+            origin = None if boundary is not None else (float(chunk['lat'][0]), float(chunk['lon'][0]))
+            grid = CoverageGrid(resolution_feet=resolution_feet, origin=origin, boundary=boundary)
+        points = swath_points(chunk['lat'], chunk['lon'], chunk['heading'], distance_feet)
+        x, y = grid.projection.to_xy(chunk['lat'], chunk['lon'])
+        if previous is not None:
+            x = np.concatenate(([previous[0]], x))
+            y = np.concatenate(([previous[1]], y))
+        steps = np.hypot(np.diff(x), np.diff(y))
+        jumps = steps > max_step
+        track_feet += float(steps[~jumps].sum())
+        if previous is None:
+            jumps = np.concatenate(([False], jumps))
+        previous = (x[-1], y[-1])
+        for jump, left_lat, left_lon, right_lat, right_lon in zip(
+                jumps.tolist(), points.left_lat.tolist(), points.left_lon.tolist(),
+                points.right_lat.tolist(), points.right_lon.tolist()):
+            if jump:
+                grid.break_strip()
+            grid.add_edge((left_lat, left_lon), (right_lat, right_lon))
+    if grid is None:
+        grid = CoverageGrid(resolution_feet=resolution_feet, boundary=boundary)
+    stats = grid.stats()
+    stats['track_feet'] = track_feet
+    stats['width_feet'] = distance_feet
+    return stats
+
+# Encode points with the polyline algorithm (zigzag deltas in 5-bit groups) at
+# POLYLINE_PRECISION. previous is the last integer point of the text this
+# continues, so a line can be encoded a chunk at a time. Returns the text and
+# the last point.
+def encode_polyline(lats, lons, previous=(0, 0), precision=POLYLINE_PRECISION):
+    if len(lats) == 0:
+        return '', previous
+    scale = 10 ** precision
+    points = np.empty((len(lats), 2), dtype=np.int64)
+    points[:, 0] = np.round(np.asarray(lats, dtype=np.float64) * scale)
+    points[:, 1] = np.round(np.asarray(lons, dtype=np.float64) * scale)
+    deltas = np.diff(points, axis=0, prepend=np.array([previous], dtype=np.int64)).ravel()
+    values = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+
+    # Groups per value, then every group with the continuation bit on all but the last
+    groups = np.ones(len(values), dtype=np.int64)
+    for shift in range(5, 64, 5):
+        groups += values >= np.uint64(1 << shift)
+    width = int(groups.max())
+    shifts = np.arange(0, 5 * width, 5, dtype=np.uint64)
+    chars = ((values[:, None] >> shifts) & np.uint64(31)).astype(np.uint8) + 63
+    position = np.arange(width)
+    chars[position < (groups - 1)[:, None]] += 32
+    text = chars[position < groups[:, None]].tobytes().decode('ascii')
+    return text, (int(points[-1, 0]), int(points[-1, 1]))
+
+# Encoded polylines of one line at every level of detail, built a chunk at a time
+class _LevelLines:
+    def __init__(self, tolerances):
+        self.tolerances = tolerances
+        self.parts = [[] for _ in tolerances]
+        self.previous = [(0, 0)] * len(tolerances)
+        self.counts = [0] * len(tolerances)
+
+    def add(self, lats, lons):
+        for level, tolerance in enumerate(self.tolerances):
+            kept_lats, kept_lons = simplify_latlon(lats, lons, tolerance)
+            text, self.previous[level] = encode_polyline(kept_lats, kept_lons, self.previous[level])
+            self.parts[level].append(text)
+            self.counts[level] += len(kept_lats)
+
+    def encoded(self):
+        return [''.join(parts) for parts in self.parts]
+
+# Write a self-contained Leaflet page with the track and swath as encoded
+# polylines, one set per level of detail (LOD_TOLERANCES_FEET), drawn on a
+# canvas renderer. With points the recorded positions are also drawn as canvas
+# circles from the level on screen. Leaflet itself is inlined from
+# LEAFLET_DIR, so the page is one file that only needs the map tiles from the
+# network. Only the encoded text is kept in memory,
+# so export time and page size grow with the simplified track rather than the
+# row count. Returns the number of rows and the vertices per level.
+def write_map_html(chunks, map_path='./map.html', distance_feet=DISTANCE_FEET, points=False,
+                   tolerances=LOD_TOLERANCES_FEET, template_path=EXPORT_TEMPLATE):
+    track = _LevelLines(tolerances)
+    left = _LevelLines(tolerances)
+    right = _LevelLines(tolerances)
+    rows = 0
+    center = None
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        if center is None:
+            center = [float(chunk['lat'][0]), float(chunk['lon'][0])]
+        swath = swath_points(chunk['lat'], chunk['lon'], chunk['heading'], distance_feet)
+        track.add(chunk['lat'], chunk['lon'])
+        left.add(swath.left_lat, swath.left_lon)
+        right.add(swath.right_lat, swath.right_lon)
+        rows += len(chunk)
+
+    levels = [{'tolerance_feet': tolerance, 'track': track_line, 'left': left_line, 'right': right_line}
+              for tolerance, track_line, left_line, right_line
+              in zip(tolerances, track.encoded(), left.encoded(), right.encoded())]
+    data = {
+        'center': center or [0.0, 0.0],
+        'precision': POLYLINE_PRECISION,
+        'points': points,
+        'levels': levels,
+    }
+    with open(template_path) as template_file:
+        template = Template(template_file.read())
+    with open(os.path.join(LEAFLET_DIR, 'leaflet.css'), encoding='utf-8') as css_file:
+        leaflet_css = css_file.read()
+    with open(os.path.join(LEAFLET_DIR, 'leaflet.js'), encoding='utf-8') as js_file:
+        leaflet_js = js_file.read()
+    with open(map_path, 'w', encoding='utf-8') as out:
+        # No whitespace and no "</" so the data can sit in a script element
+        out.write(template.substitute(data=json.dumps(data, separators=(',', ':')).replace('</', '<\\/'),
+                                      leaflet_css=leaflet_css, leaflet_js=leaflet_js))
+    vertices = [a + b + c for a, b, c in zip(track.counts, left.counts, right.counts)]
+    return rows, vertices
+
+# Build map.html with a marker for every position. This keeps the whole log in
+# memory; skip it with --no-map for logs too large for that.
+def save_marker_map(chunks, distance_feet=DISTANCE_FEET, map_path='./map.html'):
+    left_positions = []
+    center_positions = []
+    right_positions = []
+    for chunk in chunks:
+        points = swath_points(chunk['lat'], chunk['lon'], chunk['heading'], distance_feet)
+        left_positions.extend(zip(points.left_lat.tolist(), points.left_lon.tolist()))
+        center_positions.extend(zip(chunk['lat'].tolist(), chunk['lon'].tolist()))
+        right_positions.extend(zip(points.right_lat.tolist(), points.right_lon.tolist()))
+
+    # Create an array that is the reverse of the right array
+    reverse_right_positions = list(reversed(right_positions))
+
+    # Add the first value of the left array to the end of the reversed right array
+    if left_positions:
+        reverse_right_positions.append(left_positions[0])
+
+    # Create a new array that combines the left array with the reversed right array
+    combined_positions = left_positions + reverse_right_positions
+
+    # Create a folium map centered at the first position in the center positions array
+    if center_positions:
+        m = folium.Map(location=[center_positions[0][0], center_positions[0][1]], zoom_start=20)
+
+        # Add markers for each position
+        for left_pos, center_pos, right_pos in zip(left_positions, center_positions, right_positions):
+            folium.Marker([center_pos[0], center_pos[1]], popup='Center Position', icon=folium.Icon(color='blue')).add_to(m)
+            folium.Marker([left_pos[0], left_pos[1]], popup='Left Position', icon=folium.Icon(color='green')).add_to(m)
+            folium.Marker([right_pos[0], right_pos[1]], popup='Right Position', icon=folium.Icon(color='red')).add_to(m)
+
+        # Add the polygon to the map
+        folium.Polygon(locations=combined_positions, color='blue', fill=True, fill_opacity=0.5).add_to(m)
+
+        # Save the map to an HTML file
+        m.save(map_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the swath polygon for a recorded GPS log.')
+    parser.add_argument('input', nargs='?', default='gps_data.csv', help='GPS log to read (.csv or .trk track file)')
+    parser.add_argument('--output', default='coverage.geojson', help='GeoJSON file for the swath polygon')
+    parser.add_argument('--width', type=float, default=DISTANCE_FEET, help='Implement width in feet')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='Rows processed per chunk')
+    parser.add_argument('--simplify', action='store_true', help='Drop redundant fixes and thin the swath edges')
+    parser.add_argument('--tolerance', type=float, default=EDGE_TOLERANCE_FEET, help='Edge simplification tolerance in feet')
+    parser.add_argument('--no-filter', action='store_true', help='Project every fix with its raw heading')
+    parser.add_argument('--boundary', help='GeoJSON or shapefile of field boundaries; report in-field acres per field')
+    parser.add_argument('--export', metavar='HTML', help='Also write a lightweight map page with the track and swath')
+    parser.add_argument('--points', action='store_true', help='Draw the recorded positions on the exported map')
+    parser.add_argument('--no-map', action='store_true',
+                        help='Skip map.html, the marker per position map that loads the whole log into memory')
+    args = parser.parse_args()
+
+    # The log as chunks, filtered the same way for every output
+    def open_chunks(heading_filter=None, decimator=None):
+        return prepared_chunks(args.input, args.chunk_rows,
+                               None if args.no_filter else heading_filter or HeadingFilter(),
+                               decimator or FixDecimator() if args.simplify else None)
+
+    start = time.perf_counter()
+    heading_filter = HeadingFilter()
+    decimator = FixDecimator()
+    rows, vertices = write_coverage_geojson(open_chunks(heading_filter, decimator), args.output, args.width,
+                                            args.chunk_rows, args.tolerance if args.simplify else None)
+    elapsed = time.perf_counter() - start
+    if not args.no_filter:
+        rows = heading_filter.passed + heading_filter.suppressed
+    elif args.simplify:
+        rows = decimator.seen
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {rows} rows in {elapsed:.2f} s ({rate:,.0f} rows/sec), wrote {args.output}")
+    if not args.no_filter:
+        print(f"Suppressed {heading_filter.suppressed} fixes below {heading_filter.min_speed_mph} mph, "
+              f"replaced {heading_filter.replaced} headings with the course over ground")
+    if args.simplify:
+        edge_vertices = 2 * decimator.seen
+        reduction = 1 - vertices / edge_vertices if edge_vertices else 0.0
+        print(f"Kept {decimator.kept} of {decimator.seen} fixes and {vertices} of {edge_vertices} edge vertices "
+              f"({reduction:.1%} vertex reduction)")
+
+    if args.boundary:
+        start = time.perf_counter()
+        boundary = load_boundary(args.boundary)
+        stats = coverage_stats(open_chunks(), args.width, boundary=boundary)
+        elapsed = time.perf_counter() - start
+        print(f"In-field coverage of a {stats['width_feet']:g} ft swath ({elapsed:.2f} s): "
+              f"{stats['covered_acres']:.2f} ac covered, "
+              f"{stats['overlap_acres']:.2f} ac overlap, {stats['gap_acres']:.2f} ac skipped")
+        for field in stats['fields']:
+            share = field['covered_acres'] / field['acres'] if field['acres'] else 0.0
+            print(f"  {field['name']}: {field['covered_acres']:.2f} of {field['acres']:.2f} ac ({share:.1%}), "
+                  f"{field['overlap_acres']:.2f} ac overlap")
+
+    if args.export:
+        start = time.perf_counter()
+        rows, vertices = write_map_html(open_chunks(), args.export, args.width, args.points)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(args.export)
+        print(f"Wrote {args.export} ({size / 1024:,.0f} KiB) in {elapsed:.2f} s; "
+              f"vertices per level: {', '.join(str(count) for count in vertices)}")
+
+    if not args.no_map:
+        save_marker_map(open_chunks(), args.width)
+        print("Wrote map.html")
+
+if __name__ == '__main__':
+    main()
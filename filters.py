@@ -0,0 +1,110 @@
+import math
+import numpy as np
+from geodesy import LocalProjection
+
+MIN_SPEED_MPH = 0.5  # Slower fixes are not projected; the receiver's heading means nothing when stopped
+HEADING_GAIN = 0.5  # Share of each heading residual taken into the estimate
+TURN_RATE_GAIN = 0.1  # Share of each heading residual taken into the turn rate
+COURSE_MIN_FEET = 3.0  # Travel needed before a course from positions is trusted
+MAX_COURSE_DISAGREEMENT = 90.0  # A heading further than this from the course is replaced by the course
+
+# Angle difference folded into [-180, 180)
+def _wrap(angle):
+    return (angle + 180.0) % 360.0 - 180.0
+
+# Cleans up fixes before anything is projected from their heading. Keeps O(1)
+# state and works one fix at a time (live) or a chunk of arrays at a time
+# (offline), like FixDecimator.
+#
+# Fixes below min_speed_mph are suppressed. Receivers report a stale or
+# flipped heading when stopped (356 to 176 degrees at 0 mph in gps_data.csv),
+# and projecting it swings the swath across the road.
+#
+# The course over ground is worked out from successive positions once the
+# implement has moved course_min_feet. A reported heading that disagrees with
+# it by more than max_course_disagreement is replaced by it.
+#
+# Headings are then smoothed with an alpha-beta tracker, a steady-state Kalman
+# filter on heading and turn rate per fix. It follows a steady turn without
+# the lag of a plain moving average. A heading more than
+# max_course_disagreement from the prediction restarts the tracker instead of
+# being averaged in.
+class HeadingFilter:
+    def __init__(self, min_speed_mph=MIN_SPEED_MPH, heading_gain=HEADING_GAIN, turn_rate_gain=TURN_RATE_GAIN,
+                 course_min_feet=COURSE_MIN_FEET, max_course_disagreement=MAX_COURSE_DISAGREEMENT):
+        self.min_speed_mph = min_speed_mph
+        self.heading_gain = heading_gain
+        self.turn_rate_gain = turn_rate_gain
+        self.course_min_feet = course_min_feet
+        self.max_course_disagreement = max_course_disagreement
+        self.passed = 0
+        self.suppressed = 0
+        self.replaced = 0
+        self._projection = None
+        self.reset()
+
+    # Forget the heading, turn rate and course, e.g. when tracking starts
+    def reset(self):
+        self._heading = None
+        self._rate = 0.0
+        self._anchor = None
+        self._course = None
+
+    # The fix with its heading smoothed, or None if it should not be projected
+    def filter(self, fix):
+        heading = self.smooth(fix.lat, fix.lon, fix.speed, fix.heading)
+        if heading is None:
+            return None
+        return fix._replace(heading=heading)
+
+    def smooth(self, lat, lon, speed, heading):
+        if speed < self.min_speed_mph:
+            self.suppressed += 1
+            # Whatever turn was under way ended when the implement stopped, and
+            # it may pull away in another direction
+            self._rate = 0.0
+            self._anchor = None
+            self._course = None
+            return None
+
+        course = self._update_course(lat, lon)
+        if course is not None and abs(_wrap(heading - course)) > self.max_course_disagreement:
+            heading = course
+            self.replaced += 1
+
+        predicted = None
+        if self._heading is not None:
+            predicted = self._heading + self._rate
+            residual = _wrap(heading - predicted)
+        if predicted is None or abs(residual) > self.max_course_disagreement:
+            # First fix, or a jump no implement turns in one fix: start over from it
+            self._heading = heading % 360.0
+            self._rate = 0.0
+        else:
+            self._heading = (predicted + self.heading_gain * residual) % 360.0
+            self._rate += self.turn_rate_gain * residual
+        self.passed += 1
+        return self._heading
+
+    def _update_course(self, lat, lon):
+        if self._projection is None:
+            self._projection = LocalProjection(lat, lon)
+        x, y = self._projection.to_xy(lat, lon)
+        if self._anchor is None:
+            self._anchor = (float(x), float(y))
+            return None
+        dx = x - self._anchor[0]
+        dy = y - self._anchor[1]
+        if math.hypot(dx, dy) >= self.course_min_feet:
+            self._anchor = (float(x), float(y))
+            self._course = math.degrees(math.atan2(dx, dy)) % 360.0
+        return self._course
+
+    # Filter a chunk of arrays, returning the mask of fixes to keep and the
+    # smoothed headings of the kept fixes
+    def filter_chunk(self, lats, lons, speeds, headings):
+        smooth = self.smooth
+        smoothed = [smooth(lat, lon, speed, heading) for lat, lon, speed, heading
+                    in zip(lats.tolist(), lons.tolist(), speeds.tolist(), headings.tolist())]
+        keep = np.fromiter((heading is not None for heading in smoothed), dtype=bool, count=len(smoothed))
+        return keep, np.array([heading for heading in smoothed if heading is not None], dtype=np.float64)
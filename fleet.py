@@ -0,0 +1,214 @@
+import argparse
+import logging
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from flask import Flask, Response, abort, jsonify, render_template, request
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import metrics
+from broadcast import Broadcaster
+from fleetconfig import add_vehicle_arguments, load_vehicles
+from gpsparser import FixParser
+from gpsreader import open_source
+from journal import SessionJournal
+from session import DISTANCE_FEET, CoverageSession
+from tilecache import TileCache, tile_response
+
+WORKERS = 8  # Threads shared by all vehicle pipelines
+BATCH_FRAMES = 64  # Frames a vehicle processes before giving its worker back
+
+logger = logging.getLogger(__name__)
+
+# Flask app setup
+app = Flask(__name__)
+socketio = SocketIO(app)
+broadcaster = Broadcaster(socketio)
+metrics.register_broadcaster(broadcaster)
+
+# Map tiles shared by every vehicle's page
+tile_cache = TileCache()
+metrics.register_tile_cache(tile_cache)
+
+# Tracked vehicles by id
+vehicles = {}
+
+# One tracked implement: its GPS source, parser, coverage session and SocketIO
+# room. Frames are processed on the shared worker pool, one batch per vehicle
+# at a time, so each vehicle's fixes stay in order without a thread of its own.
+class Vehicle:
+    def __init__(self, vehicle_id, source, pool, width_feet=DISTANCE_FEET, state_dir=None, boundary=None,
+                 **source_options):
+        self.id = vehicle_id
+        self.source = source
+        self.room = f"vehicle:{vehicle_id}"
+        self.pool = pool
+        self.parser = FixParser()
+        self.session = CoverageSession(width_feet=width_feet, boundary=boundary)
+        self.journal = None
+        if state_dir is not None:
+            # Each vehicle keeps its own journal so sessions resume independently
+            self.journal = SessionJournal(os.path.join(state_dir, vehicle_id))
+            self.journal.attach(self.session)
+        self.reader = open_source(source, notify=self._schedule, **source_options)
+        self.fixes = 0
+        metrics.register_reader(self.reader, vehicle=vehicle_id)
+        metrics.register_parser(self.parser, vehicle=vehicle_id)
+        metrics.register_session(self.session, vehicle=vehicle_id)
+        self._lock = Lock()
+        self._scheduled = False
+
+    def start(self):
+        self.reader.start()
+
+    # Called by the reader thread after each frame
+    def _schedule(self):
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.pool.submit(self._drain)
+
+    def _drain(self):
+        frames = self.reader.frames
+        for _ in range(BATCH_FRAMES):
+            try:
+                frame = frames.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    # A frame queued after get_nowait failed is picked up here,
+                    # otherwise the next frame schedules a new batch
+                    if frames.empty():
+                        self._scheduled = False
+                        return
+                continue
+            try:
+                fix = self.parser.parse(frame)
+                if fix:
+                    self.fixes += 1
+                    self.publish(self.session.process_fix(fix))
+            except Exception:
+                logger.exception("Vehicle %s: failed to process frame %r", self.id, frame)
+        # Let other vehicles have the worker, then carry on
+        self.pool.submit(self._drain)
+
+    def publish(self, events):
+        for event, payload in events:
+            payload['vehicle'] = self.id
+        broadcaster.publish(events, self.room)
+
+    def status(self):
+        return {
+            'id': self.id,
+            'source': self.source,
+            'tracking': self.session.tracking,
+            'fixes': self.fixes,
+            'reader': self.reader.stats(),
+            'coverage': self.session.stats(),
+        }
+
+def get_vehicle(vehicle_id):
+    vehicle = vehicles.get(vehicle_id)
+    if vehicle is None:
+        abort(404)
+    return vehicle
+
+def vehicle_from_event(data):
+    return vehicles.get((data or {}).get('vehicle'))
+
+@socketio.on('join_vehicle')
+def handle_join_vehicle(data):
+    vehicle = vehicle_from_event(data)
+    if vehicle is None:
+        return
+    for other in vehicles.values():
+        if other is not vehicle:
+            leave_room(other.room)
+    join_room(vehicle.room)
+    broadcaster.add_client(request.sid, vehicle.room)
+    emit('tracking_status', {'tracking': vehicle.session.tracking, 'vehicle': vehicle.id})
+    emit('coverage_resync', dict(vehicle.session.snapshot(), vehicle=vehicle.id))
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    broadcaster.remove_client(request.sid)
+
+@socketio.on('toggle_tracking')
+def handle_toggle_tracking(data):
+    vehicle = vehicle_from_event(data)
+    if vehicle is None:
+        return
+    tracking, events = vehicle.session.toggle_tracking()
+    socketio.emit('tracking_status', {'tracking': tracking, 'vehicle': vehicle.id}, to=vehicle.room)
+    vehicle.publish(events)
+
+@socketio.on('request_resync')
+def handle_request_resync(data):
+    vehicle = vehicle_from_event(data)
+    if vehicle is not None:
+        emit('coverage_resync', dict(vehicle.session.snapshot(), vehicle=vehicle.id))
+
+@app.route('/')
+def fleet():
+    return render_template('fleet.html', vehicles=[vehicle.status() for vehicle in vehicles.values()])
+
+@app.route('/vehicles')
+def vehicle_list():
+    return jsonify([vehicle.status() for vehicle in vehicles.values()])
+
+@app.route('/broadcast')
+def broadcast_stats():
+    return jsonify(broadcaster.stats())
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def map_tile(z, x, y):
+    return tile_response(tile_cache, z, x, y)
+
+@app.route('/vehicles/<vehicle_id>')
+def vehicle_map(vehicle_id):
+    vehicle = get_vehicle(vehicle_id)
+    return render_template('project.html', vehicle_id=vehicle.id,
+                           coverage_prefix=f'/vehicles/{vehicle.id}/coverage')
+
+@app.route('/vehicles/<vehicle_id>/coverage/tiles')
+def vehicle_coverage_tiles(vehicle_id):
+    return jsonify(get_vehicle(vehicle_id).session.tile_index())
+
+@app.route('/vehicles/<vehicle_id>/coverage/boundary')
+def vehicle_coverage_boundary(vehicle_id):
+    return jsonify(get_vehicle(vehicle_id).session.boundary_geojson())
+
+@app.route('/vehicles/<vehicle_id>/coverage/tile/<int(signed=True):x>/<int(signed=True):y>.png')
+def vehicle_coverage_tile(vehicle_id, x, y):
+    png = get_vehicle(vehicle_id).session.render_tile_png(x, y)
+    if png is None:
+        abort(404)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'no-cache'})
+
+# Vehicles are configured as described in fleetconfig.py
+def main():
+    parser = argparse.ArgumentParser(description='Track many implements from one server.')
+    add_vehicle_arguments(parser)
+    parser.add_argument('--workers', type=int, help=f'Worker threads for the vehicle pipelines (default {WORKERS})')
+    args = parser.parse_args()
+    config, vehicle_options = load_vehicles(parser, args)
+
+    pool = ThreadPoolExecutor(max_workers=args.workers or config.get('workers', WORKERS),
+                              thread_name_prefix='vehicle')
+    for options in vehicle_options:
+        vehicle = Vehicle(options.pop('id'), options.pop('source'), pool, **options)
+        vehicles[vehicle.id] = vehicle
+        vehicle.start()
+        print(f"Tracking {vehicle.id} from {vehicle.source}")
+
+    broadcaster.start()
+
+    # Start the Flask app
+    socketio.run(app, host='0.0.0.0', port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import json
+from boundary import load_boundary
+
+# Vehicles from a JSON config, shared by fleet.py and asyncserver.py:
+#     {"workers": 8,
+#      "vehicles": [{"id": "tractor1", "source": "serial:/dev/cu.AGAIGPS@115200", "width_feet": 30},
+#                   {"id": "sprayer", "source": "tcp:192.168.1.20:9000"},
+#                   {"id": "demo", "source": "replay:gps_data.csv", "speed": 1.0, "loop": true}]}
+# Keys other than id, source, width_feet and boundary are passed to the reader.
+# With "state_dir" set at the top level each vehicle's session is journaled
+# under state_dir/<id> and restored on restart. "boundary" (top level or per
+# vehicle) is a GeoJSON or shapefile of field boundaries to clip coverage to.
+# Each file is loaded once however many vehicles use it. "workers" is only
+# used by fleet.py.
+def load_config(path):
+    with open(path) as config_file:
+        return json.load(config_file)
+
+# The command line options both servers take for their vehicles
+def add_vehicle_arguments(parser):
+    parser.add_argument('config', nargs='?', help='JSON file listing the vehicles')
+    parser.add_argument('--vehicle', action='append', default=[], metavar='ID=SOURCE',
+                        help='Add a vehicle, e.g. tractor1=serial:/dev/cu.AGAIGPS or demo=replay:gps_data.csv')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--state-dir', help='Journal each vehicle session here and restore it on restart')
+    parser.add_argument('--boundary', help='GeoJSON or shapefile of field boundaries for every vehicle')
+
+# The config file and the options of each vehicle from the parsed arguments.
+# Every vehicle's options include id, source and state_dir, and boundary as a
+# loaded FieldBoundary if it has one.
+def load_vehicles(parser, args):
+    config = load_config(args.config) if args.config else {}
+    entries = list(config.get('vehicles', []))
+    for spec in args.vehicle:
+        vehicle_id, _, source = spec.partition('=')
+        entries.append({'id': vehicle_id, 'source': source})
+    if not entries:
+        parser.error('no vehicles configured')
+
+    boundaries = {}
+    vehicles = []
+    for entry in entries:
+        options = dict(entry)
+        options.setdefault('state_dir', args.state_dir or config.get('state_dir'))
+        boundary_path = options.get('boundary', args.boundary or config.get('boundary'))
+        if boundary_path:
+            if boundary_path not in boundaries:
+                boundaries[boundary_path] = load_boundary(boundary_path)
+            options['boundary'] = boundaries[boundary_path]
+        vehicles.append(options)
+    return config, vehicles
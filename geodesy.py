@@ -0,0 +1,85 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Constants
+EARTH_RADIUS_FEET = 20925646.325  # Earth radius in feet
+
+# Left/right swath edge points and the point projected ahead of the implement.
+# Every field is an array with one entry per input fix.
+SwathPoints = namedtuple('SwathPoints', [
+    'left_lat', 'left_lon',
+    'right_lat', 'right_lon',
+    'front_lat', 'front_lon',
+])
+
+# Move every point the given angular distance along a bearing. The sines and
+# cosines of the start latitude and of the distance are passed in so callers
+# projecting several bearings from the same fixes only compute them once.
+def _destination(lat_rad, lon_rad, sin_lat, cos_lat, sin_bearing, cos_bearing, sin_dist, cos_dist):
+    new_lat_rad = np.arcsin(sin_lat * cos_dist + cos_lat * sin_dist * cos_bearing)
+    new_lon_rad = lon_rad + np.arctan2(sin_bearing * sin_dist * cos_lat,
+                                       cos_dist - sin_lat * np.sin(new_lat_rad))
+    return np.degrees(new_lat_rad), np.degrees(new_lon_rad)
+
+# Batched swath geometry for arrays of fixes. lat, lon and heading are in
+# degrees, width_feet is the full implement width (scalar or array). The side
+# points are half the width to either side, so the edges are width_feet
+# apart, and the front point is width_feet ahead.
+def swath_points(lat, lon, heading, width_feet):
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    lon_rad = np.radians(np.asarray(lon, dtype=np.float64))
+    heading_rad = np.radians(np.asarray(heading, dtype=np.float64))
+    width_feet = np.asarray(width_feet, dtype=np.float64)
+
+    sin_lat = np.sin(lat_rad)
+    cos_lat = np.cos(lat_rad)
+    sin_heading = np.sin(heading_rad)
+    cos_heading = np.cos(heading_rad)
+
+    # Side offsets are half the width on each side
+    side_dist = (width_feet / 2) / EARTH_RADIUS_FEET
+    sin_side = np.sin(side_dist)
+    cos_side = np.cos(side_dist)
+
+    # heading - 90 degrees: sin = -cos(heading), cos = sin(heading)
+    left_lat, left_lon = _destination(lat_rad, lon_rad, sin_lat, cos_lat,
+                                      -cos_heading, sin_heading, sin_side, cos_side)
+    # heading + 90 degrees: sin = cos(heading), cos = -sin(heading)
+    right_lat, right_lon = _destination(lat_rad, lon_rad, sin_lat, cos_lat,
+                                        cos_heading, -sin_heading, sin_side, cos_side)
+
+    front_dist = width_feet / EARTH_RADIUS_FEET
+    front_lat, front_lon = _destination(lat_rad, lon_rad, sin_lat, cos_lat,
+                                        sin_heading, cos_heading, np.sin(front_dist), np.cos(front_dist))
+
+    return SwathPoints(left_lat, left_lon, right_lat, right_lon, front_lat, front_lon)
+
+# Scalar wrapper for a single fix, returning plain float tuples
+def calculate_new_gps_position(lat, lon, heading, distance_feet):
+    points = swath_points(lat, lon, heading, distance_feet)
+    return (float(points.left_lat), float(points.left_lon)), (float(points.right_lat), float(points.right_lon))
+
+# Scalar wrapper returning the side points and the front projection
+def calculate_swath_points(lat, lon, heading, distance_feet):
+    points = swath_points(lat, lon, heading, distance_feet)
+    return ((float(points.left_lat), float(points.left_lon)),
+            (float(points.right_lat), float(points.right_lon)),
+            (float(points.front_lat), float(points.front_lon)))
+
+# Flat x/y coordinates in feet around an origin (equirectangular). Accurate to
+# well under a foot across a field, and cheap enough to run on every fix.
+class LocalProjection:
+    def __init__(self, origin_lat, origin_lon):
+        self.origin_lat = origin_lat
+        self.origin_lon = origin_lon
+        self.feet_per_degree_lat = EARTH_RADIUS_FEET * np.pi / 180
+        self.feet_per_degree_lon = self.feet_per_degree_lat * np.cos(np.radians(origin_lat))
+
+    def to_xy(self, lat, lon):
+        return ((lon - self.origin_lon) * self.feet_per_degree_lon,
+                (lat - self.origin_lat) * self.feet_per_degree_lat)
+
+    def to_latlon(self, x, y):
+        return (self.origin_lat + y / self.feet_per_degree_lat,
+                self.origin_lon + x / self.feet_per_degree_lon)
@@ -1,60 +1,52 @@
-import serial
+import logging
 import time
-import csv
-import re
+from gpsparser import FixParser
+from gpsreader import SerialReader
+from trackstore import TrackWriter
 
 # Replace 'COM_PORT' with the actual port your Bluetooth device is connected to.
 # On a Mac, it might be something like '/dev/tty.YourBluetoothDevice-SerialPort'
 SERIAL_PORT = '/dev/cu.AGAIGPS'  # Adjust this to your actual port
 BAUD_RATE = 115200  # Make sure this matches the baud rate of your Bluetooth device
 
-# Regular expression to parse the incoming data
-pattern = re.compile(r"Lat: ([\d.-]+)\s*Long: ([\d.-]+)\s*Alt: ([\d.-]+) feet\s*Speed: ([\d.-]+) mph\s*Heading: ([\d.-]+) degrees")
+# Parses text blocks and NMEA sentences from the receiver
+parser = FixParser()
 
-# CSV file setup
-csv_file = 'gps_data.csv'
+# Per-fix output is logged at debug level; progress is printed every PROGRESS_EVERY fixes
+PROGRESS_EVERY = 100
+logger = logging.getLogger('getfrombt')
+logging.basicConfig(level=logging.INFO)
 
-# Initialize CSV file with headers if it doesn't exist
-with open(csv_file, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(['Timestamp', 'Latitude', 'Longitude', 'Altitude (feet)', 'Speed (mph)', 'Heading (degrees)'])
+# Track file setup, one writer is kept open for the whole session
+track_file = 'gps_data.trk'
+FSYNC_INTERVAL = 5.0  # Seconds between syncs to disk
+
+writer = TrackWriter(track_file, append=False, fsync_interval=FSYNC_INTERVAL)
 
 # Function to parse and save data
 def parse_and_save(data_block):
-    match = pattern.match(data_block)
-    if match:
-        data = match.groups()
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        row = [timestamp] + list(data)
-        print(f"Timestamp: {timestamp}, Latitude: {data[0]}, Longitude: {data[1]}, Altitude: {data[2]} feet, Speed: {data[3]} mph, Heading: {data[4]} degrees")
-        with open(csv_file, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(row)
-
-# Buffer to accumulate data
-buffer = ""
-
-try:
-    ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-    print(f"Connected to {SERIAL_PORT} at {BAUD_RATE} baud rate.")
-except serial.SerialException as e:
-    print(f"Error: Could not open serial port {SERIAL_PORT}: {e}")
-    exit()
+    fix = parser.parse(data_block)
+    if fix:
+        now = time.time()
+        writer.append(now, fix.lat, fix.lon, fix.alt, fix.speed, fix.heading)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Timestamp: %s, Latitude: %s, Longitude: %s, Altitude: %s feet, Speed: %s mph, Heading: %s degrees",
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), *fix)
+        if writer.records % PROGRESS_EVERY == 0:
+            print(f"Recorded {writer.records} fixes, last at {fix.lat:.7f}, {fix.lon:.7f}")
+
+# Every fix is recorded, so the reader waits for the writer rather than dropping fixes
+reader = SerialReader(SERIAL_PORT, BAUD_RATE, policy='block')
+reader.start()
 
 try:
+    # Blocks until the reader thread hands over a complete fix
     while True:
-        if ser.in_waiting > 0:
-            line = ser.readline().decode('utf-8').strip()
-            print(f"Raw data: {line}")
-            if line.startswith("Lat:"):
-                buffer = line
-            elif buffer and not line.startswith("Lat:"):
-                buffer += " " + line
-                if "Heading" in line:
-                    parse_and_save(buffer)
-                    buffer = ""
+        parse_and_save(reader.frames.get())
 except KeyboardInterrupt:
     print("Exiting script.")
 finally:
-    ser.close()
-    print("Serial port closed.")
+    reader.stop()
+    writer.close()
+    stats = reader.stats()
+    print(f"Received {stats['frames_received']} fixes, dropped {stats['frames_dropped']}.")
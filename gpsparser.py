@@ -0,0 +1,158 @@
+import math
+import re
+from collections import namedtuple
+import metrics
+
+# One position fix: degrees, feet, mph and degrees from north
+Fix = namedtuple('Fix', ['lat', 'lon', 'alt', 'speed', 'heading'])
+
+PARSE_SECONDS = metrics.stage_histogram('parse')
+
+KNOTS_TO_MPH = 1.150779448
+METERS_TO_FEET = 1 / 0.3048
+
+# Slow path for blocks the fast path does not recognise (odd spacing, glued
+# labels). Same expression the scripts have always used.
+pattern = re.compile(r"Lat: ([\d.-]+)\s*Long: ([\d.-]+)\s*Alt: ([\d.-]+) feet\s*Speed: ([\d.-]+) mph\s*Heading: ([\d.-]+) degrees")
+
+# Parse a "Lat: ... Long: ... Alt: ... feet Speed: ... mph Heading: ... degrees"
+# block. The receiver always sends the fields in this order, so the block is
+# split on whitespace and the values are taken by position, once every label
+# and unit is where it should be. Anything else goes through the expression.
+# float() takes nan and inf where the expression does not, and a corrupt
+# block must not put either into the geodesy, so those fixes are dropped.
+def parse_block(block):
+    fields = block.split()
+    if (len(fields) >= 13 and fields[0] == 'Lat:' and fields[2] == 'Long:' and fields[4] == 'Alt:' and
+            fields[6] == 'feet' and fields[7] == 'Speed:' and fields[9] == 'mph' and
+            fields[10] == 'Heading:' and fields[12] == 'degrees'):
+        try:
+            fix = Fix(float(fields[1]), float(fields[3]), float(fields[5]), float(fields[8]), float(fields[11]))
+        except ValueError:
+            return None
+        # A nan or infinite value makes the sum nan or infinite too
+        return fix if math.isfinite(fix.lat + fix.lon + fix.alt + fix.speed + fix.heading) else None
+    match = pattern.match(block)
+    if match:
+        try:
+            return Fix(*(float(value) for value in match.groups()))
+        except ValueError:
+            return None  # Runs of dots and dashes such as "1-2"
+    return None
+
+# True if an NMEA 0183 sentence carries a valid *hh checksum
+def nmea_checksum_ok(sentence):
+    star = sentence.rfind('*')
+    if not sentence.startswith('$') or star < 0 or len(sentence) < star + 3:
+        return False
+    checksum = 0
+    for char in sentence[1:star].encode('ascii', 'replace'):
+        checksum ^= char
+    try:
+        return checksum == int(sentence[star + 1:star + 3], 16)
+    except ValueError:
+        return False
+
+# ddmm.mmmm / dddmm.mmmm plus hemisphere to signed decimal degrees
+def _nmea_degrees(value, hemisphere):
+    if not value:
+        return None
+    dot = value.find('.')
+    degree_digits = (dot if dot >= 0 else len(value)) - 2
+    degrees = float(value[:degree_digits]) + float(value[degree_digits:]) / 60
+    return -degrees if hemisphere in ('S', 'W') else degrees
+
+def _float_or_none(value):
+    return float(value) if value else None
+
+# Fields of a GGA, RMC or VTG sentence as a dict, or None if the sentence is
+# corrupt, invalid or of another type
+def parse_nmea(sentence):
+    sentence = sentence.strip()
+    if not nmea_checksum_ok(sentence):
+        return None
+    fields = sentence[1:sentence.rfind('*')].split(',')
+    kind = fields[0][-3:]
+    try:
+        if kind == 'GGA' and len(fields) >= 10:
+            if fields[6] in ('', '0'):
+                return None  # No fix
+            altitude = _float_or_none(fields[9])
+            return {
+                'type': 'GGA',
+                'lat': _nmea_degrees(fields[2], fields[3]),
+                'lon': _nmea_degrees(fields[4], fields[5]),
+                'alt': altitude * METERS_TO_FEET if altitude is not None else None,
+            }
+        if kind == 'RMC' and len(fields) >= 9:
+            if fields[2] != 'A':
+                return None  # Receiver warning, position not valid
+            speed = _float_or_none(fields[7])
+            return {
+                'type': 'RMC',
+                'lat': _nmea_degrees(fields[3], fields[4]),
+                'lon': _nmea_degrees(fields[5], fields[6]),
+                'speed': speed * KNOTS_TO_MPH if speed is not None else None,
+                'heading': _float_or_none(fields[8]),
+            }
+        if kind == 'VTG' and len(fields) >= 6:
+            speed = _float_or_none(fields[5])
+            return {
+                'type': 'VTG',
+                'heading': _float_or_none(fields[1]),
+                'speed': speed * KNOTS_TO_MPH if speed is not None else None,
+            }
+    except ValueError:
+        return None
+    return None
+
+# Parses everything the receiver can send, one frame at a time. Text blocks
+# map to one fix each. NMEA sentences are merged: altitude from GGA, speed and
+# course from RMC or VTG. A fix is produced for every RMC, or for every GGA
+# when the receiver does not send RMC. Heading and speed are held over when a
+# sentence leaves them empty (receivers blank the course when stationary).
+class FixParser:
+    def __init__(self):
+        self.parsed = 0
+        self.rejected = 0
+        self._alt = 0.0
+        self._speed = 0.0
+        self._heading = 0.0
+        self._has_rmc = False
+
+    def parse(self, frame):
+        start = metrics.now()
+        if frame.startswith('$'):
+            fix = self._parse_nmea(frame)
+        else:
+            fix = parse_block(frame)
+            if fix is None:
+                self.rejected += 1
+        if fix is not None:
+            self.parsed += 1
+        PARSE_SECONDS.observe_since(start)
+        return fix
+
+    def _parse_nmea(self, sentence):
+        fields = parse_nmea(sentence)
+        if fields is None:
+            self.rejected += 1
+            return None
+        if fields.get('speed') is not None:
+            self._speed = fields['speed']
+        if fields.get('heading') is not None:
+            self._heading = fields['heading']
+
+        kind = fields['type']
+        if kind == 'GGA':
+            if fields['alt'] is not None:
+                self._alt = fields['alt']
+            if self._has_rmc:
+                return None
+        elif kind == 'RMC':
+            self._has_rmc = True
+        else:
+            return None
+        if fields['lat'] is None or fields['lon'] is None:
+            return None
+        return Fix(fields['lat'], fields['lon'], self._alt, self._speed, self._heading)
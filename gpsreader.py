@@ -0,0 +1,258 @@
+import csv
+import logging
+import queue
+import socket
+import threading
+import time
+from datetime import datetime
+import serial
+import metrics
+from trackstore import load_track
+
+logger = logging.getLogger(__name__)
+
+READ_SECONDS = metrics.stage_histogram('read')
+
+QUEUE_SIZE = 256  # Complete frames buffered between the reader and its consumer
+MAX_LINE_BYTES = 1024  # Longer lines are line noise and are thrown away
+MAX_BLOCK_LINES = 8  # A Lat: ... Heading block never spans more lines than this
+RECONNECT_DELAY = 2.0  # Seconds to wait before reopening a lost source
+DEFAULT_BAUD_RATE = 115200
+
+# Splits the receiver byte stream into complete frames. The text receiver sends
+# a fix as several lines, from "Lat: ..." down to "Heading: ... degrees", which
+# are joined into one frame; NMEA sentences ("$GPRMC,...") are one frame per
+# line. Partial lines and partial blocks are kept until the rest arrives.
+class FrameParser:
+    def __init__(self):
+        self._pending = bytearray()
+        self._block = None
+        self.discarded = 0
+
+    # Feed raw bytes, returning the list of complete frames as strings
+    def feed(self, data):
+        frames = []
+        self._pending += data
+        if b'\n' in data:
+            lines = self._pending.split(b'\n')
+            self._pending = lines.pop()
+            for line in lines:
+                self._line(line.strip(), frames)
+        if len(self._pending) > MAX_LINE_BYTES:
+            self._pending.clear()
+            self.discarded += 1
+        return frames
+
+    def _line(self, line, frames):
+        if not line:
+            return
+        if line.startswith(b'$'):
+            frames.append(line.decode('ascii', 'replace'))
+        elif line.startswith(b'Lat:'):
+            if self._block is not None:
+                self.discarded += 1
+            self._block = [line]
+        elif self._block is not None:
+            self._block.append(line)
+            if b'Heading' in line:
+                frames.append(b' '.join(self._block).decode('ascii', 'replace'))
+                self._block = None
+            elif len(self._block) > MAX_BLOCK_LINES:
+                self._block = None
+                self.discarded += 1
+
+# Reads one GPS source on its own thread and hands complete frames to the
+# consumer through a bounded queue. Subclasses implement _read, which should
+# block until data arrives (no polling) and pass the bytes to _feed.
+#
+# When the consumer falls behind, policy 'drop' throws away the oldest frame
+# (a stale fix is worth less than a new one) and policy 'block' stops reading
+# until there is room, leaving the backlog in the OS buffer. notify, if given,
+# is called after each frame is queued.
+class FixReader(threading.Thread):
+    def __init__(self, name, queue_size=QUEUE_SIZE, policy='drop', reconnect_delay=RECONNECT_DELAY, notify=None):
+        super().__init__(name=name, daemon=True)
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.policy = policy
+        self.reconnect_delay = reconnect_delay
+        self.notify = notify
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.parser = FrameParser()
+        self.bytes_read = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.blocked = 0
+        self.in_waiting = 0  # Bytes the driver held at the last read, where the source knows
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._read()
+            except OSError as e:  # serial.SerialException is an OSError too
+                print(f"Error: Could not read {self.name}: {e}")
+            if not self._stopped.is_set():
+                self._stopped.wait(self.reconnect_delay)
+        print(f"{self.name} closed.")
+
+    def _read(self):
+        raise NotImplementedError
+
+    def _feed(self, data):
+        self.bytes_read += len(data)
+        start = metrics.now()
+        frames = self.parser.feed(data)
+        READ_SECONDS.observe_since(start)
+        if frames and logger.isEnabledFor(logging.DEBUG):
+            for frame in frames:
+                logger.debug("Raw data: %s", frame)
+        for frame in frames:
+            self._put(frame)
+
+    def _put(self, frame):
+        self.frames_received += 1
+        if self.policy == 'block':
+            try:
+                self.frames.put_nowait(frame)
+            except queue.Full:
+                self.blocked += 1
+                self.frames.put(frame)
+        else:
+            while True:
+                try:
+                    self.frames.put_nowait(frame)
+                    break
+                except queue.Full:
+                    try:
+                        self.frames.get_nowait()
+                        self.frames_dropped += 1
+                    except queue.Empty:
+                        pass
+        if self.notify is not None:
+            self.notify()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def stats(self):
+        return {
+            'bytes_read': self.bytes_read,
+            'frames_received': self.frames_received,
+            'frames_dropped': self.frames_dropped,
+            'blocked': self.blocked,
+            'discarded': self.parser.discarded,
+            'queue_depth': self.frames.qsize(),
+            'in_waiting': self.in_waiting,
+            'buffered_bytes': len(self.parser._pending),
+        }
+
+# Serial port (Bluetooth SPP or USB receiver). Reads block in the driver until
+# data arrives, then take everything waiting at once.
+class SerialReader(FixReader):
+    def __init__(self, port, baud_rate, **options):
+        super().__init__(port, **options)
+        self.port = port
+        self.baud_rate = baud_rate
+
+    def _read(self):
+        with serial.Serial(self.port, self.baud_rate, timeout=1) as ser:
+            print(f"Connected to {self.port} at {self.baud_rate} baud rate.")
+            while not self._stopped.is_set():
+                # Blocks until at least one byte arrives or the timeout expires
+                self.in_waiting = ser.in_waiting
+                data = ser.read(max(1, self.in_waiting))
+                if data:
+                    self._feed(data)
+
+# Receiver stream over TCP (e.g. a serial-to-network bridge on the implement)
+class TcpReader(FixReader):
+    def __init__(self, host, port, **options):
+        super().__init__(f"{host}:{port}", **options)
+        self.host = host
+        self.port = port
+
+    def _read(self):
+        with socket.create_connection((self.host, self.port), timeout=10) as sock:
+            print(f"Connected to {self.host}:{self.port}.")
+            # A timeout only so stop() is noticed; recv otherwise blocks
+            sock.settimeout(1.0)
+            while not self._stopped.is_set():
+                try:
+                    data = sock.recv(4096)
+                except socket.timeout:
+                    continue
+                if not data:
+                    raise ConnectionError("connection closed by peer")
+                self._feed(data)
+
+# Replays a recorded session (.csv log or .trk track file) as receiver text
+# blocks, so replayed fixes go through the same framing and parsing as live
+# ones. speed is a multiple of wall-clock time (None replays as fast as the
+# consumer takes them); loop starts over at the end instead of stopping.
+class ReplayReader(FixReader):
+    def __init__(self, path, speed=1.0, loop=False, **options):
+        options.setdefault('policy', 'block')
+        super().__init__(path, **options)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.finished = threading.Event()
+
+    def _read(self):
+        while not self._stopped.is_set():
+            self._replay_once()
+            if not self.loop:
+                self.finished.set()
+                self._stopped.set()
+
+    def _replay_once(self):
+        start_wall = time.monotonic()
+        start_stamp = None
+        for timestamp, lat, lon, alt, speed, heading in read_records(self.path):
+            if self._stopped.is_set():
+                return
+            if self.speed:
+                if start_stamp is None:
+                    start_stamp = timestamp
+                delay = (timestamp - start_stamp) / self.speed - (time.monotonic() - start_wall)
+                if delay > 0:
+                    self._stopped.wait(delay)
+            self._feed(format_block(lat, lon, alt, speed, heading).encode('ascii'))
+
+# Receiver text block for one fix, as the receiver sends it
+def format_block(lat, lon, alt, speed, heading):
+    return (f"Lat: {lat:.7f}\r\nLong: {lon:.7f}\r\nAlt: {alt:.2f} feet\r\n"
+            f"Speed: {speed:.2f} mph\r\nHeading: {heading:.2f} degrees\r\n")
+
+# (timestamp, lat, lon, alt, speed, heading) rows of a recorded session
+def read_records(path):
+    if path.endswith('.trk'):
+        for record in load_track(path).tolist():
+            yield record
+        return
+    with open(path, 'r', newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield (datetime.fromisoformat(row['Timestamp']).timestamp(),
+                   float(row['Latitude']),
+                   float(row['Longitude']),
+                   float(row['Altitude (feet)']),
+                   float(row['Speed (mph)']),
+                   float(row['Heading (degrees)']))
+
+# Build a reader from a source spec: serial:<device>[@<baud>], tcp:<host>:<port>
+# or replay:<path>
+def open_source(spec, **options):
+    kind, _, target = spec.partition(':')
+    if kind == 'serial':
+        device, _, baud_rate = target.partition('@')
+        return SerialReader(device, int(baud_rate or DEFAULT_BAUD_RATE), **options)
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return TcpReader(host, int(port), **options)
+    if kind == 'replay':
+        return ReplayReader(target, **options)
+    raise ValueError(f"Unknown source: {spec}")
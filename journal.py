@@ -0,0 +1,178 @@
+import glob
+import logging
+import math
+import os
+import pickle
+import queue
+import re
+import threading
+import time
+import zlib
+from gpsparser import Fix
+from trackstore import HEADER, TrackWriter, load_track
+
+SNAPSHOT_EVERY = 5000  # Journal records between snapshots
+FSYNC_INTERVAL = 1.0  # Seconds of journal a crash can lose
+
+logger = logging.getLogger(__name__)
+
+# A tracking toggle is journaled as a record with no position; the heading
+# field holds the new state (1 on, 0 off)
+TOGGLE_LAT = math.nan
+
+# Crash-safe storage for one CoverageSession in a directory of generations:
+#     snapshot-000003.pkl.z   the whole session state, compressed
+#     journal-000003.trk      fixes and toggles since that snapshot
+# The journal uses the track file format. Every fix processed while tracking
+# is appended, and every toggle is appended as a marker record. After
+# snapshot_every records the session hands over a copy of its state and a new
+# journal generation starts. The session only queues these changes: appends
+# and the switch to a new generation are done in order by a writer thread, so
+# neither the session lock holder nor an event loop waits on an fsync. Pickling,
+# compressing and writing the snapshot happen on a thread of their own. The snapshot is written to a temporary file and
+# renamed into place, and older generations are deleted only after the rename.
+# Recovery loads the newest complete snapshot and replays the journals from
+# its generation on, so a restart costs one snapshot load plus at most a few
+# thousand fixes. Altitude, speed and heading are stored as float32, like in
+# track files. The receiver reports two decimals, so replayed vertices can
+# differ from the live ones in the last bits. Clients resync when they
+# reconnect anyway.
+class SessionJournal:
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, fsync_interval=FSYNC_INTERVAL):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync_interval = fsync_interval
+        self.generation = 0
+        self.replayed = 0
+        self.records = 0  # Records queued for the current generation's journal
+        self._writer = None
+        self._writes = queue.Queue()
+        self._write_thread = None
+        self._snapshot_thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, generation):
+        extension = 'trk' if kind == 'journal' else 'pkl.z'
+        return os.path.join(self.directory, f"{kind}-{generation:06d}.{extension}")
+
+    def _generations(self, kind):
+        found = []
+        for path in glob.glob(os.path.join(self.directory, f"{kind}-*")):
+            match = re.match(rf"{kind}-(\d+)\.(trk|pkl\.z)$", os.path.basename(path))
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    # Restore the session from disk, then journal its changes from now on
+    def attach(self, session):
+        with session.lock:
+            snapshots = self._generations('snapshot')
+            if snapshots:
+                self.generation = snapshots[-1]
+                with open(self._path('snapshot', self.generation), 'rb') as snapshot_file:
+                    session._restore(pickle.loads(zlib.decompress(snapshot_file.read())))
+
+        # Replay with no journal attached so nothing is written twice
+        for generation in self._generations('journal'):
+            if generation < self.generation or not self._has_header(generation):
+                continue
+            for record in load_track(self._path('journal', generation)):
+                self._replay(session, record)
+                self.replayed += 1
+            self.generation = generation
+
+        with session.lock:
+            self._writer = TrackWriter(self._path('journal', self.generation), append=self._has_header(self.generation),
+                                       fsync_interval=self.fsync_interval)
+            self.records = self._writer.records
+            self._write_thread = threading.Thread(target=self._run_writes, name='session-journal', daemon=True)
+            self._write_thread.start()
+            session.journal = self
+
+    # A crash straight after a journal was created can leave it without a header
+    def _has_header(self, generation):
+        path = self._path('journal', generation)
+        return os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+
+    def _replay(self, session, record):
+        if math.isnan(record['lat']):
+            if bool(record['heading']) != session.tracking:
+                session.toggle_tracking()
+        else:
+            session.process_fix(Fix(float(record['lat']), float(record['lon']), float(record['alt']),
+                                    float(record['speed']), float(record['heading'])))
+
+    # The record_* methods and snapshot are called by the session with its lock held
+    def record_fix(self, fix):
+        self._writes.put(('append', (time.time(), fix.lat, fix.lon, fix.alt, fix.speed, fix.heading)))
+        self.records += 1
+
+    def record_toggle(self, tracking):
+        self._writes.put(('append', (time.time(), TOGGLE_LAT, TOGGLE_LAT, 0.0, 0.0, 1.0 if tracking else 0.0)))
+        self.records += 1
+
+    def snapshot_due(self):
+        if self.records < self.snapshot_every:
+            return False
+        # One snapshot in flight at a time; the journal keeps growing meanwhile
+        return self._snapshot_thread is None or not self._snapshot_thread.is_alive()
+
+    # state must not share anything the session goes on changing
+    def snapshot(self, state):
+        self.generation += 1
+        self.records = 0
+        self._writes.put(('rotate', (state, self.generation)))
+
+    def _run_writes(self):
+        while True:
+            kind, args = self._writes.get()
+            if kind is None:
+                return
+            try:
+                if kind == 'append':
+                    self._writer.append(*args)
+                else:
+                    self._rotate(*args)
+            except Exception:
+                # Keep the thread alive; later writes may well succeed
+                logger.exception("Could not write the session journal in %s", self.directory)
+
+    # Start the journal of a new generation and write the snapshot it follows
+    def _rotate(self, state, generation):
+        self._writer.close()
+        self._writer = TrackWriter(self._path('journal', generation), append=False,
+                                   fsync_interval=self.fsync_interval)
+        self._snapshot_thread = threading.Thread(target=self._write_snapshot, args=(state, generation),
+                                                 name='session-snapshot', daemon=True)
+        self._snapshot_thread.start()
+
+    def _write_snapshot(self, state, generation):
+        data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        path = self._path('snapshot', generation)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as snapshot_file:
+            snapshot_file.write(data)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary, path)
+        if hasattr(os, 'O_DIRECTORY'):
+            directory = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+        # Everything before this generation is now in the snapshot
+        for kind in ('snapshot', 'journal'):
+            for old in self._generations(kind):
+                if old < generation:
+                    os.remove(self._path(kind, old))
+
+    def close(self):
+        if self._write_thread is not None:
+            self._writes.put((None, None))
+            self._write_thread.join()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Set POLYTRACK_METRICS=0 to turn instrumentation off. Disabled timers return
+# straight away. Counters and gauges are read at scrape time from the counts
+# the pipeline keeps anyway (reader and parser statistics, list lengths), so
+# they cost nothing either way.
+enabled = os.environ.get('POLYTRACK_METRICS', '1') not in ('0', 'false', 'no')
+
+# Latency buckets in seconds, from 10 us to 1 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1, 1.0)
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+# Start of a timed section, for Histogram.observe_since
+def now():
+    return time.perf_counter() if enabled else 0.0
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# A counter or gauge whose value is read when metrics are scraped
+class Callback:
+    def __init__(self, kind, name, help_text, function, labels=None):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.function = function
+
+    def samples(self):
+        yield self.name, self.labels, self.function()
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if enabled:
+            self._add(value)
+
+    # Record the time since start (from now())
+    def observe_since(self, start):
+        if enabled:
+            self._add(time.perf_counter() - start)
+
+    def _add(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            yield self.name + '_bucket', dict(self.labels, le=_number(bound)), cumulative
+        yield self.name + '_sum', self.labels, total
+        yield self.name + '_count', self.labels, count
+
+# Every metric of the process, rendered in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Samples of one metric name must be together, whatever order they were added in
+        families = {}
+        with self._lock:
+            for metric in self.metrics:
+                families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, family in families.items():
+            lines.append(f"# HELP {name} {family[0].help}")
+            lines.append(f"# TYPE {name} {family[0].kind}")
+            for metric in family:
+                lines.extend(self._samples(metric))
+        return '\n'.join(lines) + '\n'
+
+    def _samples(self, metric):
+        lines = []
+        try:
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        except Exception as e:
+            lines = [f"# {metric.name}{_labels(metric.labels)} unavailable: {e}"]
+        return lines
+
+registry = Registry()
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, **labels):
+    return registry.add(Histogram(name, help_text, labels, buckets))
+
+def gauge_function(name, help_text, function, **labels):
+    return registry.add(Callback('gauge', name, help_text, function, labels))
+
+def counter_function(name, help_text, function, **labels):
+    return registry.add(Callback('counter', name, help_text, function, labels))
+
+# Time spent in one pipeline stage
+def stage_histogram(stage):
+    return histogram('polytrack_stage_seconds', 'Time spent per fix in each pipeline stage', stage=stage)
+
+# Resident memory of this process in bytes
+def process_rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Peak rather than current where /proc is missing; kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+gauge_function('polytrack_process_resident_memory_bytes', 'Resident memory of the server process', process_rss_bytes)
+counter_function('polytrack_process_cpu_seconds_total', 'CPU time used by the server process', time.process_time)
+
+# Reader statistics (bytes, frames, drops, queue depth) for one GPS source
+def register_reader(reader, **labels):
+    stats = reader.stats
+    counter_function('polytrack_reader_bytes_total', 'Bytes read from the GPS source',
+                     lambda: stats()['bytes_read'], **labels)
+    counter_function('polytrack_reader_frames_total', 'Frames read from the GPS source',
+                     lambda: stats()['frames_received'], **labels)
+    counter_function('polytrack_reader_frames_dropped_total', 'Frames dropped because the pipeline fell behind',
+                     lambda: stats()['frames_dropped'], **labels)
+    counter_function('polytrack_reader_discarded_total', 'Unframeable input discarded by the reader',
+                     lambda: stats()['discarded'], **labels)
+    gauge_function('polytrack_reader_queue_depth', 'Frames waiting between the reader and the pipeline',
+                   lambda: reader.frames.qsize(), **labels)
+    gauge_function('polytrack_reader_in_waiting_bytes', 'Bytes waiting in the serial driver at the last read',
+                   lambda: reader.in_waiting, **labels)
+    gauge_function('polytrack_reader_buffered_bytes', 'Bytes of a partial line or block held by the reader',
+                   lambda: stats()['buffered_bytes'], **labels)
+
+def register_parser(parser, **labels):
+    counter_function('polytrack_fixes_parsed_total', 'Fixes parsed', lambda: parser.parsed, **labels)
+    counter_function('polytrack_frames_rejected_total', 'Frames that did not parse', lambda: parser.rejected, **labels)
+
+# Path sizes and coverage of a CoverageSession
+def register_session(session, **labels):
+    gauge_function('polytrack_path_points', 'Recorded fixes on the path', lambda: len(session.user_path), **labels)
+    gauge_function('polytrack_edge_vertices', 'Committed swath edge vertices',
+                   lambda: len(session.left_path) + len(session.right_path), **labels)
+    gauge_function('polytrack_coverage_segments', 'Swath segments painted', lambda: session.coverage.segments, **labels)
+    gauge_function('polytrack_coverage_tiles', 'Coverage raster tiles allocated', lambda: len(session.coverage.tiles), **labels)
+    gauge_function('polytrack_tracking', 'Whether tracking is on', lambda: int(session.tracking), **labels)
+
+# Map tile requests by where they were answered from, and the cache size
+def register_tile_cache(cache):
+    for source, attribute in (('memory', 'memory_hits'), ('disk', 'disk_hits'), ('upstream', 'fetched'),
+                              ('missing', 'misses')):
+        counter_function('polytrack_tile_requests_total', 'Map tile requests by where they were served from',
+                         lambda attribute=attribute: getattr(cache, attribute), source=source)
+    gauge_function('polytrack_tile_cache_tiles', 'Map tiles cached on disk', lambda: cache.count)
+    counter_function('polytrack_tile_cache_evicted_total', 'Map tiles evicted from the disk cache',
+                     lambda: cache.evicted)
+
+def register_broadcaster(broadcaster):
+    counter_function('polytrack_broadcast_events_total', 'Events published to the broadcaster',
+                     lambda: broadcaster.published)
+    counter_function('polytrack_broadcast_frames_total', 'Frames sent to clients', lambda: broadcaster.sent_frames)
+    counter_function('polytrack_broadcast_frames_dropped_total', 'Frames skipped for clients that were behind',
+                     lambda: broadcaster.frames_dropped)
+    gauge_function('polytrack_broadcast_clients', 'Connected clients', lambda: len(broadcaster.clients))
+    gauge_function('polytrack_broadcast_max_queue_depth', 'Most unacknowledged frames of any client',
+                   lambda: max([client['queue_depth'] for client in broadcaster.stats()['clients']], default=0))
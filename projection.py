@@ -1,147 +1,129 @@
-import csv
-import math
-import serial
-import time
-import re
-from flask import Flask, render_template
+from flask import Flask, Response, abort, jsonify, render_template, request
 from flask_socketio import SocketIO, emit
 from threading import Thread
-
-# Constants
-EARTH_RADIUS_FEET = 20925646.325  # Earth radius in feet
-FEET_TO_METERS = 0.3048  # Conversion factor from feet to meters
+import metrics
+from boundary import load_boundary
+from broadcast import Broadcaster
+from gpsparser import FixParser
+from gpsreader import SerialReader
+from journal import SessionJournal
+from session import CoverageSession
+from tilecache import TileCache, tile_response
 
 # Serial port configuration
 SERIAL_PORT = '/dev/cu.AGAIGPS'  # Adjust this to your actual port
 BAUD_RATE = 115200  # Make sure this matches the baud rate of your Bluetooth device
 
-# Regular expression to parse the incoming data
-pattern = re.compile(r"Lat: ([\d.-]+)\s*Long: ([\d.-]+)\s*Alt: ([\d.-]+) feet\s*Speed: ([\d.-]+) mph\s*Heading: ([\d.-]+) degrees")
+# Journal and snapshots of the field session, so a restart picks up where it left off
+SESSION_DIR = 'session'
+
+# GeoJSON or shapefile of the field boundaries, or None. Coverage is clipped to
+# the fields and acres are reported per field. A restored session keeps the
+# boundary it was recorded with.
+BOUNDARY_FILE = None
+
+# Parses text blocks and NMEA sentences from the receiver
+parser = FixParser()
+
+# Reads the receiver on its own thread and queues complete fixes
+reader = SerialReader(SERIAL_PORT, BAUD_RATE)
 
 # Flask app setup
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-# Flag to control tracking state
-tracking = False
+# Sends the session's events to the clients at a steady frame rate, so a slow
+# client never holds up the serial thread
+broadcaster = Broadcaster(socketio)
 
-# List to store the user's path
-user_path = []
-left_path = []
-right_path = []
+# Map tiles for the page, cached so the map loads without a connection
+tile_cache = TileCache()
 
-# Function to calculate the new GPS positions for the front and rear projections
-def calculate_new_gps_positions(lat, lon, heading, distance_feet):
-    # Convert distance to meters
-    distance_meters = (distance_feet / 2) * FEET_TO_METERS
-    
-    # Convert latitude and longitude from degrees to radians
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
-    
-    # Convert heading to radians
-    heading_rad = math.radians(heading)
-    
-    # Calculate angles for left and right projections
-    left_angle_rad = heading_rad - math.pi / 2
-    right_angle_rad = heading_rad + math.pi / 2
-    front_angle_rad = heading_rad  # Same direction as heading
-    
-    # Calculate front left and right positions
-    front_left_lat, front_left_lon = calculate_position(lat_rad, lon_rad, distance_meters, left_angle_rad, front_angle_rad)
-    front_right_lat, front_right_lon = calculate_position(lat_rad, lon_rad, distance_meters, right_angle_rad, front_angle_rad)
-    
-    # Calculate rear left and right positions
-    rear_left_lat, rear_left_lon = calculate_position(lat_rad, lon_rad, distance_meters, left_angle_rad, heading_rad + math.pi)
-    rear_right_lat, rear_right_lon = calculate_position(lat_rad, lon_rad, distance_meters, right_angle_rad, heading_rad + math.pi)
-    
-    # Calculate the front projection point
-    front_projection_lat, front_projection_lon = calculate_position(lat_rad, lon_rad, distance_feet, heading_rad, heading_rad)
-    
-    return (front_left_lat, front_left_lon), (front_right_lat, front_right_lon), (rear_left_lat, rear_left_lon), (rear_right_lat, rear_right_lon), (front_projection_lat, front_projection_lon)
+# Tracking state, recorded path and coverage for the implement
+session = CoverageSession(boundary=load_boundary(BOUNDARY_FILE) if BOUNDARY_FILE else None)
 
-# Helper function to calculate new latitude and longitude based on distance and angle
-def calculate_position(lat_rad, lon_rad, distance_meters, side_angle_rad, direction_angle_rad):
-    new_lat_rad = math.asin(math.sin(lat_rad) * math.cos(distance_meters / EARTH_RADIUS_FEET) +
-                            math.cos(lat_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(side_angle_rad))
-    new_lon_rad = lon_rad + math.atan2(math.sin(side_angle_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(lat_rad),
-                                       math.cos(distance_meters / EARTH_RADIUS_FEET) - math.sin(lat_rad) * math.sin(new_lat_rad))
-    return math.degrees(new_lat_rad), math.degrees(new_lon_rad)
+# Pipeline statistics for /metrics
+metrics.register_reader(reader)
+metrics.register_parser(parser)
+metrics.register_session(session)
+metrics.register_broadcaster(broadcaster)
+metrics.register_tile_cache(tile_cache)
 
 def parse_and_process_gps_data(data_block):
-    match = pattern.match(data_block)
-    if match:
-        data = match.groups()
-        lat = float(data[0])
-        lon = float(data[1])
-        heading = float(data[4])
-        distance_feet = 30  # Distance in feet
-        
-        front_left, front_right, rear_left, rear_right, front_projection = calculate_new_gps_positions(lat, lon, heading, distance_feet)
-        
-        # Create arrays for front and rear positions
-        front_positions = [front_left, front_right]
-        rear_positions = [rear_left, rear_right]
-        
-        # Add current position to user_path
-        if tracking:
-            user_path.append((lat, lon))
-            left_path.append(rear_left)
-            right_path.append(rear_right)
-        
-        # Create a new array that combines the left path and the reversed right path
-        combined_positions = left_path + list(reversed(right_path))
-        
-        # Send the current location and the positions to the client
-        socketio.emit('update_current_location', {
-            'current_location': (lat, lon)
-        })
-        
-        if tracking:
-            socketio.emit('update_positions', {
-                'front': front_positions,
-                'combined': combined_positions,
-                'front_projection': front_projection
-            })
+    fix = parser.parse(data_block)
+    if fix:
+        broadcaster.publish(session.process_fix(fix))
 
+# Hand each complete fix from the serial reader thread to the pipeline. Waiting
+# on the queue blocks, so nothing runs between fixes.
 def read_from_bluetooth():
-    global tracking
-    buffer = ""
-    try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-        print(f"Connected to {SERIAL_PORT} at {BAUD_RATE} baud rate.")
-        while True:
-            if ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8').strip()
-                print(f"Raw data: {line}")
-                if line.startswith("Lat:"):
-                    buffer = line
-                elif buffer and not line.startswith("Lat:"):
-                    buffer += " " + line
-                    if "Heading" in line:
-                        parse_and_process_gps_data(buffer)
-                        buffer = ""
-    except serial.SerialException as e:
-        print(f"Error: Could not open serial port {SERIAL_PORT}: {e}")
-    finally:
-        ser.close()
-        print("Serial port closed.")
+    reader.start()
+    while True:
+        parse_and_process_gps_data(reader.frames.get())
 
 @socketio.on('toggle_tracking')
 def handle_toggle_tracking():
-    global tracking
-    tracking = not tracking
+    tracking, events = session.toggle_tracking()
     emit('tracking_status', {'tracking': tracking})
+    broadcaster.publish(events)
+
+@socketio.on('connect')
+def handle_connect():
+    broadcaster.add_client(request.sid)
+    emit('tracking_status', {'tracking': session.tracking})
+    emit('coverage_resync', session.snapshot())
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    broadcaster.remove_client(request.sid)
+
+@socketio.on('request_resync')
+def handle_request_resync():
+    emit('coverage_resync', session.snapshot())
 
 @app.route('/')
 def project():
     return render_template('project.html')
 
+@app.route('/broadcast')
+def broadcast_stats():
+    return jsonify(broadcaster.stats())
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def map_tile(z, x, y):
+    return tile_response(tile_cache, z, x, y)
+
+@app.route('/coverage/tiles')
+def coverage_tiles():
+    return jsonify(session.tile_index())
+
+@app.route('/coverage/boundary')
+def coverage_boundary():
+    return jsonify(session.boundary_geojson())
+
+@app.route('/coverage/tile/<int(signed=True):x>/<int(signed=True):y>.png')
+def coverage_tile(x, y):
+    png = session.render_tile_png(x, y)
+    if png is None:
+        abort(404)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'no-cache'})
+
 if __name__ == '__main__':
+    # Restore the field session from the last run before anything reads it
+    journal = SessionJournal(SESSION_DIR)
+    journal.attach(session)
+    print(f"Restored session from {SESSION_DIR} (generation {journal.generation}, "
+          f"{journal.replayed} journal records replayed)")
+
     # Start the Bluetooth reading thread
     bluetooth_thread = Thread(target=read_from_bluetooth)
     bluetooth_thread.daemon = True
     bluetooth_thread.start()
+    broadcaster.start()
     
     # Start the Flask app
     socketio.run(app, host='0.0.0.0', port=5050)
@@ -1,75 +1,69 @@
-import csv
-import math
-import serial
-import time
-import re
-from flask import Flask, render_template
+from flask import Flask, Response, jsonify, render_template, request
 from flask_socketio import SocketIO, emit
-from threading import Thread
-
-# Constants
-EARTH_RADIUS_FEET = 20925646.325  # Earth radius in feet
-FEET_TO_METERS = 0.3048  # Conversion factor from feet to meters
+from threading import Lock, Thread
+import metrics
+from broadcast import Broadcaster
+from filters import HeadingFilter
+from geodesy import calculate_new_gps_position
+from gpsparser import FixParser
+from gpsreader import SerialReader
+from tilecache import TileCache, tile_response
 
 # Serial port configuration
 SERIAL_PORT = '/dev/cu.AGAIGPS'  # Adjust this to your actual port
 BAUD_RATE = 115200  # Make sure this matches the baud rate of your Bluetooth device
 
-# Regular expression to parse the incoming data
-pattern = re.compile(r"Lat: ([\d.-]+)\s*Long: ([\d.-]+)\s*Alt: ([\d.-]+) feet\s*Speed: ([\d.-]+) mph\s*Heading: ([\d.-]+) degrees")
+# Parses text blocks and NMEA sentences from the receiver
+parser = FixParser()
+
+# Reads the receiver on its own thread and queues complete fixes
+reader = SerialReader(SERIAL_PORT, BAUD_RATE)
 
 # Flask app setup
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-# Flag to control tracking state
-tracking = False
+# Coalesces the per-fix updates into frames sent at a steady rate
+broadcaster = Broadcaster(socketio)
 
-def calculate_new_gps_position(lat, lon, heading, distance_feet):
-    # Convert distance to meters
-    distance_meters = (distance_feet / 2) * FEET_TO_METERS  # Use half the distance for each side
-    
-    # Convert latitude and longitude from degrees to radians
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
-    
-    # Convert heading to radians
-    heading_rad = math.radians(heading)
-    
-    # Calculate the left and right angles in radians
-    left_angle_rad = heading_rad - math.pi / 2
-    right_angle_rad = heading_rad + math.pi / 2
-    
-    # Calculate the new latitude and longitude for the left position
-    left_lat_rad = math.asin(math.sin(lat_rad) * math.cos(distance_meters / EARTH_RADIUS_FEET) +
-                             math.cos(lat_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(left_angle_rad))
-    left_lon_rad = lon_rad + math.atan2(math.sin(left_angle_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(lat_rad),
-                                        math.cos(distance_meters / EARTH_RADIUS_FEET) - math.sin(lat_rad) * math.sin(left_lat_rad))
-    
-    # Calculate the new latitude and longitude for the right position
-    right_lat_rad = math.asin(math.sin(lat_rad) * math.cos(distance_meters / EARTH_RADIUS_FEET) +
-                              math.cos(lat_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(right_angle_rad))
-    right_lon_rad = lon_rad + math.atan2(math.sin(right_angle_rad) * math.sin(distance_meters / EARTH_RADIUS_FEET) * math.cos(lat_rad),
-                                         math.cos(distance_meters / EARTH_RADIUS_FEET) - math.sin(lat_rad) * math.sin(right_lat_rad))
-    
-    # Convert the new latitude and longitude from radians to degrees
-    left_lat = math.degrees(left_lat_rad)
-    left_lon = math.degrees(left_lon_rad)
-    right_lat = math.degrees(right_lat_rad)
-    right_lon = math.degrees(right_lon_rad)
-    
-    return (left_lat, left_lon), (right_lat, right_lon)
+# Map tiles for the page, cached so the map loads without a connection
+tile_cache = TileCache()
+
+GEODESY_SECONDS = metrics.stage_histogram('geodesy')
+metrics.register_reader(reader)
+metrics.register_parser(parser)
+metrics.register_broadcaster(broadcaster)
+metrics.register_tile_cache(tile_cache)
+
+# Drops stopped fixes and smooths the heading before the side points are
+# projected. Used and reset under tracking_lock.
+heading_filter = HeadingFilter()
+
+# Flag to control tracking state, flipped by the SocketIO handlers and read by
+# the reader thread, always under tracking_lock
+tracking = False
+tracking_lock = Lock()
 
 def parse_and_process_gps_data(data_block):
-    match = pattern.match(data_block)
-    if match:
-        data = match.groups()
-        lat = float(data[0])
-        lon = float(data[1])
-        heading = float(data[4])
+    fix = parser.parse(data_block)
+    if fix:
+        # Read the flag once so a toggle mid-fix cannot split the update
+        with tracking_lock:
+            is_tracking = tracking
+            filtered = heading_filter.filter(fix)
+        lat = fix.lat
+        lon = fix.lon
+        if filtered is None:
+            broadcaster.publish([('update_current_location', {
+                'current_location': (lat, lon)
+            })])
+            return
+        heading = filtered.heading
         distance_feet = 30  # Distance in feet
         
+        start = metrics.now()
         left_position, right_position = calculate_new_gps_position(lat, lon, heading, distance_feet)
+        GEODESY_SECONDS.observe_since(start)
         
         # Create an array that is the reverse of the right array
         right_positions = [right_position]
@@ -84,46 +78,56 @@ def parse_and_process_gps_data(data_block):
         combined_positions = left_positions + reverse_right_positions
         
         # Send the current location and, if tracking is on, the positions to the client
-        socketio.emit('update_current_location', {
+        events = [('update_current_location', {
             'current_location': (lat, lon)
-        })
+        })]
         
-        if tracking:
-            socketio.emit('update_positions', {
+        if is_tracking:
+            events.append(('update_positions', {
                 'left': left_positions,
                 'center': [(lat, lon)],
                 'right': right_positions,
                 'combined': combined_positions
-            })
+            }))
+        broadcaster.publish(events)
 
+# Hand each complete fix from the serial reader thread to the pipeline. Waiting
+# on the queue blocks, so nothing runs between fixes.
 def read_from_bluetooth():
-    global tracking
-    buffer = ""
-    try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-        print(f"Connected to {SERIAL_PORT} at {BAUD_RATE} baud rate.")
-        while True:
-            if ser.in_waiting > 0:
-                line = ser.readline().decode('utf-8').strip()
-                print(f"Raw data: {line}")
-                if line.startswith("Lat:"):
-                    buffer = line
-                elif buffer and not line.startswith("Lat:"):
-                    buffer += " " + line
-                    if "Heading" in line:
-                        parse_and_process_gps_data(buffer)
-                        buffer = ""
-    except serial.SerialException as e:
-        print(f"Error: Could not open serial port {SERIAL_PORT}: {e}")
-    finally:
-        ser.close()
-        print("Serial port closed.")
+    reader.start()
+    while True:
+        parse_and_process_gps_data(reader.frames.get())
 
 @socketio.on('toggle_tracking')
 def handle_toggle_tracking():
     global tracking
-    tracking = not tracking
-    emit('tracking_status', {'tracking': tracking})
+    with tracking_lock:
+        tracking = not tracking
+        is_tracking = tracking
+        if tracking:
+            # Start from a fresh heading estimate rather than one from before the stop
+            heading_filter.reset()
+    emit('tracking_status', {'tracking': is_tracking})
+
+@socketio.on('connect')
+def handle_connect():
+    broadcaster.add_client(request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    broadcaster.remove_client(request.sid)
+
+@app.route('/broadcast')
+def broadcast_stats():
+    return jsonify(broadcaster.stats())
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def map_tile(z, x, y):
+    return tile_response(tile_cache, z, x, y)
 
 @app.route('/')
 def index():
@@ -134,6 +138,7 @@ if __name__ == '__main__':
     bluetooth_thread = Thread(target=read_from_bluetooth)
     bluetooth_thread.daemon = True
     bluetooth_thread.start()
+    broadcaster.start()
     
     # Start the Flask app
     socketio.run(app, host='0.0.0.0', port=5050)
@@ -0,0 +1,144 @@
+import argparse
+import math
+import time
+from collections import Counter
+from geodesy import LocalProjection
+from gpsparser import FixParser
+from gpsreader import FrameParser, format_block, read_records
+from session import DISTANCE_FEET, CoverageSession
+
+STAGES = ('read', 'parse', 'process', 'emit')
+PASS_SPACING_FEET = DISTANCE_FEET - 0.5  # Adjacent passes of the synthetic track just overlap
+
+# A deterministic field pattern: back-and-forth passes joined by U-turns, as
+# (timestamp, lat, lon, alt, speed, heading) records
+def synthetic_track(count, origin=(46.3345, -113.3021), pass_length_feet=1000.0, spacing_feet=PASS_SPACING_FEET,
+                    speed_mph=5.0, rate_hz=10.0, start_time=1715816848.0):
+    projection = LocalProjection(*origin)
+    step = speed_mph * 5280 / 3600 / rate_hz  # Feet travelled per fix
+    straight = max(1, int(pass_length_feet / step))
+    turn = max(2, int(math.pi * spacing_feet / 2 / step))
+    x = 0.0
+    y = 0.0
+    index = 0
+    pass_number = 0
+    while True:
+        north = pass_number % 2 == 0
+        for _ in range(straight):
+            if index == count:
+                return
+            heading = 0.0 if north else 180.0
+            lat, lon = projection.to_latlon(x, y)
+            yield (start_time + index / rate_hz, float(lat), float(lon), 5245.0, speed_mph, heading)
+            y += step if north else -step
+            index += 1
+        # U-turn to the east onto the next pass
+        center_x = x + spacing_feet / 2
+        for i in range(turn):
+            if index == count:
+                return
+            angle = math.pi * i / turn
+            turn_x = center_x - math.cos(angle) * spacing_feet / 2
+            turn_y = y + math.sin(angle) * spacing_feet / 2 * (1 if north else -1)
+            heading = math.degrees(angle) if north else 180.0 - math.degrees(angle)
+            lat, lon = projection.to_latlon(turn_x, turn_y)
+            yield (start_time + index / rate_hz, float(lat), float(lon), 5245.0, speed_mph, heading)
+            index += 1
+        x += spacing_feet
+        pass_number += 1
+
+# Stands in for SocketIO: counts events and payload entries instead of sending
+class RecordingSink:
+    def __init__(self, keep_last=False):
+        self.events = Counter()
+        self.keep_last = keep_last
+        self.last = {}
+
+    def emit(self, event, payload, to=None):
+        self.events[event] += 1
+        if self.keep_last:
+            self.last[event] = payload
+
+# Per-stage latencies in nanoseconds, one list per stage
+class StageTimer:
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def percentiles(self, stage, points=(50, 95, 99, 100)):
+        values = sorted(self.samples[stage])
+        if not values:
+            return {point: 0.0 for point in points}
+        return {point: values[min(len(values) - 1, int(len(values) * point / 100))] / 1000 for point in points}
+
+# Feed records through the live pipeline: receiver text block -> frame parser
+# -> fix parser -> coverage session -> emit. speed is a multiple of wall-clock
+# time, None runs as fast as possible. checkpoint(index) is called every
+# checkpoint_every fixes. Returns the session.
+def run_pipeline(records, session=None, emit=None, speed=None, timer=None, checkpoint=None, checkpoint_every=10000):
+    if session is None:
+        session = CoverageSession()
+        session.tracking = True
+    if emit is None:
+        emit = RecordingSink().emit
+    framer = FrameParser()
+    parser = FixParser()
+    clock = time.perf_counter_ns
+    start_wall = time.monotonic()
+    start_stamp = None
+
+    for index, (timestamp, lat, lon, alt, speed_mph, heading) in enumerate(records):
+        if speed:
+            if start_stamp is None:
+                start_stamp = timestamp
+            delay = (timestamp - start_stamp) / speed - (time.monotonic() - start_wall)
+            if delay > 0:
+                time.sleep(delay)
+        data = format_block(lat, lon, alt, speed_mph, heading).encode('ascii')
+
+        t0 = clock()
+        frames = framer.feed(data)
+        t1 = clock()
+        fixes = [fix for fix in map(parser.parse, frames) if fix is not None]
+        t2 = clock()
+        events = []
+        for fix in fixes:
+            events.extend(session.process_fix(fix))
+        t3 = clock()
+        for event, payload in events:
+            emit(event, payload)
+        t4 = clock()
+
+        if timer is not None:
+            samples = timer.samples
+            samples['read'].append(t1 - t0)
+            samples['parse'].append(t2 - t1)
+            samples['process'].append(t3 - t2)
+            samples['emit'].append(t4 - t3)
+        if checkpoint is not None and (index + 1) % checkpoint_every == 0:
+            checkpoint(index + 1)
+    return session
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded or synthetic session through the live pipeline.')
+    parser.add_argument('input', nargs='?', help='.csv or .trk session (default: synthetic track)')
+    parser.add_argument('--fixes', type=int, default=10000, help='Fixes in the synthetic track')
+    parser.add_argument('--speed', type=float, help='Multiple of wall-clock time (default: as fast as possible)')
+    args = parser.parse_args()
+
+    records = read_records(args.input) if args.input else synthetic_track(args.fixes)
+    sink = RecordingSink()
+    timer = StageTimer()
+    start = time.perf_counter()
+    session = run_pipeline(records, emit=sink.emit, speed=args.speed, timer=timer)
+    elapsed = time.perf_counter() - start
+
+    fixes = len(timer.samples['read'])
+    print(f"Replayed {fixes} fixes in {elapsed:.2f} s ({fixes / elapsed:,.0f} fixes/sec)")
+    for stage in STAGES:
+        p = timer.percentiles(stage)
+        print(f"  {stage:<8} p50 {p[50]:8.1f} us  p95 {p[95]:8.1f} us  p99 {p[99]:8.1f} us  max {p[100]:9.1f} us")
+    print(f"  events: {dict(sink.events)}")
+    print(f"  coverage: {session.stats()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import copy
+import math
+from threading import Lock
+import metrics
+from broadcast import pack_points
+from coverage import COVERAGE_MAX_GAP_FEET, COVERAGE_RESOLUTION_FEET, MAX_STEP_WIDTHS, CoverageGrid
+from filters import HeadingFilter
+from geodesy import calculate_swath_points
+from simplify import FixDecimator, IncrementalSimplifier
+from swathindex import OVERLAP_ALERT_FRACTION, SwathIndex
+
+DISTANCE_FEET = 30  # Implement width in feet
+
+GEODESY_SECONDS = metrics.stage_histogram('geodesy')
+PATH_SECONDS = metrics.stage_histogram('path')
+COVERAGE_SECONDS = metrics.stage_histogram('coverage')
+
+# Function to calculate the new GPS positions for the front and rear projections
+def calculate_new_gps_positions(lat, lon, heading, distance_feet):
+    left, right, front_projection = calculate_swath_points(lat, lon, heading, distance_feet)
+
+    # The implement is modelled as a line, so the front and rear corners are the side offsets
+    return left, right, left, right, front_projection
+
+# Everything known about one implement's field session: the tracking flag,
+# the recorded path and swath edges, the coverage raster and the simplifiers.
+# process_fix and the other mutators return the (event, payload) pairs to send
+# to this session's clients; sending them is up to the caller.
+class CoverageSession:
+    def __init__(self, width_feet=DISTANCE_FEET, resolution_feet=COVERAGE_RESOLUTION_FEET,
+                 max_gap_feet=COVERAGE_MAX_GAP_FEET, boundary=None):
+        self.width_feet = width_feet
+        self.tracking = False
+        self.user_path = []
+        self.left_path = []
+        self.right_path = []
+        # Sequence number of the last coverage delta sent to clients. Clients
+        # use it to detect a missed delta and ask for a resync.
+        self.seq = 0
+        self.lock = Lock()
+
+        # Raster of covered ground with overlap and skip accounting, clipped
+        # to the field boundary if there is one
+        self.coverage = CoverageGrid(resolution_feet=resolution_feet, max_gap_feet=max_gap_feet, boundary=boundary)
+
+        # Swath segments by location, to warn when the implement is over ground
+        # it has already treated
+        self.swath_index = SwathIndex()
+        self.overlapping = False
+
+        # Simplification: fixes that add nothing to the swath are dropped and the
+        # swath edges are thinned before they are stored or sent
+        self.decimator = FixDecimator()
+
+        # Stopped fixes are dropped and headings smoothed ahead of the geodesy
+        self.heading_filter = HeadingFilter()
+        self.left_simplifier = IncrementalSimplifier()
+        self.right_simplifier = IncrementalSimplifier()
+
+        # Optional SessionJournal that persists every change (see journal.py)
+        self.journal = None
+
+        # Packed edges last handed out by snapshot() and the seq they are for
+        self._resync_seq = None
+        self._resync_edges = None
+
+    def process_fix(self, fix):
+        lat = fix.lat
+        lon = fix.lon
+
+        with self.lock:
+            # Read the flag once so a toggle mid-fix cannot split the update
+            is_tracking = self.tracking
+            if is_tracking and self.journal is not None:
+                self.journal.record_fix(fix)
+
+            # Drop stopped fixes and smooth the heading before anything is projected from it
+            filtered = self.heading_filter.filter(fix)
+            if filtered is None:
+                return [('update_current_location', {
+                    'current_location': (lat, lon)
+                })]
+            heading = filtered.heading
+
+            start = metrics.now()
+            front_left, front_right, rear_left, rear_right, front_projection = calculate_new_gps_positions(lat, lon, heading, self.width_feet)
+
+            # Create arrays for front and rear positions
+            front_positions = [front_left, front_right]
+            GEODESY_SECONDS.observe_since(start)
+
+            # Add current position to user_path, skipping fixes that add nothing to the swath
+            start = metrics.now()
+            recorded = is_tracking and self.decimator.accept(lat, lon, heading)
+            if recorded:
+                self.user_path.append((lat, lon))
+                delta = self._add_edge_points(self.left_simplifier.add(rear_left), self.right_simplifier.add(rear_right))
+                PATH_SECONDS.observe_since(start)
+
+                start = metrics.now()
+                self._check_jump(lat, lon)
+                self.coverage.add_edge(rear_left, rear_right)
+                self.swath_index.add_edge(rear_left, rear_right)
+                alert = self._check_overlap(rear_left, rear_right)
+                dirty_tiles = [{'x': x, 'y': y, 'version': version, 'bounds': self.coverage.tile_bounds(x, y)}
+                               for x, y, version in self.coverage.take_dirty_tiles()]
+                coverage_stats = self._stats()
+                COVERAGE_SECONDS.observe_since(start)
+            if is_tracking and self.journal is not None and self.journal.snapshot_due():
+                self.journal.snapshot(self._state())
+
+        # The current location and the positions for the client
+        events = [('update_current_location', {
+            'current_location': (lat, lon)
+        })]
+
+        if is_tracking:
+            events.append(('update_positions', {
+                'front': front_positions,
+                'front_projection': front_projection
+            }))
+
+        if recorded:
+            # Only the new edge points go out; clients append them to their polygon
+            events.append(('coverage_delta', delta))
+            events.append(('coverage_tiles', {
+                'tiles': dirty_tiles,
+                'stats': coverage_stats
+            }))
+            if alert is not None:
+                events.append(('overlap_alert', alert))
+        return events
+
+    # A jump from the last recorded fix (a receiver dropout) starts a new strip
+    # rather than painting across the field, as the offline tools do. Call
+    # with the lock held, after the fix is added to user_path.
+    def _check_jump(self, lat, lon):
+        projection = self.coverage.projection
+        if projection is None or len(self.user_path) < 2:
+            return
+        x0, y0 = projection.to_xy(*self.user_path[-2])
+        x1, y1 = projection.to_xy(lat, lon)
+        if math.hypot(x1 - x0, y1 - y0) > MAX_STEP_WIDTHS * self.width_feet:
+            self.coverage.break_strip()
+            self.swath_index.break_strip()
+
+    # Check the implement line against earlier swath, returning an alert
+    # payload when it starts or stops overlapping. Call with the lock held.
+    def _check_overlap(self, left, right):
+        fraction = self.swath_index.overlap_fraction(left, right)
+        overlapping = fraction >= OVERLAP_ALERT_FRACTION
+        if overlapping == self.overlapping:
+            return None
+        self.overlapping = overlapping
+        center_x, center_y = self.swath_index.to_xy((left[0] + right[0]) / 2, (left[1] + right[1]) / 2)
+        return {
+            'overlapping': overlapping,
+            'fraction': fraction,
+            'location': ((left[0] + right[0]) / 2, (left[1] + right[1]) / 2),
+            'nearest_pass_feet': self.swath_index.nearest_pass(center_x, center_y)
+        }
+
+    # Flip tracking, returning the new state and the events to send
+    def toggle_tracking(self):
+        with self.lock:
+            self.tracking = not self.tracking
+            if self.journal is not None:
+                self.journal.record_toggle(self.tracking)
+            if self.tracking:
+                # A recording starts from a fresh heading estimate, so a replayed
+                # journal filters it exactly as it was filtered live
+                self.heading_filter.reset()
+                return True, []
+            # Commit the held-back edge points and do not join the next pass to
+            # where tracking stopped
+            delta = self._add_edge_points(self.left_simplifier.flush(), self.right_simplifier.flush())
+            self.coverage.break_strip()
+            self.swath_index.break_strip()
+            events = [('coverage_delta', delta)]
+            if self.overlapping:
+                self.overlapping = False
+                events.append(('overlap_alert', {'overlapping': False, 'fraction': 0.0, 'location': None,
+                                                 'nearest_pass_feet': None}))
+        return False, events
+
+    # Store newly committed edge vertices and build the delta for clients. The
+    # sequence number only moves when vertices were added; the tips (points not
+    # committed yet) are sent every time so the polygon reaches the implement.
+    # Call with the lock held.
+    def _add_edge_points(self, new_left, new_right):
+        self.left_path.extend(new_left)
+        self.right_path.extend(new_right)
+        if new_left or new_right:
+            self.seq += 1
+        return {
+            'seq': self.seq,
+            'left': new_left,
+            'right': new_right,
+            'left_tip': self.left_simplifier.tail(),
+            'right_tip': self.right_simplifier.tail()
+        }
+
+    def _stats(self):
+        added = self.left_simplifier.added + self.right_simplifier.added
+        committed = self.left_simplifier.committed + self.right_simplifier.committed
+        stats = self.coverage.stats()
+        stats['fix_reduction'] = self.decimator.reduction_ratio()
+        stats['vertex_reduction'] = 1 - committed / added if added else 0.0
+        return stats
+
+    def stats(self):
+        with self.lock:
+            return self._stats()
+
+    # Full coverage state for a client that has just connected or missed a delta.
+    # The edges are packed (see broadcast.pack_points) once per seq and shared
+    # by every client that asks before the next delta; only the tips are built
+    # per call.
+    def snapshot(self):
+        with self.lock:
+            if self._resync_seq != self.seq:
+                self._resync_edges = (pack_points(self.left_path), pack_points(self.right_path))
+                self._resync_seq = self.seq
+            left, right = self._resync_edges
+            return {
+                'seq': self.seq,
+                'left': left,
+                'right': right,
+                'left_tip': self.left_simplifier.tail(),
+                'right_tip': self.right_simplifier.tail()
+            }
+
+    # Everything needed to rebuild the session, for journal snapshots. Call
+    # with the lock held. Nothing in it is shared with the live session, so
+    # the journal pickles it after the lock is released.
+    def _state(self):
+        return {
+            'width_feet': self.width_feet,
+            'tracking': self.tracking,
+            'user_path': list(self.user_path),
+            'left_path': list(self.left_path),
+            'right_path': list(self.right_path),
+            'seq': self.seq,
+            'coverage': self.coverage.snapshot_copy(),
+            'swath_index': self.swath_index.snapshot_copy(),
+            'overlapping': self.overlapping,
+            'decimator': copy.deepcopy(self.decimator),
+            'heading_filter': copy.deepcopy(self.heading_filter),
+            'left_simplifier': copy.deepcopy(self.left_simplifier),
+            'right_simplifier': copy.deepcopy(self.right_simplifier),
+        }
+
+    def _restore(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._resync_seq = None
+        self._resync_edges = None
+
+    def tile_index(self):
+        with self.lock:
+            return {'tiles': self.coverage.tile_index(), 'stats': self._stats()}
+
+    # The field boundary as GeoJSON, empty if there is none
+    def boundary_geojson(self):
+        with self.lock:
+            if self.coverage.boundary is None:
+                return {'type': 'FeatureCollection', 'features': []}
+            return self.coverage.boundary.to_geojson()
+
+    def render_tile_png(self, x, y):
+        with self.lock:
+            return self.coverage.render_tile_png(x, y)
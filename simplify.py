@@ -0,0 +1,160 @@
+import math
+import numpy as np
+from geodesy import LocalProjection
+
+MIN_DISTANCE_FEET = 1.0  # Fixes closer than this to the last kept fix are dropped...
+MIN_HEADING_CHANGE = 10.0  # ...unless the heading turned at least this many degrees
+EDGE_TOLERANCE_FEET = 0.25  # Largest distance a dropped edge vertex may be from the kept line
+MAX_WINDOW = 64  # Most vertices held back by the incremental simplifier
+
+# Indices to keep from a polyline (Douglas-Peucker). xs and ys are in feet; the
+# first and last points are always kept. Returns a boolean mask.
+def douglas_peucker(xs, ys, tolerance=EDGE_TOLERANCE_FEET):
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    keep = np.zeros(len(xs), dtype=bool)
+    if len(xs) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xs) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        px = xs[start + 1:end]
+        py = ys[start + 1:end]
+        dx = xs[end] - xs[start]
+        dy = ys[end] - ys[start]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px - xs[start], py - ys[start])
+        else:
+            distances = np.abs(dx * (ys[start] - py) - (xs[start] - px) * dy) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+# Simplify an array of (lat, lon) points offline, returning the kept points
+def simplify_latlon(lats, lons, tolerance=EDGE_TOLERANCE_FEET):
+    if len(lats) < 3:
+        return lats, lons
+    projection = LocalProjection(float(lats[0]), float(lons[0]))
+    xs, ys = projection.to_xy(np.asarray(lats), np.asarray(lons))
+    keep = douglas_peucker(xs, ys, tolerance)
+    return lats[keep], lons[keep]
+
+# Drops fixes that do not move the implement or turn it enough to change the
+# swath. Keeps O(1) state and can be fed one fix at a time (live) or a chunk of
+# arrays at a time (offline).
+class FixDecimator:
+    def __init__(self, min_distance_feet=MIN_DISTANCE_FEET, min_heading_change=MIN_HEADING_CHANGE):
+        self.min_distance_feet = min_distance_feet
+        self.min_heading_change = min_heading_change
+        self.seen = 0
+        self.kept = 0
+        self._projection = None
+        self._last = None
+
+    def accept(self, lat, lon, heading):
+        self.seen += 1
+        if self._projection is None:
+            self._projection = LocalProjection(lat, lon)
+        x, y = self._projection.to_xy(lat, lon)
+        if self._last is not None:
+            last_x, last_y, last_heading = self._last
+            turned = abs((heading - last_heading + 180) % 360 - 180)
+            if math.hypot(x - last_x, y - last_y) < self.min_distance_feet and turned < self.min_heading_change:
+                return False
+        self._last = (x, y, heading)
+        self.kept += 1
+        return True
+
+    # Boolean mask of the fixes to keep from arrays of a chunk
+    def filter_chunk(self, lats, lons, headings):
+        accept = self.accept
+        return np.fromiter((accept(lat, lon, heading) for lat, lon, heading
+                            in zip(lats.tolist(), lons.tolist(), headings.tolist())),
+                           dtype=bool, count=len(lats))
+
+    def reduction_ratio(self):
+        return 1 - self.kept / self.seen if self.seen else 0.0
+
+# Douglas-Peucker run incrementally over a growing swath edge. Points are held
+# back while the line from the last committed vertex to the newest point stays
+# within tolerance of all of them. Once it does not, or max_window points are
+# waiting, the held points are simplified and committed. Committed vertices
+# never change, so they can be stored and sent to clients as they come.
+class IncrementalSimplifier:
+    def __init__(self, tolerance_feet=EDGE_TOLERANCE_FEET, max_window=MAX_WINDOW):
+        self.tolerance_feet = tolerance_feet
+        self.max_window = max_window
+        self.added = 0
+        self.committed = 0
+        self._projection = None
+        self._anchor = None
+        self._pending = []
+
+    # Add a (lat, lon) point, returning the list of newly committed vertices
+    def add(self, point):
+        self.added += 1
+        if self._projection is None:
+            self._projection = LocalProjection(point[0], point[1])
+        x, y = self._projection.to_xy(point[0], point[1])
+        entry = (float(x), float(y), point)
+        if self._anchor is None:
+            self._anchor = entry
+            self.committed += 1
+            return [point]
+
+        self._pending.append(entry)
+        if len(self._pending) < 2:
+            return []
+
+        run = [self._anchor] + self._pending
+        xs = np.array([item[0] for item in run])
+        ys = np.array([item[1] for item in run])
+        if len(self._pending) < self.max_window and not self._exceeds(xs, ys):
+            return []
+
+        # Simplify everything before the newest point; it starts the next window
+        keep = douglas_peucker(xs[:-1], ys[:-1], self.tolerance_feet)
+        out = [item[2] for item, kept in zip(run[1:-1], keep[1:]) if kept]
+        self._anchor = run[-2]
+        self._pending = [run[-1]]
+        self.committed += len(out)
+        return out
+
+    def _exceeds(self, xs, ys):
+        dx = xs[-1] - xs[0]
+        dy = ys[-1] - ys[0]
+        length = math.hypot(dx, dy)
+        px = xs[1:-1]
+        py = ys[1:-1]
+        if length == 0:
+            distances = np.hypot(px - xs[0], py - ys[0])
+        else:
+            distances = np.abs(dx * (ys[0] - py) - (xs[0] - px) * dy) / length
+        return bool((distances > self.tolerance_feet).any())
+
+    # Newest point not committed yet, for drawing the edge up to the implement
+    def tail(self):
+        return self._pending[-1][2] if self._pending else None
+
+    # Commit whatever is held back, e.g. at the end of a session
+    def flush(self):
+        out = []
+        if self._pending:
+            run = [self._anchor] + self._pending
+            keep = douglas_peucker([item[0] for item in run], [item[1] for item in run], self.tolerance_feet)
+            out = [item[2] for item, kept in zip(run[1:], keep[1:]) if kept]
+            self._anchor = run[-1]
+            self._pending = []
+            self.committed += len(out)
+        return out
+
+    def reduction_ratio(self):
+        return 1 - self.committed / self.added if self.added else 0.0
@@ -0,0 +1,178 @@
+import copy
+import math
+from bisect import bisect_left
+import numpy as np
+from geodesy import LocalProjection
+
+INDEX_CELL_FEET = 32.0  # Grid hash cell size, about one implement width
+RECENT_FEET = 10.0  # Swath laid within this much travel is the implement's own, not overlap
+PASS_RATIO = 2.0  # Swath laid more than this many times its distance ago belongs to another pass
+NEAREST_PASS_FEET = 200.0  # How far nearest_pass looks
+EDGE_SAMPLES = 9  # Points checked across the implement
+OVERLAP_ALERT_FRACTION = 0.2  # Share of the implement over treated ground that raises an alert
+
+_SAMPLE_STEPS = np.linspace(0, 1, EDGE_SAMPLES)
+
+# Point-in-quad for many points against many convex quads. qx and qy are
+# (segments, 4) corner arrays, px and py the points. Returns a (points,
+# segments) mask; a point on an edge counts as inside.
+def _points_in_quads(px, py, qx, qy):
+    px = px[:, None, None]
+    py = py[:, None, None]
+    ex = qx[:, [1, 2, 3, 0]] - qx
+    ey = qy[:, [1, 2, 3, 0]] - qy
+    cross = ex[None] * (py - qy[None]) - ey[None] * (px - qx[None])
+    return (cross >= 0).all(axis=2) | (cross <= 0).all(axis=2)
+
+# Distance from one point to many segments (x0, y0, x1, y1 columns)
+def _point_segment_distances(x, y, segments):
+    x0, y0, x1, y1 = segments.T
+    dx = x1 - x0
+    dy = y1 - y0
+    length_squared = dx * dx + dy * dy
+    t = np.where(length_squared > 0, ((x - x0) * dx + (y - y0) * dy) / np.where(length_squared > 0, length_squared, 1), 0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+
+# Grid hash over the swath laid so far, maintained one edge at a time like the
+# coverage raster. Every segment (the quad between two consecutive rear edges
+# and the centerline through it) is listed in each cell its bounding box
+# touches, so a query only looks at the segments in a few cells however long
+# the session is. Segments also remember how far the implement had travelled,
+# which is how swath the implement has just laid is told apart from earlier
+# passes.
+class SwathIndex:
+    def __init__(self, cell_feet=INDEX_CELL_FEET, recent_feet=RECENT_FEET, pass_ratio=PASS_RATIO, origin=None):
+        self.cell_feet = cell_feet
+        self.recent_feet = recent_feet
+        self.pass_ratio = pass_ratio
+        self.projection = LocalProjection(*origin) if origin is not None else None
+        self.cells = {}
+        self.count = 0
+        self.travel = 0.0  # Feet driven along the centerline while recording
+        self._quads = np.empty((1024, 8))  # x0..x3, y0..y3
+        self._bounds = np.empty((1024, 4))  # min x, min y, max x, max y
+        self._centers = np.empty((1024, 4))
+        self._travel = np.empty(1024)
+        self._previous = None
+
+    def to_xy(self, lat, lon):
+        if self.projection is None:
+            self.projection = LocalProjection(lat, lon)
+        return self.projection.to_xy(lat, lon)
+
+    # Add the next rear (left, right) pair as (lat, lon) tuples
+    def add_edge(self, left, right):
+        left_x, left_y = self.to_xy(left[0], left[1])
+        right_x, right_y = self.to_xy(right[0], right[1])
+        edge = (float(left_x), float(left_y), float(right_x), float(right_y),
+                (left_x + right_x) / 2, (left_y + right_y) / 2)
+        previous = self._previous
+        self._previous = edge
+        if previous is None:
+            return
+        self.travel += math.hypot(edge[4] - previous[4], edge[5] - previous[5])
+
+        if self.count == len(self._travel):
+            self._quads = np.concatenate((self._quads, np.empty_like(self._quads)))
+            self._bounds = np.concatenate((self._bounds, np.empty_like(self._bounds)))
+            self._centers = np.concatenate((self._centers, np.empty_like(self._centers)))
+            self._travel = np.concatenate((self._travel, np.empty_like(self._travel)))
+        segment = self.count
+        xs = (previous[0], previous[2], edge[2], edge[0])
+        ys = (previous[1], previous[3], edge[3], edge[1])
+        self._quads[segment] = xs + ys
+        self._bounds[segment] = (min(xs), min(ys), max(xs), max(ys))
+        self._centers[segment] = (previous[4], previous[5], edge[4], edge[5])
+        self._travel[segment] = self.travel
+        self.count += 1
+
+        cell = self.cell_feet
+        for cy in range(math.floor(min(ys) / cell), math.floor(max(ys) / cell) + 1):
+            for cx in range(math.floor(min(xs) / cell), math.floor(max(xs) / cell) + 1):
+                self.cells.setdefault((cx, cy), []).append(segment)
+
+    # A copy that can be pickled while segments are added. Rows below count
+    # never change, but the arrays and cell lists are filled in place.
+    def snapshot_copy(self):
+        index = copy.copy(self)
+        index.cells = {key: list(ids) for key, ids in self.cells.items()}
+        index._quads = self._quads.copy()
+        index._bounds = self._bounds.copy()
+        index._centers = self._centers.copy()
+        index._travel = self._travel.copy()
+        return index
+
+    # Start a new strip, so the next pair is not joined to the last one
+    def break_strip(self):
+        self._previous = None
+
+    # Segment ids listed in the cells, below limit if given. Ids are appended
+    # in order, so each cell's ids below the limit are a prefix of its list.
+    def _candidates(self, keys, limit=None):
+        lists = [self.cells[key] for key in keys if key in self.cells]
+        if limit is not None:
+            lists = [ids[:bisect_left(ids, limit)] for ids in lists]
+            lists = [ids for ids in lists if ids]
+        if not lists:
+            return np.empty(0, dtype=np.intp)
+        if len(lists) == 1:
+            return np.asarray(lists[0], dtype=np.intp)
+        return np.unique(np.concatenate([np.asarray(ids, dtype=np.intp) for ids in lists]))
+
+    # Mask of the points (feet) that lie on swath laid more than recent_feet ago
+    def covered(self, xs, ys):
+        xs = np.atleast_1d(np.asarray(xs, dtype=np.float64))
+        ys = np.atleast_1d(np.asarray(ys, dtype=np.float64))
+        keys = set(zip(np.floor(xs / self.cell_feet).astype(int).tolist(),
+                       np.floor(ys / self.cell_feet).astype(int).tolist()))
+        # Travel only grows, so the segments old enough are those below one id
+        limit = int(np.searchsorted(self._travel[:self.count], self.travel - self.recent_feet))
+        ids = self._candidates(keys, limit)
+        if len(ids):
+            # Only quads whose bounding box overlaps the points' need the full test
+            bounds = self._bounds[ids]
+            ids = ids[(bounds[:, 0] <= xs.max()) & (bounds[:, 2] >= xs.min()) &
+                      (bounds[:, 1] <= ys.max()) & (bounds[:, 3] >= ys.min())]
+        if not len(ids):
+            return np.zeros(len(xs), dtype=bool)
+        quads = self._quads[ids]
+        return _points_in_quads(xs, ys, quads[:, :4], quads[:, 4:]).any(axis=1)
+
+    # Share of the implement line between left and right ((lat, lon) tuples)
+    # that lies on earlier swath
+    def overlap_fraction(self, left, right):
+        left_x, left_y = self.to_xy(left[0], left[1])
+        right_x, right_y = self.to_xy(right[0], right[1])
+        covered = self.covered(left_x + (right_x - left_x) * _SAMPLE_STEPS, left_y + (right_y - left_y) * _SAMPLE_STEPS)
+        return int(np.count_nonzero(covered)) / EDGE_SAMPLES
+
+    # Distance in feet from a point to the centerline of the nearest earlier
+    # pass, or None if there is none within max_feet. Segments count as another
+    # pass once they were laid more than pass_ratio times their distance ago in
+    # travel, which leaves out the pass being driven, straight or turning.
+    # Cells are searched in rings outwards until no closer segment can remain.
+    def nearest_pass(self, x, y, max_feet=NEAREST_PASS_FEET):
+        cell = self.cell_feet
+        cx = math.floor(x / cell)
+        cy = math.floor(y / cell)
+        best = None
+        for ring in range(int(math.ceil(max_feet / cell)) + 1):
+            if ring == 0:
+                keys = [(cx, cy)]
+            else:
+                keys = [(cx + dx, cy + dy) for dy in range(-ring, ring + 1) for dx in range(-ring, ring + 1)
+                        if max(abs(dx), abs(dy)) == ring]
+            ids = self._candidates(keys)
+            if len(ids):
+                # A segment listed in several rings is just measured again
+                distances = _point_segment_distances(x, y, self._centers[ids])
+                earlier = self.travel - self._travel[ids] > np.maximum(self.recent_feet, self.pass_ratio * distances)
+                if earlier.any():
+                    nearest = float(distances[earlier].min())
+                    if best is None or nearest < best:
+                        best = nearest
+            # Segments outside the rings searched so far are at least this far away
+            if best is not None and best <= ring * cell:
+                break
+        return best if best is not None and best <= max_feet else None
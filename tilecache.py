@@ -0,0 +1,381 @@
+import argparse
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, abort, request
+from boundary import load_boundary
+from trackstore import read_log_chunks
+
+# Map tiles are served from a local MBTiles file and only fetched from the
+# upstream server the first time they are asked for, so a map loads the same
+# in the field over a bad connection (or none) as in the office.
+TILE_CACHE_FILE = 'tiles.mbtiles'
+UPSTREAM_URL = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'
+ATTRIBUTION = '&copy; OpenStreetMap contributors'
+USER_AGENT = 'polytrack-tilecache/1.0 (field coverage mapping)'
+MAX_TILES = 50000  # Tiles kept on disk (about 750 MB of OSM tiles); least recently used go first
+MEMORY_TILES = 512  # Tiles kept in memory in front of the database
+EVICT_FRACTION = 0.1  # Share of MAX_TILES evicted at once when the cache is full
+FETCH_TIMEOUT = 5.0  # Seconds to wait for the upstream server
+RETRY_SECONDS = 30.0  # After a failed fetch, serve only cached tiles for this long
+USAGE_FLUSH = 256  # Tile reads recorded in memory before their times are written
+CACHE_MAX_AGE = 7 * 24 * 3600  # Browser cache lifetime of a tile, seconds
+
+# The OSM tile usage policy allows at most two download threads
+PREFETCH_THREADS = 2
+PREFETCH_ZOOMS = (12, 19)
+PREFETCH_MAX_TILES = 20000  # Refuse larger prefetches unless asked for more
+PREFETCH_MARGIN_FEET = 300.0  # Extra ground around the bounds
+
+# Leaflet and the Socket.IO client are committed under static/vendor and
+# served from there, so the pages load without a connection. The pages only
+# fall back to the CDN if those files are missing. `tilecache.py vendor --force`
+# downloads them again; change the versions here and in the templates'
+# fallbacks together.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+LEAFLET_VERSION = '1.9.3'
+SOCKETIO_VERSION = '4.8.1'
+LEAFLET_URL = f'https://unpkg.com/leaflet@{LEAFLET_VERSION}/dist'
+VENDOR_ASSETS = {
+    'vendor/leaflet/leaflet.js': f'{LEAFLET_URL}/leaflet.js',
+    'vendor/leaflet/leaflet.css': f'{LEAFLET_URL}/leaflet.css',
+    'vendor/leaflet/images/layers.png': f'{LEAFLET_URL}/images/layers.png',
+    'vendor/leaflet/images/layers-2x.png': f'{LEAFLET_URL}/images/layers-2x.png',
+    'vendor/leaflet/images/marker-icon.png': f'{LEAFLET_URL}/images/marker-icon.png',
+    'vendor/leaflet/images/marker-icon-2x.png': f'{LEAFLET_URL}/images/marker-icon-2x.png',
+    'vendor/leaflet/images/marker-shadow.png': f'{LEAFLET_URL}/images/marker-shadow.png',
+    'vendor/socket.io/socket.io.min.js':
+        f'https://cdnjs.cloudflare.com/ajax/libs/socket.io/{SOCKETIO_VERSION}/socket.io.min.js',
+}
+
+FEET_PER_DEGREE_LAT = 364000.0
+
+# Slippy-map tile column and row of a point
+def tile_xy(lat, lon, zoom):
+    n = 1 << zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+# Every (z, x, y) covering the bounds at the given zooms
+def tiles_in_bounds(south, west, north, east, zooms):
+    for zoom in zooms:
+        x0, y0 = tile_xy(north, west, zoom)
+        x1, y1 = tile_xy(south, east, zoom)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield zoom, x, y
+
+def _fetch(url, timeout=FETCH_TIMEOUT):
+    tile_request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(tile_request, timeout=timeout) as response:
+        return response.read()
+
+# Map tiles in an MBTiles (SQLite) file. Reads go through a small in-memory
+# LRU, then the database, then the upstream server; fetched tiles are stored.
+# The disk cache is bounded too: each tile's last use is kept in a table next
+# to the standard MBTiles ones (written in batches, not on every read), and
+# once there are more than max_tiles the least recently used are deleted.
+# Tiles that were already in the file, e.g. an imported .mbtiles, are given a
+# last use of 0 when it is opened, so they are the first to go.
+# After a failed fetch the upstream server is left alone for RETRY_SECONDS, so
+# an offline map gets its missing tiles as fast 404s instead of timeouts.
+# Safe to use from several threads.
+class TileCache:
+    def __init__(self, path=TILE_CACHE_FILE, upstream=UPSTREAM_URL, max_tiles=MAX_TILES, memory_tiles=MEMORY_TILES,
+                 offline=False):
+        self.path = path
+        self.upstream = upstream
+        self.max_tiles = max_tiles
+        self.memory_tiles = memory_tiles
+        self.offline = offline
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.fetched = 0
+        self.misses = 0
+        self.evicted = 0
+        self._memory = OrderedDict()
+        self._touched = {}
+        self._retry_after = 0.0
+        self._lock = threading.Lock()
+        self.count = 0
+        self._db = None
+
+    # The database is opened on first use, so importing a server creates no file.
+    # Call with the lock held.
+    def _database(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                                 'tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+                self._db.execute('CREATE TABLE IF NOT EXISTS tile_usage (zoom_level INTEGER, tile_column INTEGER, '
+                                 'tile_row INTEGER, last_used REAL, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+                self._db.execute('CREATE INDEX IF NOT EXISTS tile_usage_last_used ON tile_usage (last_used)')
+                self._db.executemany('INSERT OR IGNORE INTO metadata VALUES (?, ?)', [
+                    ('name', 'polytrack tile cache'), ('format', 'png'), ('type', 'baselayer'),
+                    ('version', '1'), ('attribution', ATTRIBUTION)])
+            self.count = self._db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+            if self._db.execute('SELECT COUNT(*) FROM tile_usage').fetchone()[0] < self.count:
+                with self._db:
+                    self._db.execute('INSERT OR IGNORE INTO tile_usage SELECT zoom_level, tile_column, tile_row, 0 '
+                                     'FROM tiles')
+            if self.count > self.max_tiles:
+                self._evict()
+        return self._db
+
+    # MBTiles rows count from the south (TMS), slippy-map rows from the north
+    @staticmethod
+    def _key(z, x, y):
+        return z, x, (1 << z) - 1 - y
+
+    # Tile image bytes, or None if it is not cached and cannot be fetched
+    def get(self, z, x, y):
+        key = self._key(z, x, y)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self._touch(key)
+                return data
+            row = self._database().execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                   'AND tile_row = ?', key).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                self._remember(key, row[0])
+                self._touch(key)
+                return row[0]
+            if self.offline or time.monotonic() < self._retry_after:
+                self.misses += 1
+                return None
+        # Fetch without the lock so cached tiles keep being served meanwhile
+        try:
+            data = _fetch(self.upstream.format(z=z, x=x, y=y))
+        except urllib.error.HTTPError:
+            # The server answered, it just has no such tile
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError:
+            with self._lock:
+                self._retry_after = time.monotonic() + RETRY_SECONDS
+                self.misses += 1
+            return None
+        self.put(z, x, y, data)
+        with self._lock:
+            self.fetched += 1
+        return data
+
+    def put(self, z, x, y, data):
+        key = self._key(z, x, y)
+        with self._lock:
+            with self._database():
+                existed = self._database().execute('SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                           'AND tile_row = ?', key).fetchone() is not None
+                self._database().execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', key + (sqlite3.Binary(data),))
+                self._database().execute('INSERT OR REPLACE INTO tile_usage VALUES (?, ?, ?, ?)', key + (time.time(),))
+            self._remember(key, data)
+            self.count += not existed
+            if self.count > self.max_tiles:
+                self._evict()
+
+    def contains(self, z, x, y):
+        with self._lock:
+            return self._database().execute('SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                    self._key(z, x, y)).fetchone() is not None
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_tiles:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key):
+        self._touched[key] = time.time()
+        if len(self._touched) >= USAGE_FLUSH:
+            self._flush_usage()
+
+    def _flush_usage(self):
+        if self._touched:
+            with self._database():
+                self._database().executemany('UPDATE tile_usage SET last_used = ? WHERE zoom_level = ? AND tile_column = ? '
+                                     'AND tile_row = ?', [(used,) + key for key, used in self._touched.items()])
+            self._touched.clear()
+
+    # Delete the least recently used tiles, EVICT_FRACTION of the cache at a time
+    def _evict(self):
+        self._flush_usage()
+        excess = self.count - self.max_tiles + int(self.max_tiles * EVICT_FRACTION)
+        with self._database():
+            victims = self._database().execute('SELECT zoom_level, tile_column, tile_row FROM tile_usage '
+                                       'ORDER BY last_used LIMIT ?', (excess,)).fetchall()
+            self._database().executemany('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', victims)
+            self._database().executemany('DELETE FROM tile_usage WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                 victims)
+        for key in victims:
+            self._memory.pop(tuple(key), None)
+        self.evicted += len(victims)
+        self.count = self._database().execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    # Download the tiles covering the bounds at the given zooms that are not
+    # cached yet. Returns (already cached, fetched, failed).
+    def prefetch(self, south, west, north, east, zooms, threads=PREFETCH_THREADS, progress=None):
+        missing = [tile for tile in tiles_in_bounds(south, west, north, east, zooms) if not self.contains(*tile)]
+        cached = sum(1 for _ in tiles_in_bounds(south, west, north, east, zooms)) - len(missing)
+
+        def download(tile):
+            z, x, y = tile
+            try:
+                self.put(z, x, y, _fetch(self.upstream.format(z=z, x=x, y=y)))
+                return True
+            except (OSError, sqlite3.Error):
+                # Not downloaded, or not stored (database locked, disk full)
+                return False
+
+        fetched = failed = 0
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for done, ok in enumerate(pool.map(download, missing), 1):
+                fetched += ok
+                failed += not ok
+                if progress is not None:
+                    progress(done, len(missing))
+        with self._lock:
+            self.fetched += fetched
+        return cached, fetched, failed
+
+    def stats(self):
+        with self._lock:
+            self._database()
+            return {
+                'tiles': self.count,
+                'max_tiles': self.max_tiles,
+                'memory_tiles': len(self._memory),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'fetched': self.fetched,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'bytes': os.path.getsize(self.path),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._flush_usage()
+            self._db.close()
+            self._db = None
+
+# Flask response for a tile: long-lived browser caching and an ETag, so a
+# reload revalidates with a 304 instead of downloading the tile again
+def tile_response(cache, z, x, y):
+    data = cache.get(z, x, y)
+    if data is None:
+        abort(404)
+    response = Response(data, mimetype='image/png',
+                        headers={'Cache-Control': f'public, max-age={CACHE_MAX_AGE}'})
+    response.set_etag(hashlib.md5(data).hexdigest())
+    return response.make_conditional(request)
+
+# Download the vendored frontend assets into static/. Returns the number that
+# could not be downloaded.
+def vendor_assets(static_dir=STATIC_DIR, force=False):
+    failed = 0
+    for name, url in VENDOR_ASSETS.items():
+        path = os.path.join(static_dir, name)
+        if os.path.exists(path) and not force:
+            continue
+        try:
+            data = _fetch(url, timeout=30)
+        except OSError as e:
+            print(f"Could not download {url}: {e}")
+            failed += 1
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as asset_file:
+            asset_file.write(data)
+        print(f"Wrote {path} ({len(data) / 1024:,.0f} KiB)")
+    return failed
+
+# (south, west, north, east) of a GPS log or boundary file
+def _bounds_of(path):
+    if path.lower().endswith(('.csv', '.trk')):
+        south = west = math.inf
+        north = east = -math.inf
+        for chunk in read_log_chunks(path):
+            south = min(south, float(chunk['lat'].min()))
+            north = max(north, float(chunk['lat'].max()))
+            west = min(west, float(chunk['lon'].min()))
+            east = max(east, float(chunk['lon'].max()))
+        return south, west, north, east
+    return load_boundary(path).bounds
+
+def _zooms(text):
+    low, _, high = text.partition('-')
+    return range(int(low), int(high or low) + 1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the offline map tile cache.')
+    parser.add_argument('--cache', default=TILE_CACHE_FILE, help='MBTiles file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prefetch = commands.add_parser('prefetch', help="Download the tiles around a field")
+    prefetch.add_argument('source', nargs='?', help='Boundary file (GeoJSON/shapefile) or GPS log (.csv/.trk)')
+    prefetch.add_argument('--bounds', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'))
+    prefetch.add_argument('--zoom', default=f'{PREFETCH_ZOOMS[0]}-{PREFETCH_ZOOMS[1]}', help='Zoom or range, e.g. 12-19')
+    prefetch.add_argument('--margin', type=float, default=PREFETCH_MARGIN_FEET, help='Feet added around the bounds')
+    prefetch.add_argument('--max-tiles', type=int, default=PREFETCH_MAX_TILES, help='Refuse larger prefetches')
+    prefetch.add_argument('--upstream', default=UPSTREAM_URL, help='Tile URL template')
+    commands.add_parser('stats', help='Show what is cached')
+    vendor = commands.add_parser('vendor', help='Refresh the committed Leaflet and Socket.IO client in static/')
+    vendor.add_argument('--force', action='store_true', help='Download again even if present')
+    args = parser.parse_args()
+
+    if args.command == 'vendor':
+        if vendor_assets(force=args.force):
+            raise SystemExit(1)
+        return
+
+    if args.command == 'stats':
+        cache = TileCache(args.cache)
+        print(cache.stats())
+        cache.close()
+        return
+
+    if args.bounds:
+        south, west, north, east = args.bounds
+    elif args.source:
+        south, west, north, east = _bounds_of(args.source)
+    else:
+        parser.error('prefetch needs a boundary file, a GPS log or --bounds')
+    margin_lat = args.margin / FEET_PER_DEGREE_LAT
+    margin_lon = margin_lat / math.cos(math.radians((south + north) / 2))
+    south, west, north, east = south - margin_lat, west - margin_lon, north + margin_lat, east + margin_lon
+    zooms = _zooms(args.zoom)
+    total = sum(1 for _ in tiles_in_bounds(south, west, north, east, zooms))
+    if total > args.max_tiles:
+        parser.error(f"{total} tiles at zoom {args.zoom}; raise --max-tiles or lower the zoom")
+
+    cache = TileCache(args.cache, upstream=args.upstream, max_tiles=max(MAX_TILES, total))
+    start = time.perf_counter()
+
+    def progress(done, count):
+        if done % 100 == 0 or done == count:
+            print(f"  {done}/{count} downloaded")
+
+    cached, fetched, failed = cache.prefetch(south, west, north, east, zooms, progress=progress)
+    print(f"{total} tiles for ({south:.5f}, {west:.5f}) - ({north:.5f}, {east:.5f}) at zoom {args.zoom}: "
+          f"{cached} already cached, {fetched} fetched, {failed} failed in {time.perf_counter() - start:.1f} s")
+    cache.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import csv
+import itertools
+import os
+import struct
+import time
+from datetime import datetime
+import numpy as np
+
+# On-disk layout: a 16 byte header followed by fixed-width little-endian records
+TRACK_MAGIC = b'POLYTRK\0'
+TRACK_VERSION = 1
+HEADER = struct.Struct('<8sHH4x')
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),  # Seconds since the epoch
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('alt', '<f4'),  # Feet
+    ('speed', '<f4'),  # mph
+    ('heading', '<f4'),  # Degrees
+])
+RECORD = struct.Struct('<dddfff')
+assert RECORD.size == RECORD_DTYPE.itemsize
+
+CHUNK_ROWS = 65536  # Records handed out at a time by read_track_chunks
+
+class TrackFormatError(ValueError):
+    pass
+
+def _check_header(data, path):
+    if len(data) < HEADER.size:
+        raise TrackFormatError(f"{path}: truncated track header")
+    magic, version, record_size = HEADER.unpack(data[:HEADER.size])
+    if magic != TRACK_MAGIC:
+        raise TrackFormatError(f"{path}: not a track file")
+    if version != TRACK_VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise TrackFormatError(f"{path}: unsupported track version {version} (record size {record_size})")
+
+# Appends fixes to a track file through one long-lived buffered file. Data is
+# flushed and fsynced every fsync_interval seconds, so a crash loses at most
+# that much of the session.
+class TrackWriter:
+    def __init__(self, path, append=True, fsync_interval=5.0, buffer_records=256):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.records = 0
+
+        size = os.path.getsize(path) if append and os.path.exists(path) else 0
+        if size:
+            with open(path, 'rb') as existing:
+                _check_header(existing.read(HEADER.size), path)
+            # Drop a partial record left behind by a crash
+            self.records = (size - HEADER.size) // RECORD.size
+            with open(path, 'r+b') as existing:
+                existing.truncate(HEADER.size + self.records * RECORD.size)
+            self._file = open(path, 'ab', buffering=buffer_records * RECORD.size)
+        else:
+            self._file = open(path, 'wb', buffering=buffer_records * RECORD.size)
+            self._file.write(HEADER.pack(TRACK_MAGIC, TRACK_VERSION, RECORD.size))
+        self._last_sync = time.monotonic()
+
+    def append(self, timestamp, lat, lon, alt, speed, heading):
+        self._file.write(RECORD.pack(timestamp, lat, lon, alt, speed, heading))
+        self.records += 1
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Map a track file as a read-only structured array without copying it
+def load_track(path):
+    with open(path, 'rb') as track:
+        _check_header(track.read(HEADER.size), path)
+    records = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    if records == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(records,))
+
+# Yield zero-copy slices of a track file, chunk_rows records at a time
+def read_track_chunks(path, chunk_rows=CHUNK_ROWS):
+    track = load_track(path)
+    for start in range(0, len(track), chunk_rows):
+        yield track[start:start + chunk_rows]
+
+# Columns kept from each log row
+FIX_DTYPE = np.dtype([
+    ('lat', np.float64),
+    ('lon', np.float64),
+    ('alt', np.float32),
+    ('speed', np.float32),
+    ('heading', np.float32),
+])
+CSV_COLUMNS = ['Latitude', 'Longitude', 'Altitude (feet)', 'Speed (mph)', 'Heading (degrees)']
+
+# Read a GPS log CSV in fixed-size chunks of typed column arrays
+def read_csv_chunks(path, chunk_rows=CHUNK_ROWS):
+    with open(path, 'r', newline='') as csvfile:
+        header = next(csv.reader([csvfile.readline()]), None)
+        if not header:
+            return
+        usecols = [header.index(name) for name in CSV_COLUMNS]
+        while True:
+            lines = list(itertools.islice(csvfile, chunk_rows))
+            if not lines:
+                break
+            columns = np.loadtxt(lines, delimiter=',', usecols=usecols, dtype=np.float64, ndmin=2)
+            chunk = np.empty(len(columns), dtype=FIX_DTYPE)
+            for i, field in enumerate(FIX_DTYPE.names):
+                chunk[field] = columns[:, i]
+            yield chunk
+
+# Read a session from a binary track file or a CSV log
+def read_log_chunks(path, chunk_rows=CHUNK_ROWS):
+    if path.endswith('.trk'):
+        return read_track_chunks(path, chunk_rows)
+    return read_csv_chunks(path, chunk_rows)
+
+# Convert a CSV log written by the old getfrombt.py into a track file
+def csv_to_track(csv_path, track_path):
+    with open(csv_path, 'r', newline='') as csvfile, TrackWriter(track_path, append=False, fsync_interval=float('inf')) as writer:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            writer.append(datetime.fromisoformat(row['Timestamp']).timestamp(),
+                          float(row['Latitude']),
+                          float(row['Longitude']),
+                          float(row['Altitude (feet)']),
+                          float(row['Speed (mph)']),
+                          float(row['Heading (degrees)']))
+        return writer.records
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a CSV GPS log into a binary track file.')
+    parser.add_argument('input', help='CSV log to convert')
+    parser.add_argument('output', nargs='?', help='Track file to write (defaults to the input name with .trk)')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + '.trk'
+    records = csv_to_track(args.input, output)
+    print(f"Wrote {records} records to {output}")
+
+if __name__ == '__main__':
+    main()